@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+""" End to end benchmark of the publish scripts.
+
+For each scale, makes a synthetic repository with synth_repo under a
+temporary root, puts stand-ins for the external tools first in PATH, and
+times:
+
+- pending_scan_cold: a PendingScan of every dist's pending directory,
+  with an empty header cache
+- pending_scan_warm: the same again, with the header cache filled
+- vers_search: vers_search.version_matrix over every standard dist
+- miss_srpm_search: miss_srpm_search.main
+- publish_fake: what publish.py -f does, with the mail it would send
+  made but not sent
+
+The results are written as JSON, one record per scale, so runs can be
+compared against each other to spot regressions.
+"""
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import dep_problems
+import mail_publish
+import miss_srpm_search
+import pending_scan
+import publish
+import rpm_cache
+import repo_catalog
+import rpm_config
+import synth_repo
+import vers_search
+
+DEFAULT_SCALES = [1000, 5000]
+
+def quietly(func, *args):
+    """ @return func(*args), with anything it prints thrown away """
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+
+def timed(timings, phase, func, *args):
+    """ Call func(*args) quietly, noting how long it took in timings """
+    start = time.time()
+    result = quietly(func, *args)
+    timings[phase] = round(time.time() - start, 4)
+    return result
+
+def floating_dists():
+    return sorted(rpm_config.fixed_to_floating.values())
+
+def scan_pending(workers):
+    publisher = publish.Publisher([], 1)
+    for dist in floating_dists():
+        pending_scan.PendingScan(dist,
+                                 pending_dir=rpm_config.pending_dir(dist),
+                                 rpm_ver=publisher.rpm_max_ver[dist],
+                                 accept_level=publisher.get_pkg_ver_limit(dist),
+                                 workers=workers)
+
+def fake_publish(root, workers):
+    """ Do what publish.py -f does, in root, without mailing anyone """
+    os.mkdir('%s/test' % root)
+    for dist in floating_dists():
+        os.symlink(rpm_config.pending_dir(dist),
+                   '%s/test/PENDING.%s' % (root, dist))
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        dep_problems.init()
+        publisher = publish.Publisher(floating_dists(), 1, workers)
+        pub_result = publisher.publish_all()
+        emails = mail_publish.publish_receivers(pub_result.get_publishers())
+        mail_publish.create_publish_text(pub_result, emails)
+    finally:
+        os.chdir(cwd)
+
+def run_scale(packages, workers, keep=0):
+    """ Benchmark one synthetic repository of packages packages
+
+    @return dict of the results
+    """
+    root = tempfile.mkdtemp(prefix='bench_publish.')
+    saved_path = os.environ.get('PATH', '')
+    try:
+        timings = {}
+        pending = timed(timings, 'generate', synth_repo.generate, root,
+                        packages)
+        synth_repo.write_tools('%s/bin' % root)
+        os.environ['PATH'] = '%s/bin:%s' % (root, saved_path)
+        dep_problems.config_dict["TEMPDIR"] = \
+            '%s/var/local/dep_problems' % root
+        dep_problems.config_dict["RPM_ROOT"] = \
+            '%s/var/local/lib/vpkgs_only' % root
+
+        rpm_cache.close()
+        repo_catalog.close()
+        timed(timings, 'pending_scan_cold', scan_pending, workers)
+        timed(timings, 'pending_scan_warm', scan_pending, workers)
+        timed(timings, 'vers_search', vers_search.version_matrix)
+        timed(timings, 'miss_srpm_search', miss_srpm_search.main,
+              ['miss_srpm_search.py', '-j', str(workers)])
+        timed(timings, 'publish_fake', fake_publish, root, workers)
+        rpm_cache.close()
+        repo_catalog.close()
+    finally:
+        os.environ['PATH'] = saved_path
+        if keep:
+            print >> sys.stderr, "Kept", root
+        else:
+            shutil.rmtree(root)
+
+    return {'packages': packages,
+            'pending': sum(pending.values()),
+            'workers': workers,
+            'timings': timings}
+
+def usage(argv):
+    print "%s [-n scales] [-j N] [-o file] [-k]" % argv[0]
+    print "Time the publish scripts against synthetic repositories"
+    print "-n : comma separated numbers of packages, default %s" % (
+        ','.join(map(str, DEFAULT_SCALES)))
+    print "-j N : examine up to N rpms at once"
+    print "-o : write the JSON results to file instead of stdout"
+    print "-k : keep the synthetic repositories"
+    print "-h : print this message"
+
+def main(argv):
+    scales = DEFAULT_SCALES
+    workers = 1
+    output = None
+    keep = 0
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hn:j:o:k')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-n':
+                scales = [int(n) for n in val.split(',')]
+            elif opt == '-j':
+                workers = int(val)
+            elif opt == '-o':
+                output = val
+            elif opt == '-k':
+                keep = 1
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    results = []
+    for packages in scales:
+        result = run_scale(packages, workers, keep)
+        print >> sys.stderr, "%d packages: %s" % (packages, ', '.join(
+            ['%s %.2fs' % item for item in sorted(result['timings'].items())]))
+        results.append(result)
+
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if output == None:
+        print text
+    else:
+        fp = open(output, 'w')
+        fp.write(text + '\n')
+        fp.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
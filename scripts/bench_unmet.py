@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+""" Microbenchmark for dep_problems.parse_unmet.
+
+Writes a synthetic apt-cache unmet dump of a repository where every
+package has unmet dependencies, then parses it both streamed line by
+line from a pipe and the old way (the whole output read into one string
+and split into a list), printing the time each took and how much each
+grew the peak memory use of the process.  The streamed parse runs
+first, since peak memory only ever goes up.
+"""
+
+import commands
+import getopt
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import dep_problems
+
+DEFAULT_PACKAGES = 50000
+
+def write_dump(fp, packages, seed=0):
+    """ Write an apt-cache unmet dump of packages broken packages to fp.
+    Dependencies come from a pool a tenth the size, as in a real
+    repository many packages miss the same few things. """
+    rand = random.Random(seed)
+    pool = ["lib%d.so.%d" % (i, i % 7) for i in range(max(packages / 10, 1))]
+    for i in range(packages):
+        fp.write("Package pkg%d version %d.%d-%d\n" % (i, i % 13, i % 5, 1))
+        for j in range(rand.randint(1, 4)):
+            dep = rand.choice(pool)
+            if rand.random() < 0.3:
+                fp.write("  Depends: %s (>= %d.0)\n" % (dep, j))
+            else:
+                fp.write("  Depends: %s\n" % dep)
+
+def max_rss():
+    """ @return peak resident size of this process, in kilobytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def time_it(func):
+    """ @return (seconds, peak memory growth in kilobytes, result) of
+    calling func """
+    rss = max_rss()
+    start = time.time()
+    result = func()
+    return time.time() - start, max_rss() - rss, result
+
+def main(argv):
+    packages = DEFAULT_PACKAGES
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hn:')
+        for opt, val in opts:
+            if opt == '-h':
+                print "%s [-n packages]" % argv[0]
+                print "-n : packages in the dump, default %d" % (
+                    DEFAULT_PACKAGES)
+                return 1
+            elif opt == '-n':
+                packages = int(val)
+    except (getopt.GetoptError, ValueError):
+        print "%s [-n packages]" % argv[0]
+        return 1
+
+    fd, dump = tempfile.mkstemp(prefix='unmet.')
+    try:
+        fp = os.fdopen(fd, 'w')
+        write_dump(fp, packages)
+        fp.close()
+        print "dump of %d packages, %d bytes" % (packages,
+                                                 os.path.getsize(dump))
+
+        cmd = "cat %s" % dump
+        counts = {}
+        stream = time_it(lambda: dep_problems.parse_unmet(
+            dep_problems.unmet_output(cmd), counts))
+        split = time_it(lambda: dep_problems.parse_unmet(
+            commands.getoutput(cmd).split('\n')))
+    finally:
+        os.remove(dump)
+
+    assert split[2] == stream[2]
+    print "streamed:          %.3fs, peak memory +%dkB" % stream[:2]
+    print "getoutput + split: %.3fs, peak memory +%dkB" % split[:2]
+    print "%(packages)d packages, %(skipped)d lines skipped" % counts
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,127 +1,297 @@
 #!/usr/bin/env python
 
-import glob, os, shutil, string
+""" Check the SPEC files of the source rpms waiting to be published.
+
+Every SPEC file needs a %files section, %defattr, a %doc entry and a
+%changelog.  The SPEC file is read straight out of each source rpm's
+payload, in a single pass, and source rpms are checked in parallel.
+Packages in testing whose SPEC file fails are moved to the error
+directory; in unstable they are only warned about.  Either way mail
+goes to oss-rpm.
+
+Results are saved under rpm_config.cache_dir keyed by the MD5 digest in
+each source rpm's signature and by the version of the rules, so a source
+rpm still waiting from an earlier run is neither read nor mailed about
+again.  Results not used for KEEP_DAYS are dropped.
+"""
+
+import cPickle
+import getopt
+import glob
+import hashlib
+import os
+import re
+import sys
+import time
+
+import fileops
+import rpm_config
+import rpm_header
+import rpm_payload
+import rpm_util
 
 SENDMAIL = "/usr/lib/sendmail" # sendmail location
+LOGFILE = "/var/adm/publish.log"
+MAIL_TO = "oss-rpm@oss.rutgers.edu"
+KEEP_DAYS = 30 # days a saved result is kept after its last use
 
 repos = ["testing", "unstable"]
-for repo in repos:
-	os.chdir("/rpm/CHECK_PEND.%s" %repo)
-	os.system('mkdir tmp/')
-	files = glob.glob("*.src.rpm")
-	flog = open('/var/adm/publish.log', 'a')
-	
-	for file in files:
-		os.system("cp %s tmp/" %file)
-
-	os.chdir("tmp/")
-	for file in files:
-		os.popen("bash /usr/local/bin/publish/extractrpm.sh %s" %file)
-
-	source_folder = r"/rpm/CHECK_PEND.%s/tmp" %repo
-	pend_error = r"/rpm/pending.error"
-
-	extension = ".spec"
-	findstr = "%changelog"
-	findstr1 = "%doc"
-	findstr2 = "%files"
-	findstr3 = "%defattr"
-	rejfiles = 0
-	rejrpms = ""
-	rejrpm = ""
-	rejected = 0
-	rejectedspecs = []
-	acceptedspecs = []
-	no_changelog = []
-	no_doc = []
-	no_files = []
-	no_defattr = []
-
-	for filename in os.listdir(source_folder):
-		source_file = os.path.join(source_folder, filename)
-		if source_file.endswith(extension):
-			changelog = 1
-			doc = 1
-			files = 1
-			defattr = 1
-			rejected = 0
-			if not findstr in open(source_file).read():
-				changelog = 0
-				no_changelog.append(1)
-				rejected = 1
-			if not findstr1 in open(source_file).read():
-				doc = 0
-				no_doc.append(1)
-				rejected = 1
-			if not findstr2 in open(source_file).read():
-				files = 0
-				no_files.append(1)
-				rejected = 1
-			if not findstr3 in open(source_file).read():
-				defattr = 0
-				no_defattr.append(1)
-				rejected = 1
-			if rejected:
-				rejfiles = 1
-				rejectedspecs.append(filename)
-				if changelog:
-					no_changelog.append(0)
-				if doc:
-					no_doc.append(0)
-				if files:
-					no_files.append(0)
-				if defattr:
-					no_defattr.append(0)
-				print >> flog, "%s failed spec file checking" % (source_file)
-			else:
-				print >> flog, "%s passed spec file checking" % (source_file)
-				acceptedspecs.append(filename)
-
-	if repo == "testing":
-		os.chdir("/rpm/CHECK_PEND.%s" %repo)
-		for i in rejectedspecs:
-			rejrpm=i
-			rejrpm=rejrpm[:-5]
-			rejrpm=rejrpm+"*"
-			rejrpms = glob.glob(rejrpm)
-			
-			for p in rejrpms:
-				os.system("mv %s /rpm/pending.error/" %p)
-
-	if rejfiles:
-		p=os.popen("%s -t" % SENDMAIL, "w")
-		p.write("To: oss-rpm@oss.rutgers.edu\n")
-		if repo == "testing":
-			p.write("Subject: Rejected: %s\n" % (rejectedspecs))
-		else:
-			p.write("Subject: Warning: %s failed spec file check\n" % (rejectedspecs))
-		p.write("\n") # blank line separating headers from body
-		p.write("SPEC FILE CHECKING\n")
-		p.write("Repository: %s\n\n" %repo)
-		p.write("Passed spec files\n")
-		p.write(string.join(acceptedspecs, "\n"))
-		if repo == "testing":
-			p.write("\n\nRejected spec files\n")
+# repos whose failures are moved to the error directory
+rejecting_repos = ["testing"]
+
+# (what must appear in the SPEC file, reason given if it doesn't), in the
+# order reasons are mailed
+rules = [("%files", "missing files section"),
+	 ("%defattr", "missing file attributes"),
+	 ("%doc", "missing doc entry"),
+	 ("%changelog", "missing changelog")]
+_rule_pattern = re.compile('|'.join([re.escape(r[0]) for r in rules]))
+# changes whenever the rules do, so saved results of old rules are unused
+rules_version = hashlib.md5(repr(rules)).hexdigest()[:8]
+
+class SpecCheck:
+	""" Result of checking the SPEC file of one source rpm """
+	def __init__(self, srpm, spec_name=None, reasons=None, error=None,
+		     cached=0):
+		""" @param reasons list of reasons the SPEC file failed, empty
+		if it passed
+		@param error why the source rpm couldn't be checked at all
+		@param cached non-zero if the result was saved by an earlier
+		run """
+		self.srpm = srpm
+		self.spec_name = spec_name
+		self.reasons = reasons or []
+		self.error = error
+		self.cached = cached
+
+	def failed(self):
+		return self.spec_name != None and len(self.reasons) > 0
+
+class ResultCache:
+	""" Results of earlier runs, keyed by (source rpm digest, rules
+	version) yielding (SPEC file name, reasons, time last used) """
+	def __init__(self, filename):
+		self.filename = filename
+		self._now = time.time()
+		try:
+			fp = open(filename, 'rb')
+			try:
+				self._results = cPickle.load(fp)
+			finally:
+				fp.close()
+		except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+			self._results = {}
+
+	def lookup(self, digest):
+		""" @return (SPEC file name, reasons) or None """
+		key = (digest, rules_version)
+		saved = self._results.get(key)
+		if saved == None:
+			return None
+		self._results[key] = (saved[0], saved[1], self._now)
+		return saved[:2]
+
+	def store(self, digest, spec_name, reasons):
+		self._results[(digest, rules_version)] = (spec_name, reasons,
+							  self._now)
+
+	def clear(self):
+		self._results = {}
+
+	def save(self):
+		""" Write out the results used in the last KEEP_DAYS """
+		oldest = self._now - KEEP_DAYS * 24 * 60 * 60
+		results = {}
+		for key, saved in self._results.items():
+			if key[1] == rules_version and saved[2] >= oldest:
+				results[key] = saved
+		try:
+			if not os.path.isdir(rpm_config.cache_dir):
+				os.makedirs(rpm_config.cache_dir)
+			fp = open(self.filename + '.new', 'wb')
+			cPickle.dump(results, fp, 2)
+			fp.close()
+			os.rename(self.filename + '.new', self.filename)
+		except (IOError, OSError), e:
+			print >> sys.stderr, "Warning, can't save spec checks:", e
+
+def cache_file():
+	return '%s/specchecks' % rpm_config.cache_dir
+
+def srpm_digest(path):
+	""" @return hex MD5 of the header and payload of the rpm at path,
+	from its signature if it has one """
+	header = rpm_header.read_header(path, tags=(),
+					sigtags=(rpm_header.SIGTAG_MD5,))
+	md5 = header.sigtags.get(rpm_header.SIGTAG_MD5)
+	if md5:
+		return md5.encode('hex')
+	digest = hashlib.md5()
+	fp = open(path, 'rb')
+	try:
+		fp.seek(header.header_start)
+		while 1:
+			data = fp.read(1024 * 1024)
+			if not data: break
+			digest.update(data)
+	finally:
+		fp.close()
+	return digest.hexdigest()
+
+def check_spec(text):
+	""" @return list of reasons SPEC file text fails the rules, in
+	rules order """
+	found = {}
+	for match in _rule_pattern.finditer(text):
+		found[match.group()] = 1
+	return [reason for required, reason in rules if not required in found]
+
+def check_srpm(path, cache=None):
+	""" @return SpecCheck for the source rpm at path
+
+	@param cache optional ResultCache to look for an earlier result in
+	and save a new one to
+	"""
+	srpm = os.path.basename(path)
+	try:
+		digest = None
+		if cache != None:
+			digest = srpm_digest(path)
+			saved = cache.lookup(digest)
+			if saved != None:
+				return SpecCheck(srpm, saved[0], saved[1], cached=1)
+		spec = rpm_payload.spec_file(path)
+	except (IOError, OSError), e:
+		return SpecCheck(srpm, error=str(e))
+	if spec == None:
+		return SpecCheck(srpm, error="no SPEC file")
+
+	spec_name, reasons = os.path.basename(spec[0]), check_spec(spec[1])
+	if digest != None:
+		cache.store(digest, spec_name, reasons)
+	return SpecCheck(srpm, spec_name, reasons)
+
+def check_repo(repo, workers=1, cache=None):
+	""" @return list of SpecCheck for every source rpm in the pending
+	directory of repo, in filename order """
+	pending = rpm_config.pending_dir(repo)
+	srpms = glob.glob("%s/*.src.rpm" % pending)
+	srpms.sort()
+	return rpm_util.parallel_map(lambda path: check_srpm(path, cache),
+				     srpms, workers)
+
+def reject(repo, failed):
+	""" Move everything in the pending directory of repo named like the
+	SPEC files of failed to the error directory """
+	pending = rpm_config.pending_dir(repo)
+	moves = {}
+	for check in failed:
+		pattern = "%s/%s*" % (pending, check.spec_name[:-len(".spec")])
+		for path in glob.glob(pattern):
+			moves[path] = 1
+	paths = moves.keys()
+	paths.sort()
+	fileops.move_files([(path, rpm_config.error_dir) for path in paths])
+
+def report_text(repo, passed, failed):
+	""" @return mail about the SPEC files of repo, headers included """
+	rejecting = repo in rejecting_repos
+	failed_names = [check.spec_name for check in failed]
+	lines = ["To: %s" % MAIL_TO]
+	if rejecting:
+		lines.append("Subject: Rejected: %s" % failed_names)
+	else:
+		lines.append("Subject: Warning: %s failed spec file check" %
+			     failed_names)
+	lines.append("") # blank line separating headers from body
+	lines.append("SPEC FILE CHECKING")
+	lines.append("Repository: %s\n" % repo)
+	lines.append("Passed spec files")
+	lines.extend([check.spec_name for check in passed])
+	if rejecting:
+		lines.append("\nRejected spec files")
+	else:
+		lines.append("\nFailed spec files")
+	lines.extend(failed_names)
+	lines.append("\nReason(s) for failure")
+	for check in failed:
+		lines.append("%s:" % check.spec_name)
+		lines.extend(check.reasons)
+		lines.append("")
+	return '\n'.join(lines) + '\n'
+
+def send_mail(text, log):
+	p = os.popen("%s -t" % SENDMAIL, "w")
+	p.write(text)
+	sts = p.close()
+	if sts:
+		print >> log, "Sendmail exit status", sts
+
+def process_repo(repo, log, workers=1, cache=None):
+	""" Check, log, reject and mail about the source rpms of repo.
+	Results saved by an earlier run are only used to reject. """
+	checks = check_repo(repo, workers, cache)
+	if repo in rejecting_repos:
+		reject(repo, [check for check in checks
+			      if check.cached and check.failed()])
+
+	passed, failed = [], []
+	for check in checks:
+		if check.cached:
+			continue
+		elif check.error != None:
+			print >> log, "%s could not be checked: %s" % (check.srpm,
+								       check.error)
+		elif check.failed():
+			print >> log, "%s (%s) failed spec file checking" % (
+				check.srpm, check.spec_name)
+			failed.append(check)
 		else:
-			p.write("\n\nFailed spec files\n")
-		p.write(string.join(rejectedspecs, "\n"))
-		p.write("\n\nReason(s) for failure\n")
-		index = 0
-		for i in rejectedspecs:
-			p.write("%s:\n" %i)
-			if no_files[index]: 
-				p.write("missing files section\n")
-			if no_defattr[index]:
-				p.write("missing file attributes\n")
-			if no_doc[index]:
-				p.write("missing doc entry\n")
-			if no_changelog[index]: 
-				p.write("missing changelog\n")
-			p.write("\n")
-			index = index + 1
-		sts = p.close()
-		if sts != 0:
-			print >> flog, "Sendmail exit status", sts
-
-	os.chdir("/rpm/CHECK_PEND.%s" %repo)
-	os.system("rm -rf tmp/")
+			print >> log, "%s (%s) passed spec file checking" % (
+				check.srpm, check.spec_name)
+			passed.append(check)
+
+	if failed and repo in rejecting_repos:
+		reject(repo, failed)
+	if failed:
+		send_mail(report_text(repo, passed, failed), log)
+
+def usage(argv):
+	print "%s [-f] [-j N] [repo...]" % argv[0]
+	print "Check the SPEC files of pending source rpms, default repos %s" % (
+		' '.join(repos))
+	print "-j N : check up to N source rpms at once"
+	print "-f : forget saved results and check every source rpm again"
+	print "-h : print this message"
+
+def main(argv):
+	workers = 1
+	recheck = 0
+	try:
+		opts, args = getopt.getopt(argv[1:], 'hj:f')
+		for opt, val in opts:
+			if opt == '-h':
+				usage(argv)
+				return 1
+			elif opt == '-j':
+				workers = int(val)
+			elif opt == '-f':
+				recheck = 1
+	except (getopt.GetoptError, ValueError):
+		usage(argv)
+		return 1
+
+	cache = ResultCache(cache_file())
+	if recheck:
+		cache.clear()
+	log = open(LOGFILE, 'a')
+	try:
+		for repo in args or repos:
+			process_repo(repo, log, workers, cache)
+	finally:
+		log.close()
+	cache.save()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
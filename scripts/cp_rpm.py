@@ -18,6 +18,8 @@ bitness means either '64' or ''
 
 import shutil
 import sys
+
+import repo_catalog
 import rpm_config
 
 def concat_rpm(pkg, vers, bitness):
@@ -66,7 +68,11 @@ def main(argv):
                 try:
                     from_name = make_from(pkg, from_dist, vers, bitness)
                     to_name = make_to(pkg, to_dist, vers, bitness)
-                    shutil.copy(from_name, to_name)
+                    update = repo_catalog.start_update([to_name])
+                    try:
+                        shutil.copy(from_name, to_name)
+                    finally:
+                        update.finish()
                 except IOError, e:
                     err_occured = 1
                     print >> sys.stderr, e
@@ -2,17 +2,31 @@
 
 """ Use "apt-cache unmet" to find dependency problems.
 
+Unless config_dict["RESOLVER"] is "apt", the in-process dep_resolver is
+used in place of apt-get update and apt-cache unmet.  Its results have
+the same format.
+
+apt runs in a workspace of its own for each dist, under TEMPDIR, so
+dists can be checked at the same time.
+
 Note, init must be called before any of this will work.
 """
 
-import commands
+import cPickle
+import hashlib
 import os
+import subprocess
 import sys
+import threading
 
+import dep_resolver
+import fileops
 import rpm_config
+import run_metrics
 
 config_dict = {"TEMPDIR":"/var/local/dep_problems",
-               "RPM_ROOT":"/var/local/lib/vpkgs_only"}
+               "RPM_ROOT":"/var/local/lib/vpkgs_only",
+               "RESOLVER":"internal"}
 apt_conf_template = """
 Dir
 {
@@ -50,13 +64,13 @@ RPM
    Options "-vv";
 }
 """
-apt_conf_contents = apt_conf_template % config_dict
 
 def run_system_cmd(cmd, verbose = 1, critical=1, silence = 0, fake_it=0):
     if silence: cmd = cmd + ' 2>/dev/null >/dev/null'
     if verbose: print cmd
     if fake_it: return 0
 
+    run_metrics.count("forks")
     ret_val = os.system(cmd)
     if ret_val > 0 and critical:
         import traceback
@@ -71,21 +85,65 @@ def write_file(filename, data):
     fp.write(data)
     fp.close()
     
-def init():
-    run_system_cmd("rm -rf %(TEMPDIR)s" % config_dict)
-    run_system_cmd("mkdir -p %(TEMPDIR)s" % config_dict)
-
-    write_file("%(TEMPDIR)s/apt.conf" % config_dict, apt_conf_contents)
+class Workspace:
+    """ A directory holding apt's configuration, sources.list, lists and
+    cache.  Each dist gets its own, so apt runs for different dists can
+    happen at the same time without stepping on each other's files. """
+    def __init__(self, tempdir):
+        self.tempdir = tempdir
+        self.initialized = 0
+
+    def params(self):
+        """ @return config_dict with TEMPDIR pointing at this workspace """
+        params = config_dict.copy()
+        params["TEMPDIR"] = self.tempdir
+        return params
+
+    def init(self):
+        """ Empty the workspace and set up apt's files in it """
+        tempdir = self.tempdir
+        fileops.remove_tree(tempdir)
+        fileops.make_dirs(tempdir)
+
+        write_file("%s/apt.conf" % tempdir, apt_conf_template % self.params())
+        write_file("%s/vendors.list" % tempdir, "")
+        os.chmod("%s/vendors.list" % tempdir, 0644)
+        os.symlink("/usr/local/etc/apt/rpmpriorities",
+                   "%s/rpmpriorities" % tempdir)
+        for subdir in ("cache/archives/partial", "lists/partial",
+                       "state/lists/partial"):
+            fileops.make_dirs("%s/%s" % (tempdir, subdir))
+        self.initialized = 1
+
+    def apt_args(self):
+        return "-c %(TEMPDIR)s/apt.conf -o Dir::etc=%(TEMPDIR)s " \
+               "-o RPM::RootDir=%(RPM_ROOT)s" % self.params()
+
+_workspaces = {}
+_workspaces_lock = threading.Lock()
+
+def workspace(dist, vers, bitness):
+    """ @return initialized Workspace for a dist, in a subdirectory of
+    TEMPDIR named after it """
+    key = (dist, vers, bitness)
+    _workspaces_lock.acquire()
+    try:
+        if not key in _workspaces:
+            _workspaces[key] = Workspace("%s/%s.%s.%s" % (
+                config_dict["TEMPDIR"], dist, vers, bitness))
+        ws = _workspaces[key]
+    finally:
+        _workspaces_lock.release()
+
+    if not ws.initialized:
+        ws.init()
+    return ws
 
-    cmds = ("""
-    touch %(TEMPDIR)s/vendors.list; chmod 644 %(TEMPDIR)s/vendors.list      
-    ln -s /usr/local/etc/apt/rpmpriorities %(TEMPDIR)s/rpmpriorities
-    mkdir -p %(TEMPDIR)s/cache/archives/partial
-    mkdir -p %(TEMPDIR)s/lists/partial
-    mkdir -p %(TEMPDIR)s/state/lists/partial
-    """ % config_dict).split('\n')
-
-    map(run_system_cmd, cmds)
+def init():
+    """ Empty TEMPDIR, dropping every dist's workspace, and set up the
+    default workspace in TEMPDIR itself """
+    _workspaces.clear()
+    Workspace(config_dict["TEMPDIR"]).init()
 
 NO_NEW, PKG_TRADED_UNMET, PKG_NEW_UNMET, TRADED_PKG, NEW_PKG = range(5)
 
@@ -157,51 +215,147 @@ def unmet_compare(cur, new):
 
     return (NO_NEW, 'No new dependency problems')
 
-def unmet(dist, vers, bitness, src_list_contents = None):
-    """ Find unmet dependencies of given vers, bitness, and dist """
+@run_metrics.timed("unmet")
+def unmet(dist, vers, bitness, src_list_contents = None, main_dir = None,
+          workers = 1):
+    """ Find unmet dependencies of given vers, bitness, and dist
+
+    @param src_list_contents optional sources.list for apt to use in
+    place of the dist's repository
+    @param main_dir optional RPMS.main directory for the in-process
+    resolver to use in place of the dist's, should hold the same
+    packages as src_list_contents
+    @param workers number of headers the in-process resolver reads at
+    once
+    """
+    if config_dict["RESOLVER"] != "apt":
+        if main_dir == None:
+            main_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
+        return dep_resolver.unmet(main_dir, config_dict["RPM_ROOT"],
+                                  workers)
 
     if src_list_contents == None:
         src_list_contents = "rpm file:%s/solaris%s-sparc%s %s main\n" % (
             rpm_config.repository_dir, vers, bitness, dist)
-    
-    write_file("%(TEMPDIR)s/sources.list" % config_dict, src_list_contents)
-    
-    apt_args = "-c %(TEMPDIR)s/apt.conf -o Dir::etc=%(TEMPDIR)s -o RPM::RootDir=%(RPM_ROOT)s" % config_dict
-    run_system_cmd("apt-get %s update" % apt_args)
 
-    probs = commands.getoutput("apt-cache %s unmet" % apt_args).split('\n')    
-    probs = parse_unmet(probs)
+    ws = workspace(dist, vers, bitness)
+    write_file("%s/sources.list" % ws.tempdir, src_list_contents)
 
-    return probs
+    apt_args = ws.apt_args()
+    run_system_cmd("apt-get %s update" % apt_args)
 
-def parse_unmet(unmet_lines):
+    return parse_unmet(unmet_output("apt-cache %s unmet" % apt_args))
+
+def repository_fingerprint(main_dir):
+    """ @return digest of the names, sizes and mtimes of the files in
+    main_dir, which changes whenever a package is added, removed or
+    replaced """
+    digest = hashlib.md5()
+    names = os.listdir(main_dir)
+    names.sort()
+    for name in names:
+        st = os.stat('%s/%s' % (main_dir, name))
+        digest.update('%s %d %d\n' % (name, st.st_size, int(st.st_mtime)))
+    return digest.hexdigest()
+
+def baseline_file(dist, vers, bitness):
+    return '%s/baseline-unmet.%s.%s.%s' % (rpm_config.cache_dir, dist,
+                                           vers, bitness)
+
+def baseline_unmet(dist, vers, bitness, workers=1):
+    """ Like unmet for the live repository of dist, but reuses the result
+    saved by the last call or save_baseline if the repository hasn't
+    changed since """
+    main_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
+    fingerprint = (config_dict["RESOLVER"], repository_fingerprint(main_dir))
+    try:
+        fp = open(baseline_file(dist, vers, bitness), 'rb')
+        try:
+            saved_fingerprint, saved_unmet = cPickle.load(fp)
+        finally:
+            fp.close()
+        if saved_fingerprint == fingerprint:
+            print "Reusing unmet dependencies of unchanged", main_dir
+            return saved_unmet
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        pass
+
+    cur_unmet = unmet(dist, vers, bitness, workers=workers)
+    save_baseline(dist, vers, bitness, cur_unmet, fingerprint)
+    return cur_unmet
+
+def save_baseline(dist, vers, bitness, unmet_result, fingerprint=None):
+    """ Remember unmet_result as the unmet dependencies of the live
+    repository of dist as it is now, eg after a publish is accepted """
+    if fingerprint == None:
+        main_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
+        fingerprint = (config_dict["RESOLVER"],
+                       repository_fingerprint(main_dir))
+    filename = baseline_file(dist, vers, bitness)
+    try:
+        if not os.path.isdir(rpm_config.cache_dir):
+            os.makedirs(rpm_config.cache_dir)
+        fp = open(filename + '.new', 'wb')
+        cPickle.dump((fingerprint, unmet_result), fp, 2)
+        fp.close()
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning, can't save baseline:", e
+
+def unmet_output(cmd):
+    """ @return generator of the lines cmd writes to stdout, yielded as
+    cmd writes them rather than once it has finished """
+    run_metrics.count("forks")
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                            bufsize=65536)
+    try:
+        # iterating over the file itself would read ahead in big chunks
+        for line in iter(proc.stdout.readline, ''):
+            yield line
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+def parse_unmet(unmet_lines, counts=None):
     """ Parse the output of apt-cache dump
 
-    @param unmet_lines new-line delimited list of strings
+    Lines that are neither a Package line nor a dependency are skipped
+    with a warning.  Package names and dependency strings are interned,
+    as the same few dependencies show up again and again.
+
+    @param unmet_lines new-line delimited list or iterator of strings
+    @param counts optional dict, its 'packages' and 'skipped' entries get
+    the number of packages with unmet dependencies and of lines skipped
     @return dict keyed by package name yielding list of strings or tuples
     """
     unmet = {}
     cur_pkg = None
     cur_unmet_list = []
+    skipped = 0
     
     for line in unmet_lines:
         splitline = line.split()
         if len(splitline) < 1: continue
-        start_word = splitline[0].strip()
+        start_word = splitline[0]
 
-        if start_word == 'Package':
-            if cur_pkg != None:
-                assert len(cur_unmet_list) > 0, "something should be unmet"
+        if start_word == 'Package' and len(splitline) >= 4:
+            if cur_pkg != None and cur_unmet_list:
                 unmet[cur_pkg] = cur_unmet_list
-                cur_unmet_list = []
-            cur_pkg = "%s-%s" % (splitline[1], splitline[3])
-        elif start_word == 'Depends:' or start_word == 'PreDepends:':
-            cur_unmet_list.append(' '.join(splitline[1:]))
+            cur_unmet_list = []
+            cur_pkg = intern("%s-%s" % (splitline[1], splitline[3]))
+        elif (start_word == 'Depends:' or start_word == 'PreDepends:') \
+             and cur_pkg != None:
+            cur_unmet_list.append(intern(' '.join(splitline[1:])))
         else:
-            raise ValueError, "Unparsed line: %s" % line
+            skipped = skipped + 1
 
-    if cur_pkg != None:
+    if cur_pkg != None and cur_unmet_list:
         unmet[cur_pkg] = cur_unmet_list
 
-    return unmet            
-
+    if skipped:
+        print >> sys.stderr, "Warning, skipped %d unparsed lines of " \
+              "apt-cache unmet output" % skipped
+    if counts != None:
+        counts['packages'] = len(unmet)
+        counts['skipped'] = skipped
+    return unmet
@@ -0,0 +1,193 @@
+""" Find unmet dependencies in a repository without apt.
+
+Builds an index of everything the packages in a repository provide
+(package names, virtual provides, versioned capabilities and files)
+from their headers, then checks every package's requires against it.
+The result has the same format as dep_problems.parse_unmet, so it can
+be fed straight to dep_problems.unmet_compare.
+
+Capabilities of the packages installed in dep_problems' RPM_ROOT (the
+virtual packages standing in for Solaris itself) are provided too, as
+they are when apt-cache unmet is run.
+"""
+
+import commands
+import os
+import sys
+import threading
+
+import rpm_cache
+import rpm_header
+import rpm_util
+import rpm_vercmp
+import run_metrics
+
+LESS = rpm_header.RPMSENSE_LESS
+GREATER = rpm_header.RPMSENSE_GREATER
+EQUAL = rpm_header.RPMSENSE_EQUAL
+
+def op_flags(op):
+    """ @return RPMSENSE flags for an operator string like '>=' """
+    flags = 0
+    if '<' in op: flags = flags | LESS
+    if '>' in op: flags = flags | GREATER
+    if '=' in op: flags = flags | EQUAL
+    return flags
+
+def ranges_overlap(provide_op, provide_evr, require_op, require_evr):
+    """ @return non-zero if a provide with the given operator and
+    (epoch, version, release) satisfies a require, using rpm's rules.
+    An unversioned provide or require always overlaps. """
+    provide_flags = op_flags(provide_op)
+    require_flags = op_flags(require_op)
+    if not provide_flags or not require_flags:
+        return 1
+
+    sense = rpm_vercmp.evrcmp(provide_evr, require_evr)
+    if sense < 0:
+        return (provide_flags & GREATER) or (require_flags & LESS)
+    elif sense > 0:
+        return (provide_flags & LESS) or (require_flags & GREATER)
+    return ((provide_flags & EQUAL) and (require_flags & EQUAL)) or \
+           ((provide_flags & LESS) and (require_flags & LESS)) or \
+           ((provide_flags & GREATER) and (require_flags & GREATER))
+
+def dep_string(dep):
+    """ @return dependency as apt-cache unmet prints it, eg 'foo (>= 1.2)' """
+    name, op, version = dep
+    if op:
+        return "%s (%s %s)" % (name, op, version)
+    return name
+
+class ProvidesIndex:
+    """ Everything provided by a set of packages """
+    def __init__(self):
+        # capability name -> list of (operator, (epoch, version, release))
+        self._caps = {}
+        self._files = {}
+
+    def add_capability(self, name, op='', version=''):
+        if version:
+            evr = rpm_vercmp.parse_evr(version)
+        else:
+            evr = None
+        self._caps.setdefault(name, []).append((op, evr))
+
+    def add_file(self, path):
+        self._files[path] = 1
+
+    def add_header(self, header):
+        """ Add everything the package with header provides """
+        evr = header.version() + '-' + header.release()
+        if header.epoch() != None:
+            evr = '%d:%s' % (header.epoch(), evr)
+        self.add_capability(header.name(), '=', evr)
+        for name, op, version in header.provides():
+            self.add_capability(name, op, version)
+        for path in header.files():
+            self.add_file(path)
+
+    def satisfies(self, dep):
+        """ @return non-zero if dep, a (name, operator, version) tuple, is
+        provided by something in the index """
+        name, op, version = dep
+        if name.startswith('/') and name in self._files:
+            return 1
+        if not name in self._caps:
+            return 0
+        if not op:
+            return 1
+
+        require_evr = rpm_vercmp.parse_evr(version)
+        for provide_op, provide_evr in self._caps[name]:
+            if provide_evr == None:
+                return 1
+            if ranges_overlap(provide_op, provide_evr, op, require_evr):
+                return 1
+        return 0
+
+_system_indexes = {}
+_system_lock = threading.Lock()
+
+def system_provides(rpm_root):
+    """ @return ProvidesIndex of the packages installed under rpm_root,
+    queried from rpm once per run """
+    _system_lock.acquire()
+    try:
+        if not rpm_root in _system_indexes:
+            _system_indexes[rpm_root] = _query_system(rpm_root)
+        return _system_indexes[rpm_root]
+    finally:
+        _system_lock.release()
+
+def _query_system(rpm_root):
+    system_index = ProvidesIndex()
+    if rpm_root == None:
+        return system_index
+
+    query_format = "[%{PROVIDENAME} %{PROVIDEFLAGS:depflags} " \
+                   "%{PROVIDEVERSION}\\n][%{FILENAMES}\\n]"
+    query = "rpm --root %s -qa --queryformat '%s'" % (rpm_root, query_format)
+    run_metrics.count("forks")
+    status, output = commands.getstatusoutput(query)
+    if status != 0:
+        print >> sys.stderr, "Warning, can't query rpm in %s: %s" % (
+            rpm_root, output)
+        return system_index
+
+    for line in output.split('\n'):
+        fields = line.split()
+        if len(fields) == 1:
+            if fields[0].startswith('/'):
+                system_index.add_file(fields[0])
+            else:
+                system_index.add_capability(fields[0])
+        elif len(fields) == 3:
+            system_index.add_capability(*fields)
+    return system_index
+
+def read_repository(main_dir, workers=1):
+    """ @return list of rpm_header.RpmHeader for the rpms in main_dir,
+    in filename order """
+    filenames = [fn for fn in os.listdir(main_dir) if fn.endswith('.rpm')]
+    filenames.sort()
+
+    def read_one(fn):
+        try:
+            return rpm_cache.get_header('%s/%s' % (main_dir, fn))
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Warning, can't read header:", e
+            return None
+
+    headers = rpm_util.parallel_map(read_one, filenames, workers)
+    return [h for h in headers if h != None]
+
+@run_metrics.timed("dep_resolver")
+def unmet(main_dir, rpm_root=None, workers=1):
+    """ Find unmet dependencies of the packages in main_dir
+
+    @param rpm_root optional root of an rpm database whose installed
+    packages also provide capabilities
+    @return dict keyed by package name-version-release yielding list of
+    unmet dependency strings, like dep_problems.parse_unmet
+    """
+    headers = read_repository(main_dir, workers)
+    system = system_provides(rpm_root)
+
+    index = ProvidesIndex()
+    for header in headers:
+        index.add_header(header)
+
+    problems = {}
+    for header in headers:
+        unmet_deps = []
+        for dep in header.requires():
+            # rpmlib() is checked by pending_scan, as apt does not see it
+            if dep[0].startswith('rpmlib('): continue
+            if index.satisfies(dep) or system.satisfies(dep): continue
+            unmet_deps.append(dep_string(dep))
+        if unmet_deps:
+            pkg = "%s-%s-%s" % (header.name(), header.version(),
+                                header.release())
+            problems[pkg] = unmet_deps
+    return problems
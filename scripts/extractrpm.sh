@@ -1 +0,0 @@
-rpm2cpio $1 | cpio -dimv
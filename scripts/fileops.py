@@ -0,0 +1,163 @@
+""" In-process file operations for the publish scripts.
+
+Moving a file used to mean forking a shell to run mv, once per file.
+MoveBatch collects a batch of moves and does them with os.rename, which
+is all mv does when the source and destination are on the same
+filesystem.  When they aren't, the file is streamed into a temporary
+file next to its destination, renamed into place and then unlinked from
+where it was.  Every directory touched by the batch is fsynced once, at
+the end, rather than once per file.
+
+link_file hard links instead of copying, again falling back to a
+streaming copy across filesystems.  Python 2 has no copy_file_range or
+sendfile, so copyfileobj with a large buffer is the fallback.
+
+remove_tree and make_dirs replace forks of rm -rf and mkdir -p.
+"""
+
+import errno
+import os
+import shutil
+
+import run_metrics
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def fsync_dir(path):
+    """ Flush the directory entries of path to disk, where the
+    filesystem supports it """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass # eg, not supported for directories here
+    finally:
+        os.close(fd)
+
+def copy_file(src, dest):
+    """ Copy src to dest through a temporary file in dest's directory,
+    keeping src's mode and times like mv does, then rename it into
+    place.  dest is never seen half written. """
+    tmp_dest = '%s.part.%d' % (dest, os.getpid())
+    fsrc = open(src, 'rb')
+    try:
+        fdest = open(tmp_dest, 'wb')
+        try:
+            shutil.copyfileobj(fsrc, fdest, COPY_BUFFER_SIZE)
+            fdest.flush()
+            os.fsync(fdest.fileno())
+        finally:
+            fdest.close()
+    except:
+        fsrc.close()
+        if os.path.exists(tmp_dest): os.remove(tmp_dest)
+        raise
+    fsrc.close()
+    shutil.copystat(src, tmp_dest)
+    os.rename(tmp_dest, dest)
+    run_metrics.count("bytes_copied", os.path.getsize(dest))
+
+def move_file(src, dest):
+    """ Move src to dest, renaming if they share a filesystem and
+    copying then unlinking otherwise
+
+    @return non-zero if the data had to be copied
+    """
+    try:
+        os.rename(src, dest)
+        run_metrics.count("files_renamed")
+        return 0
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+    copy_file(src, dest)
+    os.remove(src)
+    return 1
+
+def link_file(src, dest):
+    """ Hard link src to dest, copying it if they are on different
+    filesystems
+
+    @return non-zero if the data had to be copied
+    """
+    try:
+        os.link(src, dest)
+        run_metrics.count("files_linked")
+        return 0
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+    copy_file(src, dest)
+    return 1
+
+class MoveBatch:
+    """ A batch of moves, done all at once by run() """
+    def __init__(self, fake_it=0, verbose=1):
+        """ @param fake_it if non-zero, run() only prints the moves
+        @param verbose if non-zero, print each move like the mv command
+        it replaces """
+        self.fake_it = fake_it
+        self.verbose = verbose
+        self.moves = []
+        self.copied = 0
+        self._dir_cache = {}
+
+    def _is_dir(self, path):
+        if not path in self._dir_cache:
+            self._dir_cache[path] = os.path.isdir(path)
+        return self._dir_cache[path]
+
+    def move(self, src, dest):
+        """ Plan to move src to dest.  Like mv, a dest that is a directory
+        means the file keeps its name inside it. """
+        if self._is_dir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        self.moves.append((src, dest))
+
+    def __len__(self):
+        return len(self.moves)
+
+    def run(self):
+        """ Do every planned move, then fsync the directories involved.
+        A move that fails stops the batch, raising OSError or IOError;
+        the ones before it stay done. """
+        moves = self.moves
+        self.moves = []
+        dirs = {}
+        try:
+            for src, dest in moves:
+                if self.verbose: print 'mv %s %s' % (src, dest)
+                if self.fake_it: continue
+                self.copied = self.copied + move_file(src, dest)
+                dirs[os.path.dirname(src) or '.'] = 1
+                dirs[os.path.dirname(dest) or '.'] = 1
+        finally:
+            for path in dirs:
+                fsync_dir(path)
+
+def move_files(moves, fake_it=0, verbose=1):
+    """ Move each (src, dest) in moves as a single MoveBatch """
+    batch = MoveBatch(fake_it, verbose)
+    for src, dest in moves:
+        batch.move(src, dest)
+    batch.run()
+
+def remove_tree(path, fake_it=0, verbose=1):
+    """ Remove path and everything under it, if it exists, like rm -rf """
+    if verbose: print 'rm -rf %s' % path
+    if fake_it: return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def make_dirs(path, mode=0755, fake_it=0, verbose=1):
+    """ Create path and any missing parents, like mkdir -p """
+    if verbose: print 'mkdir -p %s' % path
+    if fake_it: return
+    try:
+        os.makedirs(path, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path): raise
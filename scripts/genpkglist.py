@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+""" Incremental replacement for genbasedir.
+
+genbasedir reads the header of every RPM in a dist on every run.  This
+keeps the per-package entries of the previous base/pkglist.COMP, along
+with a side index of the file identity (size, mtime, inode) each entry
+was made from, and only reads headers of packages that were added or
+replaced.  Entries of packages that are gone are dropped.  Like
+gensrclist, each srclist entry lists the names of the binary packages
+built from it, taken from the pkglist, so apt can find a source package
+by binary name; a source entry is remade when those change.
+
+The pkglist and srclist (plain and bzip2ed) and the release files are
+each written to a temporary file and renamed into place, so apt never
+sees a half written list.
+"""
+
+import bz2
+import cPickle
+import hashlib
+import os
+import sys
+import time
+
+import rpm_header
+import run_metrics
+
+CRPMTAG_FILENAME = 1000000
+CRPMTAG_FILESIZE = 1000001
+CRPMTAG_MD5 = 1000005
+CRPMTAG_DIRECTORY = 1000010
+CRPMTAG_BINARY = 1000011
+
+def file_md5(path):
+    """ @return hex md5 digest of the file at path """
+    digest = hashlib.md5()
+    fp = open(path, 'rb')
+    try:
+        while 1:
+            data = fp.read(1024 * 1024)
+            if not data: break
+            digest.update(data)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+def file_identity(st):
+    return (st.st_size, int(st.st_mtime), st.st_ino)
+
+def write_atomic(path, data):
+    """ Write data to path through a temporary file and a rename """
+    tmp_path = '%s.new.%d' % (path, os.getpid())
+    fp = open(tmp_path, 'wb')
+    try:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+    os.rename(tmp_path, path)
+
+def load_list(base_dir, list_name):
+    """ @return dict keyed by rpm filename yielding (file identity, raw
+    header entry) from base_dir/list_name, or an empty dict if it or its
+    side index is missing or unreadable """
+    try:
+        fp = open('%s/%s.idx' % (base_dir, list_name), 'rb')
+        try:
+            identities = cPickle.load(fp)
+        finally:
+            fp.close()
+        fp = open('%s/%s' % (base_dir, list_name), 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        blobs = rpm_header.split_blobs(data)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError,
+            rpm_header.RpmHeaderError):
+        return {}
+
+    entries = {}
+    for blob in blobs:
+        filename = rpm_header.decode_blob(blob, (CRPMTAG_FILENAME,)).get(
+            CRPMTAG_FILENAME)
+        if filename in identities:
+            entries[filename] = (identities[filename], blob)
+    return entries
+
+def binary_names(pkglist_data):
+    """ @return dict keyed by source rpm filename yielding the sorted
+    names of the packages in pkglist_data built from it """
+    names = {}
+    for blob in rpm_header.split_blobs(pkglist_data):
+        tags = rpm_header.decode_blob(blob, (rpm_header.NAME,
+                                             rpm_header.SOURCERPM))
+        sourcerpm = tags.get(rpm_header.SOURCERPM)
+        if sourcerpm and tags.get(rpm_header.NAME):
+            names.setdefault(sourcerpm, {})[tags[rpm_header.NAME]] = 1
+    for sourcerpm in names.keys():
+        binaries = names[sourcerpm].keys()
+        binaries.sort()
+        names[sourcerpm] = binaries
+    return names
+
+def make_entry(rpm_dir, directory_name, filename, st, binaries=None):
+    """ @return raw list entry for an rpm: its main header plus the tags
+    apt uses to find and verify the file
+
+    @param binaries optional list of the names of the packages built
+    from a source rpm
+    """
+    path = '%s/%s' % (rpm_dir, filename)
+    header = rpm_header.read_header(path, tags=(), sigtags=(), keep_blob=1)
+    entries = [(CRPMTAG_FILENAME, rpm_header.STRING, filename),
+               (CRPMTAG_FILESIZE, rpm_header.INT32, [st.st_size]),
+               (CRPMTAG_MD5, rpm_header.STRING, file_md5(path)),
+               (CRPMTAG_DIRECTORY, rpm_header.STRING, directory_name)]
+    if binaries:
+        entries.append((CRPMTAG_BINARY, rpm_header.STRING_ARRAY, binaries))
+    return rpm_header.append_entries(header.blob, entries)
+
+def build_list(rpm_dir, directory_name, previous, binaries=None):
+    """ @param previous dict as returned by load_list
+    @param binaries for a srclist, dict as returned by binary_names
+    @return tuple of (list data, dict of filename to identity, number of
+    headers read)
+    """
+    if binaries == None: binaries = {}
+    try:
+        filenames = [fn for fn in os.listdir(rpm_dir) if fn.endswith('.rpm')]
+    except OSError:
+        filenames = []
+    filenames.sort()
+
+    blobs = []
+    identities = {}
+    headers_read = 0
+    for filename in filenames:
+        st = os.stat('%s/%s' % (rpm_dir, filename))
+        identity = file_identity(st)
+        built = binaries.get(filename)
+        if filename in previous and previous[filename][0] == identity and \
+               rpm_header.decode_blob(previous[filename][1], (
+                   CRPMTAG_BINARY,)).get(CRPMTAG_BINARY) == built:
+            blob = previous[filename][1]
+        else:
+            try:
+                blob = make_entry(rpm_dir, directory_name, filename, st,
+                                  built)
+            except (IOError, OSError), e:
+                print >> sys.stderr, "Warning, skipping %s: %s" % (filename, e)
+                continue
+            headers_read = headers_read + 1
+        blobs.append(blob)
+        identities[filename] = identity
+
+    return ''.join(blobs), identities, headers_read
+
+def release_text(dist_dir, component, checksums):
+    """ @return contents of base/release.COMP and base/release """
+    archive = os.path.basename(dist_dir)
+    now = time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+    comp_release = "Archive: %s\nComponent: %s\nVersion: %s\n" \
+                   "Origin: Rutgers\nLabel: %s\nArchitecture: sparc\n" \
+                   "NotAutomatic: false\n" % (archive, component,
+                                              time.strftime('%Y%m%d'),
+                                              archive)
+    release_lines = ["Origin: Rutgers", "Label: %s" % archive,
+                     "Suite: %s" % archive, "Codename: %s" % archive,
+                     "Date: %s" % now, "Architectures: sparc",
+                     "Components: %s" % component,
+                     "Description: %s" % archive, "MD5Sum:"]
+    comp_release_path = 'base/release.%s' % component
+    checksums = checksums + [(comp_release_path, comp_release)]
+    for path, data in checksums:
+        release_lines.append(" %s %d %s" % (hashlib.md5(data).hexdigest(),
+                                            len(data), path))
+    return comp_release, '\n'.join(release_lines) + '\n'
+
+@run_metrics.timed("update_basedir")
+def update_basedir(dist_dir, component='main', seed_dir=None, fake_it=0,
+                   verbose=1):
+    """ Bring dist_dir/base up to date with dist_dir/RPMS.component and
+    dist_dir/SRPMS.component
+
+    @param seed_dir optional dist directory whose base/ to reuse entries
+    from when dist_dir has none yet, eg the live dist for a pseudo
+    publish made of hard links to it
+    @param fake_it if non-zero, only say what would be done
+    @return number of headers that had to be read
+    """
+    base_dir = '%s/base' % dist_dir
+    if verbose:
+        print "update_basedir %s %s" % (dist_dir, component)
+    if fake_it: return 0
+
+    if not os.path.isdir(base_dir):
+        os.makedirs(base_dir)
+
+    headers_read = 0
+    checksums = []
+    binaries = None
+    for kind, directory_name in (('pkglist', 'RPMS.%s' % component),
+                                 ('srclist', 'SRPMS.%s' % component)):
+        list_name = '%s.%s' % (kind, component)
+        previous = load_list(base_dir, list_name)
+        if not previous and seed_dir != None:
+            previous = load_list('%s/base' % seed_dir, list_name)
+
+        data, identities, count = build_list(
+            '%s/%s' % (dist_dir, directory_name), directory_name, previous,
+            binaries)
+        if kind == 'pkglist':
+            binaries = binary_names(data)
+        headers_read = headers_read + count
+        compressed = bz2.compress(data)
+
+        write_atomic('%s/%s' % (base_dir, list_name), data)
+        write_atomic('%s/%s.bz2' % (base_dir, list_name), compressed)
+        write_atomic('%s/%s.idx' % (base_dir, list_name),
+                     cPickle.dumps(identities, 2))
+        checksums.append(('base/%s' % list_name, data))
+        checksums.append(('base/%s.bz2' % list_name, compressed))
+
+    comp_release, release = release_text(dist_dir, component, checksums)
+    write_atomic('%s/release.%s' % (base_dir, component), comp_release)
+    write_atomic('%s/release' % base_dir, release)
+
+    run_metrics.count("pkglist_headers_read", headers_read)
+    if verbose:
+        print "read %d headers" % headers_read
+    return headers_read
+
+def main(argv):
+    if len(argv) < 2:
+        print "%s: dist_dir [component]" % argv[0]
+        return 1
+    component = 'main'
+    if len(argv) > 2: component = argv[2]
+    update_basedir(argv[1], component)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
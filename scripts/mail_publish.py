@@ -1,10 +1,16 @@
 
-""" Mail publish logs """
+""" Mail publish logs
+
+The mail is queued in mail_spool and sent by its background sender, so
+publish doesn't wait on the mail relay.
+"""
 
 import pickle
 
+import mail_spool
 import rpm_config
 import rpm_util
+import run_metrics
 
 def make_bit_ver(bit, ver):
     """ Used to 'Fill in' bit, if it's '', make it '32' """
@@ -13,17 +19,17 @@ def make_bit_ver(bit, ver):
 
 def rpm_ver_str(rpmname):
     """ Get human readable package version-patchlevel string from rpmname """
-    parsed = rpm_util.parse_rpmname(rpmname) 
-    return '.'.join(parsed[1]) + '-' + parsed[2]
+    return rpm_util.parse(rpmname).ver_str()
 
 def split_into_ver_bit_name_pending_existing(pending, existing):
     """ Assumes pending and existing are packages with the same name,
     in the same solaris version, with the same bitness 
     Returns tuple of
     """
-    sol_ver, bitness = rpm_util.sol_ver_and_bit(pending)
+    record = rpm_util.parse(pending)
+    sol_ver, bitness = record.ver_bit()
     if bitness == '': bitness = '32'
-    pkg_name = rpm_util.extract_rpmname(pending)
+    pkg_name = record.name
     pending_vers = rpm_ver_str(pending)
     existing_vers = rpm_ver_str(existing)
     return (sol_ver, bitness, pkg_name, pending_vers, existing_vers)
@@ -180,8 +186,8 @@ def make_subject(pub_result):
     not too long """
     seen_pkgs = {}
     for scan in pub_result.pending_results():
-        for pkg_name in scan.all_rpms():
-            seen_pkgs[rpm_util.parse_rpmname(pkg_name)[0]] = 1
+        for record in scan.all_records():
+            seen_pkgs[record.name] = 1
 
     compressed_pkgs = {} # try to compress breakout packages
     for k in seen_pkgs:
@@ -197,10 +203,13 @@ def create_publish_text(pub_result, publisher_emails):
 
 #   pickle.dump(pub_result, open("/servants/u1/jmkacz/pub_result.p", "w"))
 
-    msg_lines = ["From: RPM Publish Checker <root@samwise.rutgers.edu>\r\nTo:%s\r\nSubject: %s\r\n" %
-                 (', '.join(publisher_emails), make_subject(pub_result))]
+    return "From: %s\r\nTo:%s\r\nSubject: %s\r\n\n%s" % (
+        mail_spool.config_dict["FROM_HEADER"], ', '.join(publisher_emails),
+        make_subject(pub_result), create_publish_body(pub_result))
 
-    msg_lines.append(pending_outcome_summary(pub_result))
+def create_publish_body(pub_result):
+    """ @return the human readable output of publish, without headers """
+    msg_lines = [pending_outcome_summary(pub_result)]
     msg_lines.append('')
     
     for pending_report in pub_result.pending_results():
@@ -217,12 +226,11 @@ def create_publish_text(pub_result, publisher_emails):
     msg_lines.append('N - new, Space - empty, M - missing SRPM, A - accepted, O - old, D - missing rpmlib dpendency')
     return '\n'.join(msg_lines)
     
+@run_metrics.timed("mail_publish_results")
 def mail_publish_results(pub_result):
     """ Send mail summerizing what publish did to everyone who owns
     package involved in the publish
     @param pub_result PublishOutcome representing outcome of the publish"""
-    import smtplib
-
     publish_users = pub_result.get_publishers()
     if len(publish_users) == 0: return # no one to mail to
     
@@ -232,6 +240,6 @@ def mail_publish_results(pub_result):
     msg = create_publish_text(pub_result, publisher_emails)
     
     print msg
-    server = smtplib.SMTP('mx.nbcs.rutgers.edu.')
-    server.sendmail('oss@oss.rutgers.edu', publisher_emails, msg)
-    server.quit()
+    mail_spool.enqueue(publisher_emails, make_subject(pub_result),
+                       create_publish_body(pub_result))
+    mail_spool.start_sender()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+""" Spool of outgoing mail and the sender that delivers it.
+
+Mail is queued one file per recipient under rpm_config.mail_spool_dir,
+which takes no time and never touches the network, so a slow or
+unreachable relay can't hold up a publish.  The sender delivers the
+queue over a single SMTP session.  Everything queued for a recipient
+within DIGEST_SECONDS of the oldest message waiting for them goes out
+as one digest.  If the relay can't be reached, or refuses a message
+for the moment, the messages are tried again later, waiting twice as
+long each time up to MAX_RETRY_SECONDS.  Mail still undelivered after
+GIVE_UP_SECONDS, or refused outright, is moved to the failed directory
+of the spool.
+
+start_sender() runs the sender in the background, detached from the
+caller.  It keeps running until the queue is empty, and only one sender
+runs at a time.  Pointing SMTP_HOST and SMTP_PORT at a local stand-in,
+eg "python -m smtpd -n -c DebuggingServer localhost:8025", shows what
+would be sent.
+"""
+
+import cPickle
+import fcntl
+import getopt
+import os
+import smtplib
+import socket
+import subprocess
+import sys
+import time
+from email.Utils import formatdate
+
+import rpm_config
+
+config_dict = {"SMTP_HOST": "mx.nbcs.rutgers.edu.",
+               "SMTP_PORT": 25,
+               "SMTP_TIMEOUT": 60,
+               "FROM": "oss@oss.rutgers.edu",
+               "FROM_HEADER": "RPM Publish Checker <root@samwise.rutgers.edu>",
+               "DIGEST_SECONDS": 300,
+               "RETRY_SECONDS": 60,
+               "MAX_RETRY_SECONDS": 3600,
+               "GIVE_UP_SECONDS": 2 * 24 * 60 * 60}
+
+# Command for running the sender
+SENDER_COMMAND = [sys.executable, os.path.abspath(__file__)]
+
+_sequence = 0
+
+def queue_dir():
+    return '%s/queue' % rpm_config.mail_spool_dir
+
+def failed_dir():
+    return '%s/failed' % rpm_config.mail_spool_dir
+
+def _makedirs(path):
+    if not os.path.isdir(path): os.makedirs(path)
+
+class Message:
+    """ Mail for one recipient waiting in the spool """
+    def __init__(self, recipient, subject, body, queued=None):
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.queued = queued or time.time()
+        self.attempts = 0
+        self.next_try = self.queued
+        self.filename = None
+
+    def save(self):
+        """ Write the message to its file in the queue, atomically """
+        global _sequence
+        if self.filename == None:
+            _sequence = _sequence + 1
+            self.filename = '%s/%.6f.%d.%d' % (queue_dir(), self.queued,
+                                                os.getpid(), _sequence)
+        tmp_path = '%s.new' % self.filename
+        fp = open(tmp_path, 'wb')
+        try:
+            cPickle.dump(self.__dict__, fp, 2)
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.filename)
+
+def load(filename):
+    """ @return Message saved in filename, or None if it is unreadable """
+    try:
+        fp = open(filename, 'rb')
+        try:
+            state = cPickle.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        return None
+    message = Message(None, None, None)
+    message.__dict__.update(state)
+    message.filename = filename
+    return message
+
+def queued_messages():
+    """ @return list of Messages in the queue, oldest first """
+    try:
+        names = os.listdir(queue_dir())
+    except OSError:
+        return []
+    names.sort()
+    messages = []
+    for name in names:
+        if name.endswith('.new'): continue
+        message = load('%s/%s' % (queue_dir(), name))
+        if message != None:
+            messages.append(message)
+    return messages
+
+def enqueue(recipients, subject, body):
+    """ Queue mail with subject and body for each of recipients """
+    _makedirs(queue_dir())
+    now = time.time()
+    for recipient in recipients:
+        Message(recipient, subject, body, now).save()
+
+def message_text(recipient, messages):
+    """ @return mail for recipient with the headers, a digest if there
+    is more than one of messages """
+    if len(messages) == 1:
+        subject, body = messages[0].subject, messages[0].body
+    else:
+        subject = "Digest: %d publish results" % len(messages)
+        parts = []
+        for message in messages:
+            parts.append("%s\n%s\n%s" % (message.subject,
+                                         '=' * len(message.subject),
+                                         message.body))
+        body = ('\n\n%s\n\n' % ('-' * 70)).join(parts)
+    headers = ["From: %s" % config_dict["FROM_HEADER"],
+               "To: %s" % recipient,
+               "Subject: %s" % subject,
+               "Date: %s" % formatdate(localtime=1)]
+    return '\r\n'.join(headers) + '\r\n\r\n' + body
+
+class Sender:
+    """ Delivers mail over one SMTP session, opened when first needed """
+    def __init__(self):
+        self._session = None
+
+    def send(self, recipient, text):
+        if self._session == None:
+            self._session = smtplib.SMTP(config_dict["SMTP_HOST"],
+                                         config_dict["SMTP_PORT"],
+                                         timeout=config_dict["SMTP_TIMEOUT"])
+        self._session.sendmail(config_dict["FROM"], [recipient], text)
+
+    def close(self):
+        if self._session == None: return
+        try:
+            self._session.quit()
+        except (socket.error, smtplib.SMTPException):
+            self._session.close()
+        self._session = None
+
+def _retry_later(messages, now, why):
+    """ Put messages off until their next try, or give up on them """
+    for message in messages:
+        message.attempts = message.attempts + 1
+        if now - message.queued >= config_dict["GIVE_UP_SECONDS"]:
+            _give_up(message, why)
+            continue
+        delay = config_dict["RETRY_SECONDS"] * 2 ** (message.attempts - 1)
+        message.next_try = now + min(delay, config_dict["MAX_RETRY_SECONDS"])
+        message.save()
+
+def _give_up(message, why):
+    print >> sys.stderr, "Giving up on mail to %s (%s): %s" % (
+        message.recipient, message.subject, why)
+    _makedirs(failed_dir())
+    os.rename(message.filename, '%s/%s' % (
+        failed_dir(), os.path.basename(message.filename)))
+
+def _refused(messages, now, code, why):
+    """ Give up on messages the relay refused for good, or retry them """
+    print >> sys.stderr, "Mail to %s refused: %s %s" % (
+        messages[0].recipient, code, why)
+    if code >= 500:
+        for message in messages:
+            _give_up(message, why)
+    else:
+        _retry_later(messages, now, why)
+
+def _due(now, force):
+    """ @return list of (recipient, messages) due to be sent now, and
+    the time the next of the rest will be due or None """
+    by_recipient = {}
+    for message in queued_messages():
+        by_recipient.setdefault(message.recipient, []).append(message)
+
+    due = []
+    next_due = None
+    recipients = by_recipient.keys()
+    recipients.sort()
+    for recipient in recipients:
+        messages = by_recipient[recipient]
+        ready = [m for m in messages if m.next_try <= now]
+        if ready and (force or ready[0].queued +
+                      config_dict["DIGEST_SECONDS"] <= now):
+            due.append((recipient, ready))
+            messages = [m for m in messages if not m in ready]
+        for message in messages:
+            when = message.next_try
+            if not force:
+                when = max(when, message.queued + config_dict["DIGEST_SECONDS"])
+            if next_due == None or when < next_due: next_due = when
+    return due, next_due
+
+def flush(now=None, force=0):
+    """ Deliver every digest that is due
+
+    @param force if non-zero, deliver everything that may be tried now
+    without waiting for more mail to the same recipient
+    @return time the next message will be due, or None if the queue is
+    empty
+    """
+    if now == None: now = time.time()
+    due, next_due = _due(now, force)
+
+    sender = Sender()
+    try:
+        for index in range(len(due)):
+            recipient, messages = due[index]
+            try:
+                sender.send(recipient, message_text(recipient, messages))
+            except (socket.error, smtplib.SMTPServerDisconnected,
+                    smtplib.SMTPConnectError), e:
+                # the relay is in trouble, try everyone left later
+                print >> sys.stderr, "Mail to %s failed: %s" % (recipient, e)
+                sender.close()
+                for recipient, messages in due[index:]:
+                    _retry_later(messages, now, e)
+                break
+            except smtplib.SMTPRecipientsRefused, e:
+                code, why = e.recipients[recipient]
+                _refused(messages, now, code, why)
+            except smtplib.SMTPResponseException, e:
+                _refused(messages, now, e.smtp_code, e.smtp_error)
+            else:
+                for message in messages:
+                    os.unlink(message.filename)
+    finally:
+        sender.close()
+    if due:
+        next_due = _due(now, force)[1]
+    return next_due
+
+def take_lock():
+    """ @return open file holding the sender's lock, or None if another
+    sender has it """
+    _makedirs(rpm_config.mail_spool_dir)
+    fp = open('%s/sender.lock' % rpm_config.mail_spool_dir, 'a')
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        fp.close()
+        return None
+    return fp
+
+def run(force=0):
+    """ Deliver the queue, sleeping until each digest is due, until it
+    is empty.  Returns right away if another sender is running. """
+    while 1:
+        lock = take_lock()
+        if lock == None: return
+        try:
+            next_due = flush(force=force)
+            while next_due != None:
+                time.sleep(max(next_due - time.time(), 1))
+                next_due = flush(force=force)
+        finally:
+            lock.close()
+        # mail queued just as the queue emptied has no sender waiting
+        # for it, so look again now that the lock is free
+        if not queued_messages(): return
+
+def start_sender():
+    """ Start a sender in the background, detached from this process,
+    logging to the spool directory """
+    _makedirs(rpm_config.mail_spool_dir)
+    log = open('%s/sender.log' % rpm_config.mail_spool_dir, 'a')
+    try:
+        server = '%s:%d' % (config_dict["SMTP_HOST"],
+                            config_dict["SMTP_PORT"])
+        subprocess.Popen(SENDER_COMMAND + ['-s', server,
+                                           '-r', rpm_config.root],
+                         stdin=open(os.devnull), stdout=log, stderr=log,
+                         close_fds=True, preexec_fn=os.setsid)
+    finally:
+        log.close()
+
+def usage(argv):
+    print "%s [-1] [-n] [-l] [-s host[:port]] [-r root]" % argv[0]
+    print "Deliver the mail spooled in %s" % rpm_config.mail_spool_dir
+    print "-1 : deliver what is due and exit, instead of waiting for the rest"
+    print "-n : deliver now, without waiting to make digests"
+    print "-l : list the queue and exit"
+    print "-s : SMTP server, default %s:%d" % (config_dict["SMTP_HOST"],
+                                                config_dict["SMTP_PORT"])
+    print "-r : root the repository was relocated under"
+    print "-h : print this message"
+
+def main(argv):
+    once = 0
+    force = 0
+    list_only = 0
+    try:
+        opts, args = getopt.getopt(argv[1:], 'h1nls:r:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-1':
+                once = 1
+            elif opt == '-n':
+                force = 1
+            elif opt == '-l':
+                list_only = 1
+            elif opt == '-s':
+                host, port = (val.split(':', 1) + [None])[:2]
+                config_dict["SMTP_HOST"] = host
+                if port != None:
+                    config_dict["SMTP_PORT"] = int(port)
+            elif opt == '-r':
+                if val: rpm_config.relocate(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    if list_only:
+        for message in queued_messages():
+            print "%s %s: %s (%d tries)" % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(message.queued)),
+                message.recipient, message.subject, message.attempts)
+    elif once:
+        lock = take_lock()
+        if lock == None:
+            print "Another sender is running."
+            return 1
+        try:
+            flush(force=force)
+        finally:
+            lock.close()
+    else:
+        run(force)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
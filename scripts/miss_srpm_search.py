@@ -1,31 +1,160 @@
 #!/usr/bin/env python
 
+""" Find rpms in the floating dists whose source rpm isn't in SRPMS.
+
+The source rpms come from the repository catalog, which only reads
+the headers of rpms new since it last looked.  Without it, the dists and
+SRPMS are listed and the headers come through rpm_cache.  Either way,
+with -j the headers are read several at once.  The rpms
+missing their source rpm are saved, so with -d only the changes since
+the last audit are printed.
+"""
+
+import cPickle
+import getopt
+import os
+import sys
+
+import repo_catalog
+import rpm_cache
 import rpm_config
 import rpm_util
-import commands
-import os
 
+# bump whenever the saved audit changes format
+AUDIT_VERSION = 2
 
 def parent_srpm(rpmname):
-    # stolen and hushed from rpm_util.py
-    """ @return name of source rpm that built rpmname """
-    # need to actually query rpm in case of 'breakout' package
-    query_string = "rpm -qp --queryformat '%{SOURCERPM}' " + rpmname + " 2>/dev/null"
-    return commands.getoutput(query_string)
+    """ @return name of source rpm that built rpmname, or '' if it can't
+    be read """
+    # need to actually look in the header in case of 'breakout' package
+    try:
+        return rpm_cache.get_header(rpmname).sourcerpm() or ''
+    except (IOError, OSError):
+        return ''
 
-def main():
+def audit_file():
+    return '%s/srpm_audit' % rpm_config.cache_dir
+
+def load_audit(filename):
+    """ @return dict keyed by missing (dist, rpm, source rpm) saved by
+    the last audit, empty if there wasn't one """
+    try:
+        fp = open(filename, 'rb')
+        try:
+            version, missing = cPickle.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError):
+        return {}
+    if version != AUDIT_VERSION:
+        return {}
+    return missing
+
+def save_audit(filename, missing):
+    try:
+        if not os.path.isdir(rpm_config.cache_dir):
+            os.makedirs(rpm_config.cache_dir)
+        fp = open(filename + '.new', 'wb')
+        try:
+            cPickle.dump((AUDIT_VERSION, missing), fp, 2)
+        finally:
+            fp.close()
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning, can't save audit:", e
+
+def audit(workers=1):
+    """ @param workers number of headers to read at once
+    @return dict keyed by (dist, rpm, source rpm) for each rpm in the
+    floating dists whose source rpm is missing, from the disk """
+    srpms = rpm_util.dict_from_list(os.listdir(rpm_config.srpms_dir))
+    locations = []
     for (vers, bitness) in rpm_config.ver_bit_pairs():
         for dist in rpm_config.fixed_to_floating.values():
             # only hit each dist once...
             rpm_list_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
             for filename in os.listdir(rpm_list_dir):
-                srpm_name = parent_srpm(rpm_list_dir + '/' + filename)
-                srpm_loc = rpm_config.srpms_dir + '/' + srpm_name
-                if not os.access(srpm_loc, os.F_OK):
-                    print dist, filename, srpm_name
+                locations.append((dist, filename,
+                                  rpm_list_dir + '/' + filename))
+
+    found = rpm_util.parallel_map(lambda item: parent_srpm(item[2]),
+                                  locations, workers)
+    missing = {}
+    for (dist, filename, path), srpm_name in zip(locations, found):
+        if not srpm_name in srpms:
+            missing[(dist, filename, srpm_name)] = 1
+    return missing
+
+def catalog_audit(catalog):
+    """ @return dict keyed by (dist, rpm, source rpm) for each rpm in
+    the floating dists whose source rpm is missing, from catalog """
+    srpms = rpm_util.dict_from_list(catalog.filenames(rpm_config.srpms_dir))
+    missing = {}
+    for (vers, bitness) in rpm_config.ver_bit_pairs():
+        for dist in rpm_config.fixed_to_floating.values():
+            rpm_list_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
+            for filename, srpm_name in catalog.sourcerpms(rpm_list_dir):
+                srpm_name = srpm_name or ''
+                if not srpm_name in srpms:
+                    missing[(dist, filename, srpm_name)] = 1
+    return missing
+
+def usage(argv):
+    print "%s [-d] [-f] [-j N]" % argv[0]
+    print "Print rpms in the floating dists whose source rpm is missing"
+    print "-d : only print what changed since the last audit, + for newly"
+    print "     missing and - for found again"
+    print "-f : rebuild the repository catalog first, rereading every rpm"
+    print "-j N : read up to N rpm headers at once"
+    print "-h : print this message"
+
+def main(argv):
+    delta = 0
+    forget = 0
+    workers = 1
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hdfj:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-d':
+                delta = 1
+            elif opt == '-f':
+                forget = 1
+            elif opt == '-j':
+                workers = int(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    last_missing = load_audit(audit_file())
+    catalog = repo_catalog.default_catalog()
+    if catalog != None:
+        catalog.workers = workers
+        if forget: catalog.rebuild()
+        missing = catalog_audit(catalog)
+    else:
+        missing = audit(workers)
+
+    now_missing = missing.keys()
+    now_missing.sort()
+    if delta:
+        was_missing = last_missing.keys()
+        was_missing.sort()
+        for item in now_missing:
+            if not item in last_missing:
+                print '+', ' '.join(item)
+        for item in was_missing:
+            if not item in missing:
+                print '-', ' '.join(item)
+    else:
+        for item in now_missing:
+            print ' '.join(item)
 
-                    
-    
+    save_audit(audit_file(), missing)
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main(sys.argv))
@@ -6,17 +6,22 @@ This includes per-RPM dependency checks.  IE, things that can be checked
 without needing a massive repository wide dependency check.  It does
 version check against the repository, but it is relatively simple"""
 
-import commands
-import glob
 import os
+import pwd
 import sys
 
+import repo_catalog
+import rpm_cache
 import rpm_config
 import rpm_util
+import run_metrics
 
 
 ACCEPT_LESSER, ACCEPT_EQUAL, ACCEPT_GREATER = (-1, 0, 1)
 
+# uid -> username, shared by every scan
+_usernames = {}
+
 def sorted_list_of_keys(d):
     keys = d.keys()
     keys.sort()
@@ -29,7 +34,7 @@ class PendingScan:
     their version in the repository against their version in pending.
     """
     def __init__(self, dist, pending_dir=None, accept_level=None,
-                 rpm_ver='4.0.2', prefix=None):
+                 rpm_ver='4.0.2', prefix=None, workers=1):
         """ Create a report, perform scan
 
         @param dist distrobution to check for pending packages (eg, 'stable')
@@ -44,10 +49,16 @@ class PendingScan:
         
         @param prefix optional place to pretend where repository lives
         when checking against existing packages
+
+        @param workers number of rpms to examine at once
         """
-        
+        if pending_dir == None:
+            pending_dir = rpm_config.pending_dir(dist)
+
+        self._entries = list_directory(pending_dir)
         categories = categorize_pending(dist,pending_dir, accept_level,
-                                        rpm_ver, prefix)
+                                        rpm_ver, prefix, workers,
+                                        self._entries)
         accepted_tuples, old_tuples, missing_rpmlib_dep_tups, abandoned_rpms,\
                          srpms, sources = categories
                      
@@ -97,6 +108,25 @@ class PendingScan:
     def all_rpms(self):
         """ @return a list containing all the RPMs found in the scan """
         return self.accepted_rpms() + self.bad_rpms()
+
+    def entry(self, filename):
+        """ @return os.stat result for filename in the pending directory
+        as of the scan, or None if it wasn't there """
+        return self._entries.get(filename)
+
+    def owners(self):
+        """ @return dict keyed by username of everyone owning one of
+        all_rpms() """
+        owners = {}
+        for rpm in self.all_rpms():
+            st = self._entries.get(rpm)
+            if st != None:
+                owners[username(st.st_uid)] = 1
+        return owners
+
+    def all_records(self):
+        """ @return list of rpm_util.RpmName for all_rpms() """
+        return rpm_util.parse_many(self.all_rpms())
         
     def get_replaced(self, accepted_rpm):
         """ @return name of rpm in current repository that is being
@@ -154,38 +184,21 @@ class PendingScan:
                 indicies[(str(vers), str(bitness))] = count
                 count = count + 1
 
-        for rpm in self.all_rpms():
-            rpmname = rpm_util.extract_rpmname(rpm)
+        for record in self.all_records():
             num_dists = len(rpm_config.bitnesses)*len(rpm_config.sol_versions)
-            table[rpmname] = [' '] * num_dists
-
-        for accepted in self._accepted_dict:
-            parsed = rpm_util.parse_rpmname(accepted)
-            name, ver_bit = parsed[0], rpm_util.sol_ver_and_bit(parsed)
-
-            if self.get_replaced(accepted) == None: status = 'N'
-            else: status = 'A'
-
-            table[name][indicies[ver_bit]] = status
+            table[record.name] = [' '] * num_dists
 
-        # should factor this crap out, it's basically all the same...
-        for old in self._old_dict:
-            parsed = rpm_util.parse_rpmname(old)
-            name, ver_bit = parsed[0], rpm_util.sol_ver_and_bit(parsed)
+        def mark(rpms, status):
+            for record in rpm_util.parse_many(rpms):
+                table[record.name][indicies[record.ver_bit()]] = status
 
-            table[name][indicies[ver_bit]] = 'O'
-
-        for dep_prob in self._missing_deps:
-            parsed = rpm_util.parse_rpmname(dep_prob)
-            name, ver_bit = parsed[0], rpm_util.sol_ver_and_bit(parsed)
-
-            table[name][indicies[ver_bit]] = 'D'
-
-        for abandoned in self._abandoned_rpms:
-            parsed = rpm_util.parse_rpmname(abandoned)
-            name, ver_bit = parsed[0], rpm_util.sol_ver_and_bit(parsed)
+        for accepted in self._accepted_dict:
+            if self.get_replaced(accepted) == None: mark([accepted], 'N')
+            else: mark([accepted], 'A')
 
-            table[name][indicies[ver_bit]] = 'M'
+        mark(self._old_dict, 'O')
+        mark(self._missing_deps, 'D')
+        mark(self._abandoned_rpms, 'M')
                         
         table = table.items()
         table.sort()
@@ -203,8 +216,9 @@ class PendingScan:
         vers, bitness = str(vers), str(bitness)
         ret = {}
         for rpm in rpm_seq:
-            ver_bit = rpm_util.sol_ver_and_bit(rpm)
-            if ver_bit == (vers, bitness) and rpm != None:
+            if rpm == None: continue
+            record = rpm_util.parse(rpm)
+            if record != None and record.ver_bit() == (vers, bitness):
                 ret[rpm] = 1
         return ret
 
@@ -213,12 +227,17 @@ class PendingScan:
 class RpmDependencies:
     """ Extracts and stores the dependencies of an RPM """
     
-    def __init__(self, filename):
+    def __init__(self, filename, header=None):
         """  Ideally, this should work if filename is a direct path to an rpm
         or just an rpm name but for now, only works with direct paths
+
+        @param header optional rpm_header.RpmHeader already read from
+        filename, to avoid reading it again
         """
-        if not os.access(filename, os.O_RDONLY):
-            raise IOError, '%s does not exist' % filename
+        if header == None:
+            if not os.access(filename, os.O_RDONLY):
+                raise IOError, '%s does not exist' % filename
+            header = rpm_cache.get_header(filename)
 
         self._name = filename
         self._rpm_deps = []
@@ -226,7 +245,7 @@ class RpmDependencies:
         self._cap_deps = []
         self._lib_deps = []
 
-        self._parse_deps('rpm -qpR %s' % filename)
+        self._parse_deps(header)
 
     def get_name(self):
         return self._name
@@ -243,13 +262,11 @@ class RpmDependencies:
     def get_rpm_deps(self):
         return self._rpm_deps
 
-    def _parse_deps(self, cmd):
-        deps = commands.getoutput(cmd).split('\n')
-
-        for depline in deps:
-            if depline.startswith('warning:') or  \
-               depline.startswith('error:'): continue
-            dep = self._split_dep(depline)
+    def _parse_deps(self, header):
+        """ Sort the requires of header into the dependency lists.  Each
+        dependency is a 3-tuple containing (name, operator, version),
+        operator and version are '' for unversioned dependencies """
+        for dep in header.requires():
             dep_name = dep[0]
             if dep_name.startswith('/'):
                 self._prog_deps.append(dep)
@@ -260,26 +277,40 @@ class RpmDependencies:
             else:
                 self._rpm_deps.append(dep)
 
-    def _split_dep(self, depline):
-        """ Break up dependency line from rpm output 
+def username(uid):
+    """ @return name of the user with uid, or the uid as a string if
+    there is no such user.  Each uid is only looked up once. """
+    name = _usernames.get(uid)
+    if name == None:
+        try:
+            name = pwd.getpwuid(uid)[0]
+        except KeyError:
+            name = str(uid)
+        _usernames[uid] = name
+    return name
 
-        @param depline single line from output of rpm dependency list
-        @return 3-tuple containing (name, operator, version) from depline.
-        operator and version will be '' if depline contains no spaces
-        """
-        split_depline = depline.split(' ')
-        if len(split_depline) == 1:
-            return (split_depline[0], '', '')
-        elif len(split_depline) == 3:
-            return tuple(split_depline)
-        raise ValueError("%s confused me" % depline)
+def list_directory(directory):
+    """ List directory once, keeping what later checks need of each file
+
+    @return dict keyed by filename yielding its os.stat result, for
+    everything in directory
+    """
+    entries = {}
+    for filename in os.listdir(directory):
+        try:
+            entries[filename] = os.stat('%s/%s' % (directory, filename))
+        except OSError:
+            pass # moved away while we looked
+    return entries
 
 def partition(f, l):
     return (filter(f, l), filter(lambda x: not f(x), l))        
         
+@run_metrics.timed("categorize_pending")
 def categorize_pending(dist, pending_dir = None,
                        accept_level = ACCEPT_EQUAL,
-                       rpm_ver = '4.0.2', repository_prefix = None):
+                       rpm_ver = '4.0.2', repository_prefix = None,
+                       workers = 1, entries = None):
     """ Categorize the files in the pending directory of given dist.
 
     @param dist distrobution to check for pending packages
@@ -299,6 +330,13 @@ def categorize_pending(dist, pending_dir = None,
 
     accept_level == ACCEPT_GREATER, the pending RPM version must be
     greater than the existing RPM.
+
+    @param workers number of rpm headers to read at once.  The results
+    are the same, in the same order, whatever it is set to.
+
+    @param entries optional dict of filename to os.stat result for
+    pending_dir, as returned by list_directory, to save listing and
+    statting it again
     
     @return tuple of (accepted_rpms, too_old, srpms, sources)
     """
@@ -308,12 +346,20 @@ def categorize_pending(dist, pending_dir = None,
     if pending_dir == None:        
         pending_dir = rpm_config.pending_dir(dist)
 
-    rpms, sources = partition(ends_with_rpm, os.listdir(pending_dir))
+    if entries == None:
+        entries = list_directory(pending_dir)
+
+    filenames = entries.keys()
+    filenames.sort()
+    rpms, sources = partition(ends_with_rpm, filenames)
     srpms, rpms = partition(ends_with_src_rpm, rpms)
+    run_metrics.count("files_scanned", len(rpms) + len(srpms) + len(sources),
+                      dist=dist)
     
-    has_srpm, lacks_srpm = ensure_has_srpm(rpms, srpms, pending_dir)
+    headers = read_headers(rpms, pending_dir, workers, entries)
+    has_srpm, lacks_srpm = ensure_has_srpm(rpms, srpms, pending_dir, headers)
     meets_rpmlib_dep, missing_rpmlib_dep = rpmlib_probs(has_srpm, rpm_ver,
-                                                        pending_dir)
+                                                        pending_dir, headers)
     
     pub_result = new_enough_rpms(meets_rpmlib_dep, dist, accept_level,
                                  repository_prefix)
@@ -321,10 +367,44 @@ def categorize_pending(dist, pending_dir = None,
 
     return new_enough, too_old, missing_rpmlib_dep, lacks_srpm, srpms, sources
 
-def rpmlib_probs(rpms_to_check, rpm_version_no_greater_than, pending_dir):
+@run_metrics.timed("read_headers")
+def read_headers(rpms, pending_dir, workers=1, entries=None):
+    """ Read the header of each rpm in pending_dir once, so the checks
+    after it need not open the files again.  Headers come from the
+    rpm_cache, so rpms left in pending since the last scan aren't read.
+
+    @param workers number of headers to read at once
+    @param entries optional dict of filename to os.stat result, from
+    list_directory, so the cache lookups needn't stat the rpms again
+    @return dict keyed by rpm filename yielding rpm_header.RpmHeader,
+    unreadable rpms are left out
+    """
+    if entries == None: entries = {}
+
+    def read_one(rpm):
+        try:
+            return rpm_cache.get_header(pending_dir + '/' + rpm,
+                                        entries.get(rpm))
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Warning, can't read header:", e
+            return None
+
+    headers = {}
+    for rpm, header in zip(rpms, rpm_util.parallel_map(read_one, rpms,
+                                                       workers)):
+        if header != None:
+            headers[rpm] = header
+    return headers
+
+@run_metrics.timed("rpmlib_probs")
+def rpmlib_probs(rpms_to_check, rpm_version_no_greater_than, pending_dir,
+                 headers=None):
     """ Find problems with rpmlib dependencies being greater than
     rpm_version_no_greater_than
 
+    @param headers optional dict of rpm to rpm_header.RpmHeader, as
+    returned by read_headers
+
     @return (satisified, unsatisified)
     satisfied is a flatlist of accepted rpms
     unsatisfied is a list of tuples of (unsatisfied rpm, required_feature)
@@ -332,8 +412,11 @@ def rpmlib_probs(rpms_to_check, rpm_version_no_greater_than, pending_dir):
     satisfied, unsatisfied = [], []
     comparable_max_ver = rpm_version_no_greater_than.split('.')
     
+    if headers == None: headers = {}
+    
     for rpm in rpms_to_check:
-        rpm_lib_reqs = RpmDependencies(pending_dir + '/' + rpm).get_cap_deps()
+        rpm_lib_reqs = RpmDependencies(pending_dir + '/' + rpm,
+                                       headers.get(rpm)).get_cap_deps()
         this_one_is_unsat = 0
         for rpmlib_req in rpm_lib_reqs:
             comparable_req = rpmlib_req[2][:-2].split('.')
@@ -346,19 +429,67 @@ def rpmlib_probs(rpms_to_check, rpm_version_no_greater_than, pending_dir):
 
     return satisfied, unsatisfied
             
-def new_enough_rpms(rpm_list, dist, accept_level, prefix=None):
+class RepositoryIndex:
+    """ Maps package names to the rpms with exactly that name in
+    repository directories.  Directories in the repository catalog are
+    looked up in it; others are listed and their filenames parsed only
+    once, however many pending rpms are looked up in them.
+    """
+    def __init__(self):
+        self._dirs = {}
+
+    def same_name(self, directory, name):
+        """ @return list of (filename, rpm_util.RpmName) for each rpm in
+        directory whose package name is name """
+        catalog = repo_catalog.covering(directory)
+        if catalog != None:
+            same = []
+            for filename in catalog.same_name(directory, name):
+                record = rpm_util.parse(filename)
+                if record != None and record.key != None:
+                    same.append((filename, record))
+            return same
+
+        if not directory in self._dirs:
+            self._dirs[directory] = index_directory(directory)
+        return self._dirs[directory].get(name, [])
+
+def index_directory(directory):
+    """ @return dict keyed by package name yielding a list of
+    (filename, rpm_util.RpmName) for the rpms in directory.  A directory
+    that doesn't exist yields an empty dict. """
+    index = {}
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return index
+
+    filenames.sort()
+    for filename in filenames:
+        record = rpm_util.parse(filename)
+        if record == None or record.key == None:
+            print >> sys.stderr, "Warning, can't parse", filename
+            continue
+        index.setdefault(record.name, []).append((filename, record))
+    return index
+
+@run_metrics.timed("new_enough_rpms")
+def new_enough_rpms(rpm_list, dist, accept_level, prefix=None, index=None):
     """ @return tuple of (accepted_list, old_list) rpms.
     Each list is a tuple of (target, other), where target is the rpm in
     pending, and other is either None, or the rpm in the current repository
 
     @praram accept_level @see categorize_pending
+    @param index optional RepositoryIndex to look up existing rpms in,
+    one is made for this call if not given
     """
     accepted_rpms, old_rpms = [], []
+    if index == None: index = RepositoryIndex()
     
     for rpm in rpm_list:
-        parsed_rpm = rpm_util.parse_rpmname(rpm)
+        record = rpm_util.parse(rpm)
         
-        vers_bitness = rpm_util.sol_ver_and_bit(parsed_rpm)
+        vers_bitness = rpm_util.sol_ver_and_bit(record)
         if vers_bitness == None:
             print >> sys.stderr, "Warning, no vers/bitness for", rpm
             continue
@@ -371,10 +502,10 @@ def new_enough_rpms(rpm_list, dist, accept_level, prefix=None):
             unprefixed = unprefixed[len(rpm_config.repository_dir):]
             place_to_look = prefix + unprefixed
 
-        glob_same_name = "%s/%s*" % (place_to_look, parsed_rpm[0])
-        rpms_with_same_name = glob.glob(glob_same_name)
+        rpms_with_same_name = index.same_name(place_to_look, record.name)
 
-        accepted, compared = version_order(parsed_rpm, rpms_with_same_name)
+        accepted, compared = version_order_parsed(record,
+                                                  rpms_with_same_name)
         if accepted >= accept_level:
             accepted_rpms.append((rpm, compared))
         else:
@@ -385,6 +516,8 @@ def new_enough_rpms(rpm_list, dist, accept_level, prefix=None):
 def version_order(parsed_rpmname, existing_list):
     """ Determine the relative ordering of parsed_rpmname.
 
+    @param existing_list list of rpm filenames or paths to compare with,
+    ones with a different package name are ignored
     @return tuple containing (code, other_rpmname), where code is -1 if
     parsed_rpmname is lesser in version than other_rpmname, 0 if it is
     the same, and 1 otherwise.  If there are no other rpms, other_rpmname
@@ -394,51 +527,72 @@ def version_order(parsed_rpmname, existing_list):
         return x.split('/')[-1]
     existing_list = map(remove_path, existing_list)
 
-    this_name = parsed_rpmname[0]
-    this_version = rpm_util.extract_rpm_version(parsed_rpmname)
+    parsed_list = []
+    for other_rpm in existing_list:
+        other_record = rpm_util.parse(other_rpm)
+        if other_record == None:
+            print "Trouble parsing with ", other_rpm, " ... parsed as ", other_record
+            continue
+        if parsed_rpmname[0] == other_record.name:
+            parsed_list.append((other_rpm, other_record))
+
+    this_record = rpm_util.RpmName('', parsed_rpmname)
+    return version_order_parsed(this_record, parsed_list)
+
+def version_order_parsed(record, same_name_list):
+    """ Like version_order, but compares an rpm_util.RpmName against
+    already parsed rpms of the same name, as returned by
+    RepositoryIndex.same_name
+
+    @param same_name_list list of (filename, rpm_util.RpmName)
+    """
+    this_name = record.name
+    this_version = record.key
     found_eq_version = 0
     counted_others = 0
     compared_rpm = None
     
-    for other_rpm in existing_list:
-        parsed_other_rpm = rpm_util.parse_rpmname(other_rpm)
-        try:
-            other_name = parsed_other_rpm[0]
-        except TypeError:
-            print "Trouble parsing with ", other_rpm, " ... parsed as ", parsed_other_rpm
-            continue
-        if this_name == other_name:            
-            other_version = rpm_util.extract_rpm_version(parsed_other_rpm)
-            counted_others += 1
-            compared_rpm = other_rpm
-            if counted_others > 1:
-                warning = "Warning, more than one %s in repo " % this_name
-                print >> sys.stderr, warning
-            if this_version < other_version:
-                return (-1, compared_rpm)
-            if this_version == other_version:
-                found_eq_version = 1
+    for other_rpm, other_record in same_name_list:
+        other_version = other_record.key
+        counted_others += 1
+        compared_rpm = other_rpm
+        if counted_others > 1:
+            warning = "Warning, more than one %s in repo " % this_name
+            print >> sys.stderr, warning
+        if this_version < other_version:
+            return (-1, compared_rpm)
+        if this_version == other_version:
+            found_eq_version = 1
 
     if found_eq_version:
         return (0, compared_rpm)
     return (1, compared_rpm)
 
-def ensure_has_srpm(rpmlist, srpmlist, pending_dir):
+@run_metrics.timed("ensure_has_srpm")
+def ensure_has_srpm(rpmlist, srpmlist, pending_dir, headers=None):
     """ Make sure rpms in rpmlist have a corresponding srpm in srpmlist
 
+    @param headers optional dict of rpm to rpm_header.RpmHeader, as
+    returned by read_headers.  Rpms not in it have their header read.
+
     @return tuple of (has_srpm_list, lacks_srpm_list) based on the presense
-    of an srpm of the same name in pending or in the SRPM directory
+    of an srpm of the same name in pending or in the SRPM directory,
+    looked up in the repository catalog
     """
     has_srpm, lacks_srpm = [], []
 
     srpm_dict = rpm_util.dict_from_list(srpmlist)
-    for srpm in os.listdir(rpm_config.srpms_dir):
-        srpm_dict[srpm] = 1
+
+    if headers == None: headers = {}
 
     for rpm_filename in rpmlist:
-        full_path = pending_dir + '/' + rpm_filename
-        srpm_which_built_rpm = rpm_util.parent_srpm(full_path)
-        if srpm_which_built_rpm in srpm_dict:
+        if rpm_filename in headers:
+            srpm_which_built_rpm = headers[rpm_filename].sourcerpm()
+        else:
+            full_path = pending_dir + '/' + rpm_filename
+            srpm_which_built_rpm = rpm_util.parent_srpm(full_path)
+        if srpm_which_built_rpm in srpm_dict or \
+               repo_catalog.has_srpm(srpm_which_built_rpm):
             has_srpm.append(rpm_filename)
         else:
             lacks_srpm.append(rpm_filename)
@@ -4,13 +4,22 @@
 
 
 import os
-import shutil
+import sys
 
 import dep_problems
 run_system_cmd = dep_problems.run_system_cmd
+import fileops
+import genpkglist
 import mail_publish
 import pending_scan
+import rdeps
+import repo_catalog
 import rpm_config
+import rpm_util
+import run_metrics
+
+# dists published ahead of the others when several run at once
+PRIORITY_DISTS = ['stable']
 
 class PublishOutcome:
     """ Represents the result of a publish """
@@ -21,13 +30,8 @@ class PublishOutcome:
 
     def add_scan(self, scan):
         """ @param scan pending_scan.PendingScan """
-        import pwd
         self.pending_scans.append(scan)
-        
-        for pkg in scan.all_rpms():
-            uid = os.stat("%s/%s" % (scan.pending_dir, pkg))[4]
-            username = pwd.getpwuid(uid)[0]
-            self.usernames_with_pkgs[username] = 1
+        self.usernames_with_pkgs.update(scan.owners())
 
     def add_pub_result(self, dist_tuple, outcome):
         """ @param dist_tuple tuple of (dist, sol_ver, bitness)
@@ -35,6 +39,12 @@ class PublishOutcome:
         in repository """
         self.per_dist_outcomes.append((dist_tuple, outcome))
 
+    def merge(self, other):
+        """ Add everything in PublishOutcome other to this one """
+        self.pending_scans.extend(other.pending_scans)
+        self.per_dist_outcomes.extend(other.per_dist_outcomes)
+        self.usernames_with_pkgs.update(other.usernames_with_pkgs)
+
     def pending_results(self):
         """ @return list of PendingScan that happened during publish"""
         return self.pending_scans
@@ -54,10 +64,12 @@ class Publisher:
     where to put the results of a publish, whether or not to do a dry-
     run, etc.
     """
-    def __init__(self, dists, fake_run):
+    def __init__(self, dists, fake_run, scan_workers=1, dist_workers=1):
         self.backed_release = None
         self.dists_to_publish = dists
         self.fake_run = fake_run
+        self.scan_workers = scan_workers
+        self.dist_workers = dist_workers
         self.dep_prob_accept_levels = {'unstable': dep_problems.NEW_PKG,
                                        'testing': dep_problems.NO_NEW,
                                        'stable': dep_problems.NO_NEW,
@@ -80,8 +92,8 @@ class Publisher:
     def get_result_dir(self):
         if self.fake_run:
             result_dir = "%s/testing_publish" % rpm_config.repository_dir
-            run_system_cmd("rm -rf %s" % result_dir)
-            run_system_cmd("mkdir -p %s" % result_dir)
+            fileops.remove_tree(result_dir)
+            fileops.make_dirs(result_dir)
         else:
             result_dir = rpm_config.repository_dir
         return result_dir
@@ -104,80 +116,126 @@ class Publisher:
     def get_pkg_ver_limit(self, dist):
         return self.pkg_ver_accept.get(dist,pending_scan.ACCEPT_GREATER)
 
-    def do_accept_pub(self, dist_tup, scan, pub_report, msg):
-        """ Called when a dist_tup has been deemed worthy of publishing """
+    def do_accept_pub(self, dist_tup, scan, pub_report, msg,
+                      new_unmet=None):
+        """ Called when a dist_tup has been deemed worthy of publishing
+
+        @param new_unmet unmet dependencies of the pseudo publish, which
+        become those of the live repository once it is published
+        """
         dist, vers, bitness = dist_tup
         report_msg = "Publish accepted: " + msg
         print report_msg
         pub_report.add_pub_result(dist_tup, report_msg)
         real_publish(scan, dist, vers, bitness, self.fake_run)
+        if new_unmet != None and not self.fake_run:
+            dep_problems.save_baseline(dist, vers, bitness, new_unmet)
 
     def do_reject_pub(self, dist_tup, scan, pub_report, msg):
-        """ Called when a dist_tup has problems too severe to publish """
+        """ Called when a dist_tup has problems too severe to publish.
+        The message also lists what in the live dist requires the
+        packages the publish would have replaced. """
         dist, vers, bitness = dist_tup
         pend = scan.pending_dir
         print "Badness in new repository", msg
+        replaced = scan.replaced_set(vers, bitness)
+        if replaced:
+            index = rdeps.dist_index(dist, vers, bitness, self.scan_workers)
+            affected = rdeps.replaced_report(index, replaced.keys())
+            if affected:
+                msg = "%s\nReverse dependencies of replaced packages:\n%s" % (
+                    msg, affected)
         pub_report.add_pub_result(dist_tup, "Rejected: " + msg)
         accepted = scan.accepted_set(vers, bitness)
         move_bad_pkgs_to_error(pend, accepted)
             
+    def publish_dist(self, dist, result_dir):
+        """ Scan the pending directory of dist and publish whatever of
+        it can be published
+
+        @return PublishOutcome for just this dist
+        """
+        pub_report = PublishOutcome()
+        pend = self.get_pending_dir(dist)
+
+        pkg_ver_lim = self.get_pkg_ver_limit(dist)
+        rpm_ver = self.rpm_max_ver[dist]
+        scan = pending_scan.PendingScan(dist, pending_dir=pend,
+                                        rpm_ver = rpm_ver,
+                                        accept_level=pkg_ver_lim,
+                                        workers=self.scan_workers)
+        pub_report.add_scan(scan)
+
+        move_pending_srpms(scan)
+        move_pending_sources(scan)
+        bad_packages = scan.bad_rpms()
+        move_bad_pkgs_to_error(pend, bad_packages)
+
+        for (vers, bitness) in rpm_config.ver_bit_pairs():
+            print dist, vers, bitness
+            this_dist = (dist, vers, bitness)
+
+            if len(scan.accepted_set(vers, bitness)) > 0:
+                dest_prefix = "%s/%s" % (
+                    result_dir, rpm_config.dist_suffix(*this_dist))
+
+                span = run_metrics.start("baseline_unmet")
+                cur_unmet = dep_problems.baseline_unmet(
+                    dist, vers, bitness, self.scan_workers)
+                span.stop()
+                new_unmet = pseudo_publish(scan, dist, vers, bitness,
+                                           pend, dest_prefix,
+                                           self.scan_workers)
+                run_metrics.count("unmet_packages", len(cur_unmet),
+                                  dist=dist, repository="live")
+                run_metrics.count("unmet_packages", len(new_unmet),
+                                  dist=dist, repository="pseudo")
+
+                dep_problem_code, msg = dep_problems.unmet_compare(
+                    cur_unmet, new_unmet)
+
+                if self.accept_depend_probs(dep_problem_code, dist):
+                    self.do_accept_pub(this_dist, scan, pub_report, msg,
+                                       new_unmet)
+                else:
+                    self.do_reject_pub(this_dist, scan, pub_report, msg)
+            else:
+                pub_report.add_pub_result(this_dist, "Nothing pending")
+                print dist, vers, bitness, "No pending packages"
+
+        return pub_report
+
+    @run_metrics.timed("publish_all")
     def publish_all(self):
         """ Check every pending directory for new packages.
         If there are new packages, see if a publish would cause too many
         problems, and if so, don't publish it for real
 
-        @param fake_run option to publish to testing RPM directories, and
-        look into different places for pending packages
+        Up to dist_workers dists are published at once, PRIORITY_DISTS
+        first.  The outcome lists them in the order they were given
+        regardless.
+
         @return PublishOutcome showing what this did
         """
-    
-        pub_report = PublishOutcome()    
         result_dir = self.get_result_dir()
 
-        for dist in self.dists_to_publish: 
-            pend = self.get_pending_dir(dist)
-
-            pkg_ver_lim = self.get_pkg_ver_limit(dist)
-            rpm_ver = self.rpm_max_ver[dist]
-            scan = pending_scan.PendingScan(dist, pending_dir=pend,
-                                            rpm_ver = rpm_ver,
-                                            accept_level=pkg_ver_lim)
-            pub_report.add_scan(scan)
-
-            move_pending_srpms(scan)
-            move_pending_sources(scan)
-            bad_packages = scan.bad_rpms()
-            move_bad_pkgs_to_error(pend, bad_packages)
-
-            for (vers, bitness) in rpm_config.ver_bit_pairs():
-                print dist, vers, bitness
-                this_dist = (dist, vers, bitness)
-
-                if len(scan.accepted_set(vers, bitness)) > 0:
-                    dest_prefix = "%s/%s" % (
-                        result_dir, rpm_config.dist_suffix(*this_dist))
+        ordered = [d for d in self.dists_to_publish if d in PRIORITY_DISTS] + \
+                  [d for d in self.dists_to_publish if not d in PRIORITY_DISTS]
+        reports = rpm_util.parallel_map(
+            lambda dist: (dist, self.publish_dist(dist, result_dir)),
+            ordered, self.dist_workers)
+        reports = dict(reports)
 
-                    cur_unmet = dep_problems.unmet(*this_dist)
-                    new_unmet = pseudo_publish(scan, dist, vers, bitness,
-                                               pend, dest_prefix)
-
-                    dep_problem_code, msg = dep_problems.unmet_compare(
-                        cur_unmet, new_unmet)
-
-                    if self.accept_depend_probs(dep_problem_code, dist):
-                        self.do_accept_pub(this_dist, scan, pub_report, msg)
-                    else:
-                        self.do_reject_pub(this_dist, scan, pub_report, msg)
-                else:
-                    pub_report.add_pub_result(this_dist, "Nothing pending")
-                    print "No pending packages"
-    
+        pub_report = PublishOutcome()
+        for dist in self.dists_to_publish:
+            pub_report.merge(reports[dist])
         return pub_report
 
+@run_metrics.timed("real_publish")
 def real_publish(scan, dist, vers, bitness, testing_run=None):
-    """ Actually run genbasedir on the given distrobution.
-    Note, this could be done without another genbasedir,
-    but it would require a bit of magic.
+    """ Actually publish the given distrobution, updating its apt
+    pkglist for the packages that changed.  Accepted packages are moved
+    out of the pending directory, not copied.
 
     @param scan PendingScan for this dist
     @param dist floating dist, eg, stable
@@ -188,14 +246,16 @@ def real_publish(scan, dist, vers, bitness, testing_run=None):
     will_be_gone = scan.replaced_set(vers, bitness)
     accepted_set = scan.accepted_set(vers, bitness)
     
-    copy_accepted_to_publish(publish_dir, pending, accepted_set)
+    span = run_metrics.start("real_publish.move")
+    move_accepted_to_publish(publish_dir, pending, accepted_set, testing_run)
+    span.stop()
 
     if (dist != 'retired'):
         # This shouldn't happen since retired is a "special" dist
         dist_dir = rpm_config.rpm_dist_dir(dist, vers, bitness)
-        genbasedir_cmd = "genbasedir %s main" % dist_dir
-        run_system_cmd(genbasedir_cmd, fake_it = testing_run)
-        remove_accepted_pending_rpms(scan, vers, bitness)
+        genpkglist.update_basedir(dist_dir, 'main', fake_it = testing_run)
+
+    span = run_metrics.start("real_publish.attic")
 
     if ((dist == 'uranium') or (dist == 'unstable') or (dist == 'testing')):
         # follow convention, only atticize old packages if the dist
@@ -203,6 +263,7 @@ def real_publish(scan, dist, vers, bitness, testing_run=None):
         atticize_old_rpms(publish_dir, will_be_gone, testing_run)
     if (dist == 'stable'):
         retire_old_rpms(publish_dir, will_be_gone, testing_run)
+    span.stop()
 
 def time_now():
     """ @return current time as string in YYYYMMDDHHMM format """
@@ -210,13 +271,16 @@ def time_now():
     time_tup = time.localtime()
     return  time.strftime("%G%m%d%H%M",time_tup)
     
-def pseudo_publish(scan, dist, vers, bitness, pending, dest_prefix=None):
+@run_metrics.timed("pseudo_publish")
+def pseudo_publish(scan, dist, vers, bitness, pending, dest_prefix=None,
+                   workers=1):
     """ Make a new rpm distrobution in order to check its consistancy.
 
     @param scan PendingScan for pending
     @param pending prefix to the place to look for incoming packages
     @param dest_prefix optional prefix to dist directory, defaults to
     rpm_config.rpm_dist_dir.
+    @param workers number of rpm headers to read at once
 
     @return unmet dependencies in newly published packages
     """
@@ -228,8 +292,8 @@ def pseudo_publish(scan, dist, vers, bitness, pending, dest_prefix=None):
     # current_dist_dir is the real repository to do an overlay to
     current_dist_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
 
-    run_system_cmd('mkdir -p %s' % pseudo_publish_dir)
-    run_system_cmd('mkdir -p %s/%s/base' % (dest_prefix, pub_time))
+    fileops.make_dirs(pseudo_publish_dir)
+    fileops.make_dirs('%s/%s/base' % (dest_prefix, pub_time))
 
     if dist == 'retired':
         will_be_gone = [] # don't remove old packages from retired
@@ -238,8 +302,10 @@ def pseudo_publish(scan, dist, vers, bitness, pending, dest_prefix=None):
     accepted_set = scan.accepted_set(vers, bitness)
 
     
+    span = run_metrics.start("pseudo_publish.link")
     link_unchanged_existing(current_dist_dir, pseudo_publish_dir,will_be_gone)
-    copy_accepted_to_publish(pseudo_publish_dir, pending, accepted_set)
+    link_accepted_to_publish(pseudo_publish_dir, pending, accepted_set)
+    span.stop()
 
     dest_munged_for_apt = '%s %s' % (dest_prefix, pub_time)
 
@@ -247,12 +313,41 @@ def pseudo_publish(scan, dist, vers, bitness, pending, dest_prefix=None):
     # rpm file://rpm/repository/solaris/solaris9-sparc64/stable date main
     apt_contents = "rpm file:%s main\n" % dest_munged_for_apt
     
-    run_system_cmd("genbasedir %s/%s main" % (dest_prefix, pub_time), silence=1)
+    if dep_problems.config_dict["RESOLVER"] == "apt":
+        # entries for the hard linked packages come from the live dist
+        genpkglist.update_basedir("%s/%s" % (dest_prefix, pub_time), 'main',
+                                  seed_dir=rpm_config.rpm_dist_dir(
+                                      dist, vers, bitness), verbose=0)
     new_dep_probs = dep_problems.unmet(dist, vers, bitness,
-                                       src_list_contents = apt_contents)
+                                       src_list_contents = apt_contents,
+                                       main_dir = pseudo_publish_dir,
+                                       workers = workers)
     
     return new_dep_probs 
 
+def run_batch(batch):
+    """ Run fileops.MoveBatch batch, recording the moves in the
+    repository catalog """
+    if batch.fake_it:
+        batch.run()
+        return
+    paths = []
+    for src, dest in batch.moves:
+        paths.extend([src, dest])
+    update = repo_catalog.start_update(paths)
+    try:
+        batch.run()
+    finally:
+        update.finish()
+
+def move_files(moves, fake_it=0):
+    """ fileops.move_files, recording the moves in the repository
+    catalog """
+    batch = fileops.MoveBatch(fake_it)
+    for src, dest in moves:
+        batch.move(src, dest)
+    run_batch(batch)
+
 def atticize_old_rpms(publish_dir, will_be_gone, testing_run = None):
     """ Move each package both in directory publish_dir and also in
     will_be_gone to the attic
@@ -261,9 +356,8 @@ def atticize_old_rpms(publish_dir, will_be_gone, testing_run = None):
     actually execute it.
     """ 
     attic_dir = rpm_config.attic_dir
-    for gone_pkg in will_be_gone:
-        mv_cmd = 'mv %s/%s %s' % (publish_dir, gone_pkg, attic_dir)
-        run_system_cmd(mv_cmd, fake_it=testing_run)
+    move_files([('%s/%s' % (publish_dir, gone_pkg), attic_dir)
+                        for gone_pkg in will_be_gone], fake_it=testing_run)
 
 def retire_old_rpms(publish_dir, will_be_gone, testing_run = None):
     """ Move each package both in directory publish dir (the stable
@@ -273,14 +367,14 @@ def retire_old_rpms(publish_dir, will_be_gone, testing_run = None):
     actually execute it.
     """
     retired_dir = rpm_config.retired_dir
-    for retired_pkg in will_be_gone:
-        mv_cmd = 'mv %s/%s %s' % (publish_dir, retired_pkg, retired_dir)
-        run_system_cmd(mv_cmd, fake_it=testing_run)
+    move_files([('%s/%s' % (publish_dir, retired_pkg), retired_dir)
+                        for retired_pkg in will_be_gone],
+                       fake_it=testing_run)
 
 def move_bad_pkgs_to_error(pending_dir, bad_packages):
     error_dir = rpm_config.error_dir
-    for bad_pkg in bad_packages:
-        run_system_cmd('mv %s/%s %s' % (pending_dir, bad_pkg, error_dir))
+    fileops.move_files([('%s/%s' % (pending_dir, bad_pkg), error_dir)
+                        for bad_pkg in bad_packages])
 
 def link_unchanged_existing(current_dist_dir, publish_dir, will_be_gone):
     """ Link each file in current_dist_dir to the publish_dir, if
@@ -292,55 +386,84 @@ def link_unchanged_existing(current_dist_dir, publish_dir, will_be_gone):
             dest_path = "%s/%s" % (publish_dir, existing_rpm)
             os.link(full_path_to_existing, dest_path)
 
-def copy_accepted_to_publish(publish_dir, pending, accepted):
-    """ Copy each package in accepted from the pending to publish_dir """
+def link_accepted_to_publish(publish_dir, pending, accepted):
+    """ Hard link each package in accepted from the pending to publish_dir,
+    copying only if they are on different filesystems """
     for new_rpm in accepted:
         full_path_to_new = "%s/%s" % (pending, new_rpm)
         dest_path = "%s/%s" % (publish_dir, new_rpm)
         os.chmod(full_path_to_new, 0644)
-        shutil.copy(full_path_to_new, dest_path)
+        fileops.link_file(full_path_to_new, dest_path)
+
+def move_accepted_to_publish(publish_dir, pending, accepted, testing_run=None):
+    """ Move each package in accepted from the pending to publish_dir
+
+    @param testing_run option to just print the moves
+    """
+    batch = fileops.MoveBatch(fake_it=testing_run)
+    for new_rpm in accepted:
+        full_path_to_new = "%s/%s" % (pending, new_rpm)
+        if not testing_run: os.chmod(full_path_to_new, 0644)
+        batch.move(full_path_to_new, "%s/%s" % (publish_dir, new_rpm))
+    run_batch(batch)
 
 def move_pending_sources(scan):
     """ Move all the sources from the scan into the main sources directory """
+    batch = fileops.MoveBatch()
     for src in scan.sources():
         mv_from = '%s/%s' % (scan.pending_dir, src)
         os.chmod(mv_from, 0644)
-        mv_to = '%s/%s' % (rpm_config.sources_dir, src)
-        run_system_cmd('mv %s %s' % (mv_from, mv_to))
+        batch.move(mv_from, '%s/%s' % (rpm_config.sources_dir, src))
+    batch.run()
 
 def move_pending_srpms(scan):
     """ Move all the source rpms from the scan into the srpms directory """
+    batch = fileops.MoveBatch()
     for srpm in scan.srpms():
         mv_from = '%s/%s' % (scan.pending_dir, srpm)
         os.chmod(mv_from, 0644)
-        mv_to = '%s/%s' % (rpm_config.srpms_dir, srpm)
-        run_system_cmd('mv %s %s' % (mv_from, mv_to))
-
-def remove_accepted_pending_rpms(scan, vers, bitness):
-    """ Remove all accepted rpms from the pending directory.
-    Caller should be sure the RPMs in pending aren't the only copies"""
-    for rpm in scan.accepted_set(vers, bitness):
-        full_path_to_rpm = '%s/%s' % (scan.pending_dir, rpm)
-        # need to check existance incase of evil republishing of equal  
-        # package numbers which causes an accepted package to be moved
-        # to the attic
-        if os.access(full_path_to_rpm, os.O_RDONLY):
-            os.remove(full_path_to_rpm)     
+        batch.move(mv_from, '%s/%s' % (rpm_config.srpms_dir, srpm))
+    run_batch(batch)
+
+def write_metrics(metrics_dir, pub_result, fake_run):
+    """ Save the run record of this publish as publish_run.json and
+    publish.prom in metrics_dir """
+    outcomes = [{'dist': '%s-%s-%s' % dist_tuple, 'outcome': outcome}
+                for dist_tuple, outcome in pub_result.publish_outcomes()]
+    try:
+        if not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir)
+        run_metrics.write_json('%s/publish_run.json' % metrics_dir,
+                               fake_run=fake_run, outcomes=outcomes)
+        run_metrics.write_prometheus('%s/publish.prom' % metrics_dir)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning, can't write run metrics:", e
 
 def usage(argv):
     print "%s [-p] [dist1 [, dist2]]" % argv[0]
     print "Eg. %s unstable testing : publishes only testing and unstable" % argv[0]
     print "If not dists given, it is assumed you want to publish them all"
     print "-p : pseudo run, no changes to production repositories"
+    print "-j N : read up to N rpm headers at once, when scanning pending and"
+    print "       resolving dependencies"
+    print "-J N : publish up to N dists at once, stable first"
+    print "-a : check dependencies with apt-get and apt-cache"
+    print "--metrics dir : write the run record and Prometheus textfile to"
+    print "                dir, default %s" % rpm_config.metrics_dir
+    print "--profile dir : write cProfile stats of each phase to dir"
     print "-h : print this message"
 
 def main(argv):
     import getopt
     fake_run = 0
+    scan_workers = 1
+    dist_workers = 1
+    metrics_dir = rpm_config.metrics_dir
     pending_dists = []
 
     try:
-        opts, args = getopt.getopt(argv[1:], 'hf')
+        opts, args = getopt.getopt(argv[1:], 'hfj:J:a',
+                                   ['metrics=', 'profile='])
     except getopt.GetoptError:
         usage(argv)
         return 1
@@ -351,6 +474,24 @@ def main(argv):
             return 1
         elif opt == '-f':
             fake_run = 1
+        elif opt == '-a':
+            dep_problems.config_dict["RESOLVER"] = "apt"
+        elif opt == '--metrics':
+            metrics_dir = val
+        elif opt == '--profile':
+            run_metrics.enable_profiling(val)
+        elif opt == '-j':
+            try:
+                scan_workers = int(val)
+            except ValueError:
+                usage(argv)
+                return 1
+        elif opt == '-J':
+            try:
+                dist_workers = int(val)
+            except ValueError:
+                usage(argv)
+                return 1
     
     if len(args) == 0:
         pending_dists = rpm_config.fixed_to_floating.values()
@@ -363,10 +504,12 @@ def main(argv):
         pending_dists = args
 
     dep_problems.init()
-    publisher = Publisher(pending_dists, fake_run)
+    publisher = Publisher(pending_dists, fake_run, scan_workers,
+                          dist_workers)
     pub_result = publisher.publish_all()
 
     mail_publish.mail_publish_results(pub_result)
+    write_metrics(metrics_dir, pub_result, fake_run)
     return 0
         
 if __name__ == '__main__':
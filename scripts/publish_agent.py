@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+""" Long running publish agent.
+
+Watches the pending directories and runs a publish once uploads into
+them have finished, instead of polling from cron and sleeping two minutes
+in the hope that the files have made it.  A file is ready when its size
+and mtime have not changed for a quiet period and, for RPMs, its headers
+are complete and the file is as long as its signature says.  An RPM
+that is still incomplete INCOMPLETE_SECONDS after it last changed is an
+abandoned upload, and is left for publish to move to the error
+directory.  Uploads that arrive in a burst are published together once
+all of them are ready.  The PENDING and CHECK_PEND directories are
+published separately, each as soon as its own uploads are ready, and
+the SPEC files in CHECK_PEND are checked on every pass while anything
+there is waiting.
+
+Only one agent can hold the lock in VARRUNDIR at a time, so a second
+agent started by accident exits instead of publishing alongside the
+first.  Publishing still only happens while VARRUNDIR/enabled contains 1.
+
+Uses pyinotify to wake up on changes if it is installed, and polls the
+directories otherwise.
+"""
+
+import fcntl
+import getopt
+import os
+import sys
+import time
+
+import dep_problems
+run_system_cmd = dep_problems.run_system_cmd
+import rpm_config
+import rpm_header
+
+VARRUNDIR = "/var/run/publish"
+ENABLED = "%s/enabled" % VARRUNDIR
+LOCKFILE = "%s/agent.lock" % VARRUNDIR
+
+# Command for running the SPEC file check
+SPEC_CHECK = "/usr/local/bin/publish/checkspecfiles.py"
+
+# The commands to run the actual publish scripts
+PUBLISH_COMMAND = "/usr/local/bin/publish.sh ok"
+CHECKED_PUBLISH_COMMAND = "/usr/local/bin/publish/publish.py"
+
+AFTER_UNCHECKED_PUBLISH = ["rebuild-apt"]
+AFTER_ANY_PUBLISH = ["rpm2html /etc/rpm2html.config",
+                     "cleanup-rpm2html",
+                     "checkrelease.sh"]
+YUM_REPOS = ['stable', 'testing', 'unstable']
+CREATEREPO_COMMAND = """/usr/local/bin/createrepo --update \
+ /rpm/repository/solaris/solaris9-sparc64/%(repo)s/RPMS.main/ \
+ --outputdir=/rpm/repository/yum/solaris9-sparc64/%(repo)s/ \
+ --baseurl=ftp://rpm.rutgers.edu/solaris/solaris9-sparc64/%(repo)s/RPMS.main/"""
+
+DEFAULT_QUIET_SECONDS = 30
+DEFAULT_POLL_SECONDS = 10
+INCOMPLETE_SECONDS = 10 * 60
+
+def checked_dirs():
+    return [rpm_config.pending_dir(dist)
+            for dist in rpm_config.fixed_to_floating.values()]
+
+def unchecked_dirs():
+    return [rpm_config.unchecked_pending_dir(dist)
+            for dist in rpm_config.fixed_to_floating.values()]
+
+def enabled():
+    """ @return non-zero if the agent has been enabled """
+    try:
+        return open(ENABLED).read().strip() == '1'
+    except IOError:
+        return 0
+
+def take_lock(lockfile=LOCKFILE):
+    """ @return open file holding an exclusive lock on lockfile, or None
+    if another agent holds it.  The lock goes away with the process.
+    Raises IOError if lockfile can't be opened. """
+    fp = open(lockfile, 'a')
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        fp.close()
+        return None
+    return fp
+
+def snapshot(dirs):
+    """ @return dict keyed by path yielding (size, mtime) for every file
+    directly in dirs """
+    snap = {}
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            path = '%s/%s' % (d, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # moved away while we looked
+            if not os.path.isdir(path):
+                snap[path] = (st.st_size, st.st_mtime)
+    return snap
+
+def _changed(snap, old):
+    """ @return non-zero if snap has a file that isn't in old snapshot,
+    or is there with a different size or mtime """
+    for path, state in snap.items():
+        if old.get(path) != state:
+            return 1
+    return 0
+
+class UploadTracker:
+    """ Remembers when each pending file last changed, to tell when a
+    burst of uploads has finished """
+    def __init__(self, dirs, quiet_seconds,
+                 incomplete_seconds=INCOMPLETE_SECONDS):
+        self.dirs = dirs
+        self.quiet_seconds = quiet_seconds
+        self.incomplete_seconds = incomplete_seconds
+        self._seen = {}
+        self._changed_at = {}
+        self._published = {}
+        self._last_change = 0
+
+    def update(self, now=None):
+        """ Rescan the directories, noting anything new or changed.
+        Files going away don't count, nothing is left half written.
+
+        @return the new snapshot of the directories
+        """
+        if now == None: now = time.time()
+        snap = snapshot(self.dirs)
+        changed_at = {}
+        for path, state in snap.items():
+            if self._seen.get(path) == state:
+                changed_at[path] = self._changed_at[path]
+            else:
+                changed_at[path] = now
+                self._last_change = now
+        self._seen = snap
+        self._changed_at = changed_at
+        return snap
+
+    def pending(self):
+        """ @return non-zero if there are files waiting that weren't
+        there, unchanged, at the last publish """
+        return _changed(self._seen, self._published)
+
+    def mark_published(self, snap):
+        """ Note that the files in snap, taken before a publish started,
+        have been through it, so those it leaves behind don't trigger
+        another one.  Files that arrived since are still pending. """
+        self._published = snap
+
+    def ready(self, now=None):
+        """ @return non-zero if there are files waiting, nothing has
+        changed for the quiet period, and every waiting rpm is complete
+        or has been given up on.  Files left behind by the last publish
+        aren't looked at. """
+        if now == None: now = time.time()
+        if not self.pending(): return 0
+        if now - self._last_change < self.quiet_seconds: return 0
+        for path, state in self._seen.items():
+            if not path.endswith('.rpm') or \
+                   self._published.get(path) == state or \
+                   now - self._changed_at[path] >= self.incomplete_seconds:
+                continue
+            if not rpm_header.is_complete(path):
+                return 0
+        return 1
+
+class PollWatcher:
+    """ Wakes up every poll_seconds """
+    def __init__(self, dirs, poll_seconds):
+        self.poll_seconds = poll_seconds
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_seconds))
+
+class InotifyWatcher:
+    """ Wakes up when something is written to or moved into dirs """
+    def __init__(self, dirs, poll_seconds):
+        import pyinotify
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+               pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+               pyinotify.IN_MODIFY
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._wm,
+                                            lambda event: None)
+        for d in dirs:
+            if os.path.isdir(d):
+                self._wm.add_watch(d, mask)
+
+    def wait(self, timeout):
+        # check_events takes milliseconds
+        if self._notifier.check_events(int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+def make_watcher(dirs, poll_seconds):
+    try:
+        return InotifyWatcher(dirs, poll_seconds)
+    except (ImportError, OSError):
+        return PollWatcher(dirs, poll_seconds)
+
+def after_publish():
+    """ Update the rpmfind and yum databases after a publish """
+    for cmd in AFTER_ANY_PUBLISH:
+        run_system_cmd(cmd, critical=0)
+
+    print "Updating yum databases..."
+    for yumrepo in YUM_REPOS:
+        print "Updating %s yum database..." % yumrepo
+        run_system_cmd(CREATEREPO_COMMAND % {'repo': yumrepo}, critical=0)
+    print "Yum database update complete."
+
+def publish_cycle(unchecked, checked):
+    """ Run the spec check if anything is waiting to be checked, then
+    whichever publishes have files ready.  The checks take a while, so
+    each publish looks again first, and leaves uploads that arrived
+    meanwhile for the next pass.
+
+    @param unchecked UploadTracker for the PENDING directories
+    @param checked UploadTracker for the CHECK_PEND directories
+    """
+    if checked.pending():
+        print "Checking SPEC files..."
+        run_system_cmd(SPEC_CHECK, critical=0)
+
+    published = 0
+    snap = unchecked.update()
+    if unchecked.ready():
+        print "Unchecked files exist; running publish."
+        run_system_cmd(PUBLISH_COMMAND, critical=0)
+        for cmd in AFTER_UNCHECKED_PUBLISH:
+            run_system_cmd(cmd, critical=0)
+        unchecked.mark_published(snap)
+        published = 1
+
+    snap = checked.update()
+    if checked.ready():
+        print "Checked files exist; running check publish."
+        run_system_cmd(CHECKED_PUBLISH_COMMAND, critical=0)
+        checked.mark_published(snap)
+        published = 1
+
+    if published:
+        after_publish()
+
+def run(quiet_seconds, poll_seconds, once=0):
+    """ Watch the pending directories, publishing each whenever the
+    uploads in it have settled.
+
+    @param once if non-zero, return once nothing is left waiting, or
+    right away if the agent isn't enabled
+    """
+    unchecked = UploadTracker(unchecked_dirs(), quiet_seconds)
+    checked = UploadTracker(checked_dirs(), quiet_seconds)
+    watcher = make_watcher(unchecked.dirs + checked.dirs, poll_seconds)
+
+    while 1:
+        unchecked.update()
+        checked.update()
+
+        waiting = unchecked.pending() or checked.pending()
+        if waiting:
+            if enabled():
+                publish_cycle(unchecked, checked)
+            else:
+                print "The publish agent has not been enabled."
+                if once: return 0
+        elif once:
+            print "No files in pending directories."
+            return 0
+
+        watcher.wait(quiet_seconds)
+
+def usage(argv):
+    print "%s [-1] [-q seconds] [-p seconds]" % argv[0]
+    print "Publish uploads to the pending directories once they settle"
+    print "-1 : publish what is waiting, once it settles, and exit"
+    print "-q : seconds a file must be unchanged to be ready, default %d" % (
+        DEFAULT_QUIET_SECONDS)
+    print "-p : seconds between directory scans without inotify, " \
+          "default %d" % DEFAULT_POLL_SECONDS
+    print "-h : print this message"
+
+def main(argv):
+    quiet_seconds = DEFAULT_QUIET_SECONDS
+    poll_seconds = DEFAULT_POLL_SECONDS
+    once = 0
+
+    try:
+        opts, args = getopt.getopt(argv[1:], 'h1q:p:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-1':
+                once = 1
+            elif opt == '-q':
+                quiet_seconds = int(val)
+            elif opt == '-p':
+                poll_seconds = int(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    try:
+        lock = take_lock()
+    except IOError, e:
+        print >> sys.stderr, "Can't open the lock file:", e
+        return 1
+    if lock == None:
+        print "The publish agent is already running."
+        return 1
+
+    print "%s started." % argv[0]
+    return run(quiet_seconds, poll_seconds, once)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+""" Reverse dependencies of the packages in a dist.
+
+Builds an index from the headers of every package in a dist of what
+requires each capability, and of what each package provides (its name,
+its provides and its files), so "what requires X" needs a dict lookup
+instead of a run of apt.  The index is kept under rpm_config.cache_dir
+along with a fingerprint of the dist's RPMS.main, and is rebuilt when
+the fingerprint no longer matches.
+
+Requirers are matched by capability name only; versions are shown but
+not compared.
+"""
+
+import cPickle
+import getopt
+import os
+import sys
+
+import dep_problems
+import dep_resolver
+import rpm_config
+
+# bump whenever ReverseIndex changes, so old cached indexes are rebuilt
+INDEX_VERSION = 2
+
+class ReverseIndex:
+    """ What requires each capability in a set of packages """
+    def __init__(self, data=None):
+        """ @param data optional tuple from data() to start from """
+        if data == None: data = ({}, {}, {})
+        # capability -> list of (requiring rpm filename, dependency string)
+        # rpm filename -> list of capability names it provides
+        # package name -> list of rpm filenames
+        self._requirers, self._provided, self._by_name = data
+
+    def data(self):
+        """ @return the index as a tuple of plain dicts, which is what gets
+        cached, so the cache doesn't depend on the module that pickled it
+        being run as a script or imported """
+        return (self._requirers, self._provided, self._by_name)
+
+    def add_header(self, header):
+        """ Add the package with rpm_header.RpmHeader header """
+        filename = os.path.basename(header.filename)
+        provided = [header.name()]
+        provided.extend([name for name, op, version in header.provides()])
+        provided.extend(header.files())
+        self._provided[filename] = provided
+        self._by_name.setdefault(header.name(), []).append(filename)
+
+        for dep in header.requires():
+            if dep[0].startswith('rpmlib('): continue
+            self._requirers.setdefault(dep[0], []).append(
+                (filename, dep_resolver.dep_string(dep)))
+
+    def filenames(self, package):
+        """ @return rpm filenames in the index for package, which may be
+        a package name or an rpm filename """
+        if package in self._provided:
+            return [package]
+        return self._by_name.get(package, [])
+
+    def requiring_capability(self, capability):
+        """ @return sorted list of (rpm filename, dependency string) for
+        everything that requires capability """
+        result = self._requirers.get(capability, [])[:]
+        result.sort()
+        return result
+
+    def requiring_package(self, package):
+        """ @return sorted list of (rpm filename, dependency string) for
+        everything, other than package itself, that requires something
+        package provides
+
+        @param package package name or rpm filename
+        """
+        own = self.filenames(package)
+        seen = {}
+        for filename in own:
+            for capability in self._provided[filename]:
+                for requirer in self._requirers.get(capability, []):
+                    if not requirer[0] in own:
+                        seen[requirer] = 1
+        result = seen.keys()
+        result.sort()
+        return result
+
+def index_file(dist, vers, bitness):
+    return '%s/rdeps.%s.%s.%s' % (rpm_config.cache_dir, dist, vers, bitness)
+
+def build_index(main_dir, workers=1):
+    """ @return ReverseIndex of the rpms in main_dir """
+    index = ReverseIndex()
+    for header in dep_resolver.read_repository(main_dir, workers):
+        index.add_header(header)
+    return index
+
+def dist_index(dist, vers, bitness, workers=1):
+    """ @return ReverseIndex of the live RPMS.main of dist, from the cache
+    if the directory hasn't changed since it was built """
+    main_dir = rpm_config.rpm_main_dir(dist, vers, bitness)
+    fingerprint = (INDEX_VERSION, dep_problems.repository_fingerprint(main_dir))
+    filename = index_file(dist, vers, bitness)
+    try:
+        fp = open(filename, 'rb')
+        try:
+            saved_fingerprint, data = cPickle.load(fp)
+        finally:
+            fp.close()
+        if saved_fingerprint == fingerprint:
+            return ReverseIndex(data)
+    except (IOError, EOFError, ValueError, AttributeError,
+            cPickle.UnpicklingError):
+        pass
+
+    index = build_index(main_dir, workers)
+    try:
+        if not os.path.isdir(rpm_config.cache_dir):
+            os.makedirs(rpm_config.cache_dir)
+        fp = open(filename + '.new', 'wb')
+        cPickle.dump((fingerprint, index.data()), fp, 2)
+        fp.close()
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning, can't save reverse dependencies:", e
+    return index
+
+def replaced_report(index, replaced, max_per_package=20):
+    """ @return text listing what requires each of the rpm filenames in
+    replaced, or '' if nothing does """
+    lines = []
+    for filename in sorted(replaced):
+        requirers = index.requiring_package(filename)
+        if not requirers: continue
+        lines.append("%s is required by:" % filename)
+        for requirer, dep in requirers[:max_per_package]:
+            lines.append("    %s (%s)" % (requirer, dep))
+        if len(requirers) > max_per_package:
+            lines.append("    and %d more" % (
+                len(requirers) - max_per_package))
+    if not lines:
+        return ''
+    return '\n'.join(lines) + '\n'
+
+def usage(argv):
+    print "%s [-c] [-s sol_ver] [-b bitness] [-j N] dist name..." % argv[0]
+    print "Lists the packages in dist that require each name"
+    print "-c : names are capabilities, eg libfoo.so.1 or /usr/bin/perl,"
+    print "     not packages"
+    print "-s : Solaris version, default 9"
+    print "-b : bitness, default 64"
+    print "-j N : read up to N headers at once when building the index"
+    print "-h : print this message"
+
+def main(argv):
+    capabilities = 0
+    vers, bitness = rpm_config.ver_bit_pairs()[0]
+    workers = 1
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hcs:b:j:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-c':
+                capabilities = 1
+            elif opt == '-s':
+                vers = int(val)
+            elif opt == '-b':
+                bitness = val
+            elif opt == '-j':
+                workers = int(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    if len(args) < 2 or not args[0] in rpm_config.standard_dists:
+        usage(argv)
+        return 1
+
+    index = dist_index(args[0], vers, bitness, workers)
+    for name in args[1:]:
+        if capabilities:
+            requirers = index.requiring_capability(name)
+        else:
+            if not index.filenames(name):
+                print "%s: no such package in %s" % (name, args[0])
+                continue
+            requirers = index.requiring_package(name)
+        print "%s:" % name
+        for requirer, dep in requirers:
+            print "    %s (%s)" % (requirer, dep)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
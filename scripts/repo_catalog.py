@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+
+""" Catalog of every rpm in the repository, in a sqlite database.
+
+The RPMS.main of each floating dist, the attic, the retired directory
+and SRPMS are catalogued: for each rpm its name, version, release, the
+rpm_vercmp key of the version and release, Solaris version and bitness
+(from the filename), source rpm and MD5 digest (from
+the header), size and mtime.  Lookups by directory and package name are
+indexed, so the tools needn't list or glob directories of thousands of
+files.
+
+Each directory's mtime is stored with its entries.  The first time a
+directory is used in a run, a different mtime means something changed
+it behind the catalog's back, and only then is it listed again.  Only
+new or changed files have their header read, up to workers at once and
+without holding up other lookups.  Headers already in
+rpm_cache are taken from it, but those read here aren't added to it, so
+cataloguing a large attic can't push out the entries publish relies on.
+Publish and the move tools bracket their changes with start_update and
+finish, which records them in one transaction without listing anything.
+
+repo_catalog.py -r rebuilds the whole catalog from disk, -j N reading N
+headers at once.
+"""
+
+import atexit
+import cPickle
+import getopt
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import rpm_cache
+import rpm_config
+import rpm_header
+import rpm_util
+
+# bump whenever the schema or what goes in it changes
+CATALOG_VERSION = 2
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (version INTEGER);
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS rpms (
+    directory TEXT, filename TEXT, dist TEXT, sol_ver TEXT, bitness TEXT,
+    name TEXT, version TEXT, release TEXT, vkey BLOB, sourcerpm TEXT,
+    size INTEGER, mtime INTEGER, digest TEXT,
+    PRIMARY KEY (directory, filename));
+CREATE INDEX IF NOT EXISTS rpms_dir_name ON rpms (directory, name, filename);
+CREATE INDEX IF NOT EXISTS rpms_name ON rpms (name);
+CREATE INDEX IF NOT EXISTS rpms_sourcerpm ON rpms (sourcerpm);
+"""
+_insert = "INSERT OR REPLACE INTO rpms VALUES " \
+          "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+def catalogued_dirs():
+    """ @return dict keyed by each catalogued directory yielding the
+    dist its rpms are recorded under """
+    dirs = {rpm_config.attic_dir: 'attic',
+            rpm_config.retired_dir: 'retired',
+            rpm_config.srpms_dir: 'srpms'}
+    for vers, bitness in rpm_config.ver_bit_pairs():
+        for dist in rpm_config.fixed_to_floating.values():
+            dirs[rpm_config.rpm_main_dir(dist, vers, bitness)] = dist
+    return dirs
+
+def _row(directory, dist, filename, st):
+    """ @return rpms table row for filename in directory """
+    record = rpm_util.parse(filename)
+    name = version = release = vkey = sol_ver = bitness = None
+    if record != None:
+        name, release = record.name, record.release
+        sol_ver, bitness = record.sol_ver, record.bitness
+        if record.version != None: version = '.'.join(record.version)
+        if record.key != None:
+            vkey = sqlite3.Binary(cPickle.dumps(record.key, 2))
+
+    sourcerpm = digest = None
+    path = '%s/%s' % (directory, filename)
+    try:
+        header = rpm_cache.cached_header(path, st)
+        if header == None:
+            header = rpm_header.read_header(path, tags=(rpm_header.SOURCERPM,),
+                                            sigtags=(rpm_header.SIGTAG_MD5,))
+        sourcerpm = header.sourcerpm()
+        md5 = header.sigtags.get(rpm_header.SIGTAG_MD5)
+        if md5: digest = md5.encode('hex')
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning, can't read header:", e
+    return (directory, filename, dist, sol_ver, bitness, name, version,
+            release, vkey, sourcerpm, st.st_size, int(st.st_mtime), digest)
+
+class Catalog:
+    """ sqlite backed catalog of the rpms in catalogued_dirs().  Safe to
+    share between threads.  workers is the number of headers to read at
+    once when a directory has to be listed again. """
+    def __init__(self, filename, dirs=None, workers=1):
+        self.filename = filename
+        if dirs == None: dirs = catalogued_dirs()
+        self.dirs = dirs
+        self.workers = workers
+        self.rescans = 0
+        self._checked = {}
+        self._dir_locks = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.executescript(_schema)
+
+        row = self._db.execute("SELECT version FROM meta").fetchone()
+        if row == None or row[0] != CATALOG_VERSION:
+            self._db.execute("DELETE FROM rpms")
+            self._db.execute("DELETE FROM directories")
+            self._db.execute("DELETE FROM meta")
+            self._db.execute("INSERT INTO meta VALUES (?)",
+                             (CATALOG_VERSION,))
+            self._db.commit()
+
+    def covers(self, directory):
+        """ @return non-zero if directory is catalogued """
+        return directory in self.dirs
+
+    def _stored_mtime(self, directory):
+        row = self._db.execute("SELECT mtime FROM directories WHERE "
+                               "directory=?", (directory,)).fetchone()
+        return row and row[0]
+
+    def _set_mtime(self, directory, mtime):
+        """ Note the catalog matches directory as of mtime, unless that is
+        too recent to be sure of: on filesystems with whole second
+        mtimes, a change later in the same second keeps the mtime """
+        if mtime != None and mtime == int(mtime) and \
+               mtime >= int(time.time()) - 1:
+            mtime = None
+        self._db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)",
+                         (directory, mtime))
+
+    def _is_current(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            mtime = None
+        stored = self._stored_mtime(directory)
+        return stored != None and stored == mtime
+
+    def _check(self, directory):
+        """ List directory again if it changed since it was catalogued.
+        Must be called without the lock held; only one thread lists a
+        directory at a time. """
+        self._lock.acquire()
+        try:
+            if directory in self._checked: return
+            dir_lock = self._dir_locks.setdefault(directory,
+                                                  threading.Lock())
+        finally:
+            self._lock.release()
+
+        dir_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                if directory in self._checked: return
+                current = self._is_current(directory)
+            finally:
+                self._lock.release()
+            if not current:
+                self._rescan(directory)
+            self._lock.acquire()
+            self._checked[directory] = 1
+            self._lock.release()
+        finally:
+            dir_lock.release()
+
+    def _rescan(self, directory):
+        """ Bring the entries of directory up to date with the disk,
+        reading headers only of new or changed files.  The headers are
+        read without the lock held.  The directory's mtime is taken
+        before it is listed, so anything changed meanwhile is seen by
+        the next run. """
+        dist = self.dirs[directory]
+        try:
+            mtime = os.stat(directory).st_mtime
+            filenames = os.listdir(directory)
+        except OSError:
+            mtime, filenames = None, []
+
+        stored = {}
+        self._lock.acquire()
+        try:
+            for filename, size, file_mtime in self._db.execute(
+                "SELECT filename, size, mtime FROM rpms WHERE directory=?",
+                (directory,)):
+                stored[filename] = (size, file_mtime)
+        finally:
+            self._lock.release()
+
+        changed = []
+        for filename in filenames:
+            if not filename.endswith('.rpm'): continue
+            try:
+                st = os.stat('%s/%s' % (directory, filename))
+            except OSError:
+                continue # moved away while we looked
+            if stored.pop(filename, None) != (st.st_size, int(st.st_mtime)):
+                changed.append((filename, st))
+        rows = rpm_util.parallel_map(
+            lambda item: _row(directory, dist, item[0], item[1]),
+            changed, self.workers)
+
+        self._lock.acquire()
+        try:
+            try:
+                self._db.executemany(_insert, rows)
+                self._db.executemany(
+                    "DELETE FROM rpms WHERE directory=? AND filename=?",
+                    [(directory, filename) for filename in stored])
+                if mtime != None:
+                    self._set_mtime(directory, mtime)
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+            self.rescans += 1
+        finally:
+            self._lock.release()
+
+    def _refresh_path(self, path):
+        """ Update the entry of a file that may have changed """
+        directory, filename = os.path.split(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st == None or not filename.endswith('.rpm'):
+            self._db.execute(
+                "DELETE FROM rpms WHERE directory=? AND filename=?",
+                (directory, filename))
+        else:
+            self._db.execute(_insert, _row(directory, self.dirs[directory],
+                                           filename, st))
+
+    def current_dirs(self, paths):
+        """ @return dict keyed by the catalogued directories of paths that
+        the catalog is up to date with """
+        current = {}
+        self._lock.acquire()
+        try:
+            for path in paths:
+                directory = os.path.dirname(path)
+                if self.covers(directory) and not directory in current and \
+                       self._is_current(directory):
+                    current[directory] = 1
+        finally:
+            self._lock.release()
+        return current
+
+    def changed(self, paths, current):
+        """ Record that paths were created, replaced or removed, in one
+        transaction
+
+        @param current dict of directories that were up to date before
+        the change, from current_dirs; they are marked up to date again
+        """
+        self._lock.acquire()
+        try:
+            try:
+                dirs = {}
+                for path in paths:
+                    directory = os.path.dirname(path)
+                    if not self.covers(directory): continue
+                    self._refresh_path(path)
+                    dirs[directory] = 1
+                for directory in dirs:
+                    if directory in current:
+                        self._set_mtime(directory,
+                                        os.stat(directory).st_mtime)
+                    else:
+                        self._set_mtime(directory, None)
+                    self._checked.pop(directory, None)
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+        finally:
+            self._lock.release()
+
+    def rebuild(self):
+        """ Forget everything and read every catalogued directory and
+        header again, whatever the mtimes say """
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM directories")
+            self._db.execute("DELETE FROM rpms")
+            self._db.commit()
+            self._checked = {}
+        finally:
+            self._lock.release()
+        dirs = self.dirs.keys()
+        dirs.sort()
+        for directory in dirs:
+            self._check(directory)
+
+    def _query(self, directory, sql, args):
+        if directory != None: self._check(directory)
+        self._lock.acquire()
+        try:
+            return self._db.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def filenames(self, directory):
+        """ @return sorted list of the rpms in directory """
+        return [row[0] for row in self._query(directory,
+            "SELECT filename FROM rpms WHERE directory=? ORDER BY filename",
+            (directory,))]
+
+    def same_name(self, directory, name):
+        """ @return sorted list of the rpms in directory whose package
+        name is name """
+        return [row[0] for row in self._query(directory,
+            "SELECT filename FROM rpms WHERE directory=? AND name=? "
+            "ORDER BY filename", (directory, name))]
+
+    def versions(self, directory, name=None):
+        """ @return list of (filename, package name, version key,
+        version-release string) for the rpms in directory whose version
+        is known, only those called name if it is given.  The keys are
+        rpm_util.extract_rpm_version's, stored when the rpm was
+        catalogued. """
+        sql = "SELECT filename, name, vkey, version || '-' || release " \
+              "FROM rpms WHERE directory=? AND vkey IS NOT NULL"
+        args = (directory,)
+        if name != None:
+            sql = sql + " AND name=?"
+            args = args + (name,)
+        return [(filename, rpm_name, cPickle.loads(str(vkey)), ver_str)
+                for filename, rpm_name, vkey, ver_str in
+                self._query(directory, sql + " ORDER BY filename", args)]
+
+    def sourcerpms(self, directory):
+        """ @return list of (filename, source rpm) for the rpms in
+        directory """
+        return self._query(directory,
+            "SELECT filename, sourcerpm FROM rpms WHERE directory=? "
+            "ORDER BY filename", (directory,))
+
+    def find(self, name):
+        """ @return list of (dist, filename, digest) for every rpm whose
+        package name is name, anywhere in the catalog """
+        for directory in self.dirs:
+            self._check(directory)
+        return self._query(None,
+            "SELECT dist, filename, digest FROM rpms WHERE name=? "
+            "ORDER BY dist, filename", (name,))
+
+    def has_file(self, directory, filename):
+        return len(self._query(directory,
+            "SELECT 1 FROM rpms WHERE directory=? AND filename=?",
+            (directory, filename))) > 0
+
+    def counts(self):
+        """ @return list of (dist, number of rpms) """
+        return self._query(None,
+            "SELECT dist, COUNT(*) FROM rpms GROUP BY dist ORDER BY dist", ())
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.commit()
+            self._db.close()
+        finally:
+            self._lock.release()
+
+_default_catalog = None
+_default_catalog_failed = 0
+_default_catalog_lock = threading.Lock()
+
+def default_catalog():
+    """ @return the Catalog stored under rpm_config.cache_dir, or None if
+    it can't be opened, in which case the tools read directories """
+    global _default_catalog, _default_catalog_failed
+    _default_catalog_lock.acquire()
+    try:
+        if _default_catalog == None and not _default_catalog_failed:
+            try:
+                if not os.path.isdir(rpm_config.cache_dir):
+                    os.makedirs(rpm_config.cache_dir)
+                _default_catalog = Catalog(rpm_config.catalog_file())
+                atexit.register(close)
+            except (OSError, sqlite3.Error), e:
+                print >> sys.stderr, "Warning, repository catalog disabled:", e
+                _default_catalog_failed = 1
+        return _default_catalog
+    finally:
+        _default_catalog_lock.release()
+
+def has_srpm(name):
+    """ @return non-zero if source rpm name has been published, looked
+    up in the default catalog if there is one """
+    catalog = covering(rpm_config.srpms_dir)
+    if catalog == None:
+        return os.path.exists('%s/%s' % (rpm_config.srpms_dir, name))
+    return catalog.has_file(rpm_config.srpms_dir, name)
+
+def covering(directory):
+    """ @return the default Catalog if it catalogues directory, or None """
+    catalog = default_catalog()
+    if catalog != None and catalog.covers(directory):
+        return catalog
+    return None
+
+class Update:
+    """ Changes about to be made to files in the repository """
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.catalog = default_catalog()
+        self.current = {}
+        if self.catalog != None:
+            self.current = self.catalog.current_dirs(self.paths)
+
+    def finish(self):
+        """ Record the changes, once they have been made """
+        if self.catalog != None:
+            self.catalog.changed(self.paths, self.current)
+
+def start_update(paths):
+    """ @return Update for the files at paths, which are about to be
+    created, replaced or removed.  Call its finish() afterwards, even if
+    the changes fail part way. """
+    return Update(paths)
+
+def close():
+    """ Write out the default catalog, it will be reopened if needed """
+    global _default_catalog
+    if _default_catalog != None:
+        _default_catalog.close()
+        _default_catalog = None
+
+def usage(argv):
+    print "%s [-r] [-j N] [name...]" % argv[0]
+    print "Show where the rpms called name are, or count the rpms per dist"
+    print "-r : rebuild the catalog from the repository first"
+    print "-j N : read up to N rpm headers at once"
+    print "-h : print this message"
+
+def main(argv):
+    rebuild = 0
+    workers = 1
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hrj:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-r':
+                rebuild = 1
+            elif opt == '-j':
+                workers = int(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+
+    catalog = default_catalog()
+    if catalog == None: return 1
+    catalog.workers = workers
+    if rebuild: catalog.rebuild()
+    if not args:
+        for dist, count in catalog.counts():
+            print "%s: %d rpms" % (dist, count)
+    for name in args:
+        for dist, filename, digest in catalog.find(name):
+            print dist, filename, digest or '-'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -7,6 +7,7 @@ import shutil
 import sys
 
 import cp_rpm
+import repo_catalog
 import rpm_config
 
 def usage():
@@ -31,8 +32,13 @@ def main(argv):
                     existing_name = cp_rpm.make_from(pkg, dist, vers, bitness)
                     attic_name = cp_rpm.make_to(pkg, 'attic', vers, bitness)
 
-                    shutil.copy(existing_name, attic_name)
-                    os.remove(existing_name)
+                    update = repo_catalog.start_update([existing_name,
+                                                        attic_name])
+                    try:
+                        shutil.copy(existing_name, attic_name)
+                        os.remove(existing_name)
+                    finally:
+                        update.finish()
                 except IOError, e:
                     print >> sys.stderr, e
                     hit_error = 1
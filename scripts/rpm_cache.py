@@ -0,0 +1,186 @@
+""" Persistent cache of RPM header metadata.
+
+RPM files in the repository and in the pending directories never change
+once they are written, but the scans look at the same files on every
+run.  This keeps the decoded headers in a sqlite database keyed by the
+identity of the file (device, inode, size, mtime), so an unchanged file
+is never opened twice.  A file that is rewritten gets a new key, and its
+old entry is dropped the next time it is read.
+"""
+
+import atexit
+import cPickle
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import rpm_config
+import rpm_header
+
+DEFAULT_MAX_ENTRIES = 50000
+# bump whenever rpm_header.DEFAULT_TAGS or RpmHeader changes, so headers
+# cached by an older version get read again
+CACHE_VERSION = 2
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (version INTEGER);
+CREATE TABLE IF NOT EXISTS headers (
+    dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+    last_used INTEGER, data BLOB,
+    PRIMARY KEY (dev, ino, size, mtime));
+CREATE INDEX IF NOT EXISTS headers_last_used ON headers (last_used);
+"""
+
+def file_identity(st):
+    """ @return (device, inode, size, mtime) key for os.stat result st """
+    return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime))
+
+class HeaderCache:
+    """ sqlite backed cache of rpm_header.RpmHeader keyed by file
+    identity.  Safe to share between threads. """
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._run_time = int(time.time())
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(_schema)
+        self._inserted = 0
+
+        row = self._db.execute("SELECT version FROM meta").fetchone()
+        if row == None or row[0] != CACHE_VERSION:
+            self._db.execute("DELETE FROM headers")
+            self._db.execute("DELETE FROM meta")
+            self._db.execute("INSERT INTO meta VALUES (?)", (CACHE_VERSION,))
+            self._db.commit()
+
+    def lookup(self, path, st=None):
+        """ @return cached rpm_header.RpmHeader for path, or None if it
+        isn't cached.  Never reads the file or adds an entry.
+
+        @param st optional os.stat result for path, if the caller
+        already has one
+        """
+        if st == None: st = os.stat(path)
+        key = file_identity(st)
+
+        self._lock.acquire()
+        try:
+            row = self._db.execute(
+                "SELECT data, last_used FROM headers WHERE dev=? AND ino=? "
+                "AND size=? AND mtime=?", key).fetchone()
+            if row == None: return None
+            self.hits += 1
+            if row[1] < self._run_time:
+                self._db.execute(
+                    "UPDATE headers SET last_used=? WHERE dev=? AND "
+                    "ino=? AND size=? AND mtime=?",
+                    (self._run_time,) + key)
+            header = cPickle.loads(str(row[0]))
+            header.filename = path
+            return header
+        finally:
+            self._lock.release()
+
+    def get_header(self, path, st=None):
+        """ @return rpm_header.RpmHeader for path, reading the file only
+        if it is not already cached
+
+        @param st optional os.stat result for path, if the caller
+        already has one
+        """
+        if st == None: st = os.stat(path)
+        header = self.lookup(path, st)
+        if header != None: return header
+        key = file_identity(st)
+
+        header = rpm_header.read_header(path)
+        data = cPickle.dumps(header, 2)
+
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            # a different size or mtime on the same inode is a stale entry
+            self._db.execute("DELETE FROM headers WHERE dev=? AND ino=?",
+                             key[:2])
+            self._db.execute("INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                             key + (self._run_time, sqlite3.Binary(data)))
+            self._inserted += 1
+            if self._inserted % 500 == 0: self._db.commit()
+        finally:
+            self._lock.release()
+        return header
+
+    def evict(self):
+        """ Drop the least recently used entries beyond max_entries """
+        self._lock.acquire()
+        try:
+            count = self._db.execute(
+                "SELECT COUNT(*) FROM headers").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM headers WHERE rowid IN (SELECT rowid FROM "
+                    "headers ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """ Evict old entries and write everything out """
+        if self._inserted: self.evict()
+        self._lock.acquire()
+        try:
+            self._db.commit()
+            self._db.close()
+        finally:
+            self._lock.release()
+
+_default_cache = None
+_default_cache_failed = 0
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    """ @return the HeaderCache stored under rpm_config.cache_dir, or None
+    if it can't be opened, in which case headers are read uncached """
+    global _default_cache, _default_cache_failed
+    _default_cache_lock.acquire()
+    try:
+        if _default_cache == None and not _default_cache_failed:
+            try:
+                if not os.path.isdir(rpm_config.cache_dir):
+                    os.makedirs(rpm_config.cache_dir)
+                _default_cache = HeaderCache(rpm_config.header_cache_file())
+                atexit.register(close)
+            except (OSError, sqlite3.Error), e:
+                print >> sys.stderr, "Warning, header cache disabled:", e
+                _default_cache_failed = 1
+        return _default_cache
+    finally:
+        _default_cache_lock.release()
+
+def get_header(path, st=None):
+    """ @return rpm_header.RpmHeader for path, from the default cache if
+    there is one """
+    cache = default_cache()
+    if cache == None:
+        return rpm_header.read_header(path)
+    return cache.get_header(path, st)
+
+def cached_header(path, st=None):
+    """ @return rpm_header.RpmHeader for path if the default cache has
+    it, or None.  For bulk readers that shouldn't push out the entries
+    the publish scans rely on. """
+    cache = default_cache()
+    if cache == None: return None
+    return cache.lookup(path, st)
+
+def close():
+    """ Write out the default cache, it will be reopened if needed """
+    global _default_cache
+    if _default_cache != None:
+        _default_cache.close()
+        _default_cache = None
@@ -17,15 +17,44 @@ fixed_to_floating = {'hydrogen':'stable',
                      'lithium':'unstable',
 		     'uranium':'uranium'}
 
+pending_root = '/rpm'
 repository_dir = '/rpm/repository/solaris'
 error_dir = '/rpm/pending.error'
 attic_dir = '/rpm/repository/solaris/.attic'
 retired_dir = '/rpm/repository/solaris/.retired'
 srpms_dir = '/rpm/repository/solaris/SRPMS'
 sources_dir = '/rpm/repository/solaris/SOURCES'
+# state kept between runs, unlike dep_problems' TEMPDIR this is never wiped
+cache_dir = '/var/local/publish_cache'
+# where publish.py leaves its run record and Prometheus textfile
+metrics_dir = '/var/local/publish_cache/metrics'
+# mail waiting for mail_spool's sender
+mail_spool_dir = '/var/local/publish_cache/mail'
+# set by relocate, prefixed to all of the above
+root = ''
 sol_versions = (9,)
 bitnesses = ('64',)
 
+def relocate(new_root):
+    """ Move every directory above under new_root, eg to run against a
+    synthetic repository instead of the real one """
+    global root, pending_root, repository_dir, error_dir, attic_dir, \
+           retired_dir, srpms_dir, sources_dir, cache_dir, metrics_dir, \
+           mail_spool_dir
+    old_root = root
+    def moved(path): return new_root + path[len(old_root):]
+    pending_root = moved(pending_root)
+    repository_dir = moved(repository_dir)
+    error_dir = moved(error_dir)
+    attic_dir = moved(attic_dir)
+    retired_dir = moved(retired_dir)
+    srpms_dir = moved(srpms_dir)
+    sources_dir = moved(sources_dir)
+    cache_dir = moved(cache_dir)
+    metrics_dir = moved(metrics_dir)
+    mail_spool_dir = moved(mail_spool_dir)
+    root = new_root
+
 def ver_bit_pairs():
     return [(9, '64'),]
 
@@ -46,12 +75,22 @@ def rpm_main_dir(dist, vers, bitness):
 def dist_suffix(dist, vers, bitness):
     return 'solaris%s-sparc%s/%s' % (vers, bitness, dist)
 
+def header_cache_file():
+    return '%s/headers.sqlite' % cache_dir
+
+def catalog_file():
+    return '%s/catalog.sqlite' % cache_dir
+
+def floating_dist(dist):
+    """ @return the floating dist for a fixed dist, or dist itself """
+    assert dist in dist_list and dist != 'attic'
+    return fixed_to_floating.get(dist, dist)
+
 def pending_dir(dist):
     """ dist is either a floating or fixed dist, either works """
-    assert dist in dist_list and dist != 'attic'
-    if dist in fixed_to_floating:
-        floating_dist = fixed_to_floating[dist]
-    else:
-        floating_dist = dist
+    return "%s/CHECK_PEND.%s" % (pending_root, floating_dist(dist))
 
-    return "/rpm/CHECK_PEND.%s" % floating_dist
+def unchecked_pending_dir(dist):
+    """ @return the pending directory that publish.sh publishes from
+    without any checks.  dist is either a floating or fixed dist """
+    return "%s/PENDING.%s" % (pending_root, floating_dist(dist))
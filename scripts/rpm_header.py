@@ -0,0 +1,354 @@
+""" Read the metadata of an RPM file without forking rpm.
+
+An RPM file is a 96 byte lead, a signature header padded to an 8 byte
+boundary, the main header, and then the compressed payload.  Everything
+the publish scripts want to know (SOURCERPM, name/version/release,
+requires and provides) is in the main header, so only the first few
+kilobytes of each file ever get read.
+"""
+
+import os
+import struct
+
+LEAD_SIZE = 96
+LEAD_MAGIC = '\xed\xab\xee\xdb'
+HEADER_MAGIC = '\x8e\xad\xe8\x01'
+
+# header entry data types
+NULL, CHAR, INT8, INT16, INT32, INT64, STRING, BIN, STRING_ARRAY, \
+      I18NSTRING = range(10)
+
+# main header tags
+NAME = 1000
+VERSION = 1001
+RELEASE = 1002
+EPOCH = 1003
+ARCH = 1022
+OLDFILENAMES = 1027
+SOURCERPM = 1044
+PROVIDENAME = 1047
+REQUIREFLAGS = 1048
+REQUIRENAME = 1049
+REQUIREVERSION = 1050
+PROVIDEFLAGS = 1112
+PROVIDEVERSION = 1113
+DIRINDEXES = 1116
+BASENAMES = 1117
+DIRNAMES = 1118
+
+# signature header tags
+SIGTAG_SIZE = 1000
+SIGTAG_MD5 = 1004
+
+# dependency sense flags
+RPMSENSE_LESS = 2
+RPMSENSE_GREATER = 4
+RPMSENSE_EQUAL = 8
+RPMSENSE_PREREQ = 64
+
+FILE_TAGS = (OLDFILENAMES, DIRINDEXES, BASENAMES, DIRNAMES)
+# tags decoded by default, enough for pending_scan and dependency checks
+DEFAULT_TAGS = (NAME, VERSION, RELEASE, EPOCH, ARCH, SOURCERPM,
+                PROVIDENAME, PROVIDEFLAGS, PROVIDEVERSION,
+                REQUIRENAME, REQUIREFLAGS, REQUIREVERSION) + FILE_TAGS
+DEFAULT_SIGTAGS = (SIGTAG_SIZE, SIGTAG_MD5)
+
+class RpmHeaderError(IOError):
+    """ Raised when a file is not an RPM or its headers are truncated """
+    pass
+
+def sense_op(flags):
+    """ @return comparison operator string (eg, '>=') for dependency
+    flags, or '' for an unversioned dependency """
+    op = ''
+    if flags & RPMSENSE_LESS: op = op + '<'
+    if flags & RPMSENSE_GREATER: op = op + '>'
+    if flags & RPMSENSE_EQUAL: op = op + '='
+    return op
+
+class RpmHeader:
+    """ Decoded tags from the signature and main headers of an RPM """
+    # raw main header, only kept when read_header is asked to
+    blob = None
+
+    def __init__(self, filename, tags, sigtags, header_start, header_end):
+        self.filename = filename
+        self.tags = tags
+        self.sigtags = sigtags
+        self.header_start = header_start
+        self.header_end = header_end
+
+    def get(self, tag, default=None):
+        return self.tags.get(tag, default)
+
+    def name(self):
+        return self.tags.get(NAME)
+
+    def version(self):
+        return self.tags.get(VERSION)
+
+    def release(self):
+        return self.tags.get(RELEASE)
+
+    def epoch(self):
+        """ @return epoch as an int, or None if the package has none """
+        epoch = self.tags.get(EPOCH)
+        if epoch: return epoch[0]
+        return None
+
+    def arch(self):
+        return self.tags.get(ARCH)
+
+    def nevra(self):
+        """ @return tuple of (name, epoch, version, release, arch) """
+        return (self.name(), self.epoch(), self.version(), self.release(),
+                self.arch())
+
+    def sourcerpm(self):
+        """ @return name of source rpm that built this, or None if this is
+        itself a source rpm """
+        return self.tags.get(SOURCERPM)
+
+    def requires(self):
+        """ @return list of (name, operator, version) tuples, formatted
+        like the output of rpm -qpR """
+        return self._deps(REQUIRENAME, REQUIREFLAGS, REQUIREVERSION)
+
+    def provides(self):
+        """ @return list of (name, operator, version) tuples """
+        return self._deps(PROVIDENAME, PROVIDEFLAGS, PROVIDEVERSION)
+
+    def files(self):
+        """ @return list of full paths of the files in the package """
+        if OLDFILENAMES in self.tags:
+            return self.tags[OLDFILENAMES]
+        basenames = self.tags.get(BASENAMES, [])
+        dirnames = self.tags.get(DIRNAMES, [])
+        dirindexes = self.tags.get(DIRINDEXES, [])
+        return [dirnames[dirindexes[i]] + basenames[i]
+                for i in range(len(basenames))]
+
+    def rpmlib_requires(self):
+        """ @return the requires on rpmlib() capabilities """
+        return [dep for dep in self.requires()
+                if dep[0].startswith('rpmlib(')]
+
+    def payload_size(self):
+        """ @return size of main header plus payload claimed by the
+        signature, or None if the signature does not say """
+        size = self.sigtags.get(SIGTAG_SIZE)
+        if size: return size[0]
+        return None
+
+    def _deps(self, name_tag, flag_tag, version_tag):
+        names = self.tags.get(name_tag, [])
+        flags = self.tags.get(flag_tag, [])
+        versions = self.tags.get(version_tag, [])
+        deps = []
+        for i in range(len(names)):
+            if i < len(flags) and i < len(versions) and versions[i]:
+                deps.append((names[i], sense_op(flags[i]), versions[i]))
+            else:
+                deps.append((names[i], '', ''))
+        return deps
+
+def _read_exactly(fp, size, filename):
+    data = fp.read(size)
+    if len(data) != size:
+        raise RpmHeaderError, "%s: truncated rpm header" % filename
+    return data
+
+def _decode_entry(store, data_type, offset, count):
+    if data_type == INT32:
+        return list(struct.unpack('>%dI' % count,
+                                  store[offset:offset + 4*count]))
+    elif data_type == INT16:
+        return list(struct.unpack('>%dH' % count,
+                                  store[offset:offset + 2*count]))
+    elif data_type in (CHAR, INT8):
+        return list(struct.unpack('>%dB' % count,
+                                  store[offset:offset + count]))
+    elif data_type == INT64:
+        return list(struct.unpack('>%dQ' % count,
+                                  store[offset:offset + 8*count]))
+    elif data_type == BIN:
+        return store[offset:offset + count]
+    elif data_type == STRING:
+        return store[offset:store.index('\0', offset)]
+    elif data_type in (STRING_ARRAY, I18NSTRING):
+        strings = []
+        for i in range(count):
+            end = store.index('\0', offset)
+            strings.append(store[offset:end])
+            offset = end + 1
+        if data_type == I18NSTRING:
+            return strings[0]
+        return strings
+    return None
+
+def _decode_tags(nindex, index, store, wanted, filename):
+    tags = {}
+    for i in range(nindex):
+        tag, data_type, offset, count = struct.unpack(
+            '>iiii', index[16*i:16*(i+1)])
+        if wanted != None and not tag in wanted: continue
+        try:
+            tags[tag] = _decode_entry(store, data_type, offset, count)
+        except (ValueError, struct.error):
+            raise RpmHeaderError, "%s: corrupt tag %d" % (filename, tag)
+    return tags
+
+def _read_one_header(fp, filename, wanted):
+    """ Read a header structure from fp, which must be positioned at the
+    header magic
+
+    @return tuple of (dict of tag to decoded value, raw header bytes)
+    """
+    intro = _read_exactly(fp, 16, filename)
+    if intro[:4] != HEADER_MAGIC:
+        raise RpmHeaderError, "%s: bad header magic" % filename
+    nindex, hsize = struct.unpack('>ii', intro[8:16])
+    if nindex < 0 or hsize < 0:
+        raise RpmHeaderError, "%s: corrupt header" % filename
+
+    index = _read_exactly(fp, 16 * nindex, filename)
+    store = _read_exactly(fp, hsize, filename)
+
+    tags = _decode_tags(nindex, index, store, wanted, filename)
+    return tags, intro + index + store
+
+def read_header(filename, tags=DEFAULT_TAGS, sigtags=DEFAULT_SIGTAGS,
+                keep_blob=0):
+    """ Read the lead, signature and main header of filename, stopping
+    before the payload.
+
+    @param tags sequence of main header tags to decode, or None for all
+    @param sigtags sequence of signature tags to decode, or None for all
+    @param keep_blob if non-zero, the raw bytes of the main header are
+    kept in the blob attribute of the result
+    @return RpmHeader
+    """
+    if tags != None: tags = dict.fromkeys(tags)
+    if sigtags != None: sigtags = dict.fromkeys(sigtags)
+
+    fp = open(filename, 'rb')
+    try:
+        lead = _read_exactly(fp, LEAD_SIZE, filename)
+        if lead[:4] != LEAD_MAGIC:
+            raise RpmHeaderError, "%s: not an rpm" % filename
+
+        sig, sig_blob = _read_one_header(fp, filename, sigtags)
+        padding = (8 - (len(sig_blob) % 8)) % 8
+        _read_exactly(fp, padding, filename)
+
+        header_start = LEAD_SIZE + len(sig_blob) + padding
+        main, main_blob = _read_one_header(fp, filename, tags)
+    finally:
+        fp.close()
+
+    header = RpmHeader(filename, main, sig, header_start,
+                       header_start + len(main_blob))
+    if keep_blob:
+        header.blob = main_blob
+    return header
+
+def blob_length(data, offset=0):
+    """ @return length of the header structure starting at offset in
+    data, a string of raw headers """
+    if data[offset:offset + 4] != HEADER_MAGIC:
+        raise RpmHeaderError, "bad header magic at offset %d" % offset
+    nindex, hsize = struct.unpack('>ii', data[offset + 8:offset + 16])
+    return 16 + 16*nindex + hsize
+
+def split_blobs(data):
+    """ @return list of the raw headers in data, which holds headers one
+    after another with nothing between them, like an apt pkglist """
+    blobs = []
+    offset = 0
+    while offset < len(data):
+        length = blob_length(data, offset)
+        if offset + length > len(data):
+            raise RpmHeaderError, "truncated header at offset %d" % offset
+        blobs.append(data[offset:offset + length])
+        offset = offset + length
+    return blobs
+
+def decode_blob(blob, tags=DEFAULT_TAGS):
+    """ @return dict of tag to decoded value for raw header blob """
+    if tags != None: tags = dict.fromkeys(tags)
+    nindex = struct.unpack('>i', blob[8:12])[0]
+    index = blob[16:16 + 16*nindex]
+    store = blob[16 + 16*nindex:]
+    return _decode_tags(nindex, index, store, tags, '<header blob>')
+
+_alignment = {INT16: 2, INT32: 4, INT64: 8}
+
+def _encode_entry(data_type, value):
+    """ @return (encoded data, count) for value of data_type """
+    if data_type == INT32:
+        return struct.pack('>%dI' % len(value), *value), len(value)
+    elif data_type == INT16:
+        return struct.pack('>%dH' % len(value), *value), len(value)
+    elif data_type == INT64:
+        return struct.pack('>%dQ' % len(value), *value), len(value)
+    elif data_type in (CHAR, INT8):
+        return struct.pack('>%dB' % len(value), *value), len(value)
+    elif data_type == BIN:
+        return value, len(value)
+    elif data_type == STRING:
+        return value + '\0', 1
+    elif data_type in (STRING_ARRAY, I18NSTRING):
+        return ''.join([v + '\0' for v in value]), len(value)
+    raise ValueError, "can't encode header type %d" % data_type
+
+def append_entries(blob, entries):
+    """ @return copy of raw header blob with entries added after the
+    existing ones
+
+    @param entries list of (tag, type, value), value being a string for
+    STRING and BIN, and a list for everything else.  Tags should be
+    greater than any already in blob, to keep the index sorted.
+    """
+    nindex, hsize = struct.unpack('>ii', blob[8:16])
+    index = blob[16:16 + 16*nindex]
+    store = blob[16 + 16*nindex:]
+
+    new_index = [index]
+    new_store = [store]
+    store_len = len(store)
+    for tag, data_type, value in entries:
+        data, count = _encode_entry(data_type, value)
+        align = _alignment.get(data_type, 1)
+        padding = (align - store_len % align) % align
+        new_store.append('\0' * padding)
+        store_len = store_len + padding
+        new_index.append(struct.pack('>iiii', tag, data_type, store_len,
+                                     count))
+        new_store.append(data)
+        store_len = store_len + len(data)
+
+    return HEADER_MAGIC + '\0' * 4 + \
+           struct.pack('>ii', nindex + len(entries), store_len) + \
+           ''.join(new_index) + ''.join(new_store)
+
+def make_blob(entries):
+    """ @return raw header holding only entries, see append_entries """
+    empty = HEADER_MAGIC + '\0' * 4 + struct.pack('>ii', 0, 0)
+    entries = list(entries)
+    entries.sort()
+    return append_entries(empty, entries)
+
+def is_complete(filename):
+    """ @return non-zero if filename has its lead and both headers, and is
+    at least as long as its signature says it should be.  Used to tell
+    whether an upload has finished. """
+    try:
+        header = read_header(filename, tags=(), sigtags=(SIGTAG_SIZE,))
+        file_size = os.path.getsize(filename)
+    except (IOError, OSError):
+        return 0
+
+    size = header.payload_size()
+    if size == None:
+        return 1
+    return file_size >= header.header_start + size
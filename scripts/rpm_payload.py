@@ -0,0 +1,116 @@
+""" Read files out of an RPM's payload without rpm2cpio or cpio.
+
+The payload of an RPM starts right after the main header, and is a cpio
+archive in the "new ASCII" format compressed with gzip or bzip2.  It is
+decompressed as it is read, member by member, so finding one file only
+decompresses the payload up to the end of that file and nothing is
+ever written to disk.
+"""
+
+import bz2
+import zlib
+
+import rpm_header
+
+READ_SIZE = 64 * 1024
+
+CPIO_MAGICS = ('070701', '070702')
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = 'TRAILER!!!'
+
+class PayloadError(rpm_header.RpmHeaderError):
+    pass
+
+class _Decompressed:
+    """ File-like reader of the decompressed payload of an open rpm """
+    def __init__(self, fp, filename):
+        self._fp = fp
+        self._buffer = ''
+        self._pos = 0
+        self._eof = 0
+
+        start = fp.read(READ_SIZE)
+        if start.startswith('\x1f\x8b'):
+            # 16 + MAX_WBITS: expect a gzip header and trailer
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif start.startswith('BZh'):
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            raise PayloadError, "%s: unsupported payload compression" % (
+                filename)
+        self._feed(start)
+
+    def _feed(self, data):
+        try:
+            data = self._decompressor.decompress(data)
+        except (zlib.error, IOError, EOFError), e:
+            raise PayloadError, "corrupt payload: %s" % e
+        # drop what has been read already rather than copying it along
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+
+    def read(self, size):
+        """ @return up to size bytes, fewer only at the end """
+        while len(self._buffer) - self._pos < size and not self._eof:
+            data = self._fp.read(READ_SIZE)
+            if not data:
+                self._eof = 1
+                break
+            self._feed(data)
+        result = self._buffer[self._pos:self._pos + size]
+        self._pos = self._pos + len(result)
+        return result
+
+    def skip(self, size):
+        """ Throw away the next size bytes """
+        while size > 0:
+            chunk = self.read(min(size, READ_SIZE))
+            if not chunk: break
+            size = size - len(chunk)
+
+def _read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise PayloadError, "truncated cpio archive"
+    return data
+
+def _padding(length):
+    return (4 - length % 4) % 4
+
+def find_member(filename, wanted):
+    """ Find the first file in the payload of rpm filename for which
+    wanted(member name) is true.  Member names are as cpio stores them,
+    eg './usr/bin/foo', or just 'foo.spec' in a source rpm.
+
+    @return tuple of (member name, contents), or None if nothing matched
+    """
+    header = rpm_header.read_header(filename, tags=(), sigtags=())
+    fp = open(filename, 'rb')
+    try:
+        fp.seek(header.header_end)
+        reader = _Decompressed(fp, filename)
+        while 1:
+            intro = _read_exactly(reader, CPIO_HEADER_SIZE)
+            if not intro[:6] in CPIO_MAGICS:
+                raise PayloadError, "%s: bad cpio magic" % filename
+            try:
+                file_size = int(intro[54:62], 16)
+                name_size = int(intro[94:102], 16)
+            except ValueError:
+                raise PayloadError, "%s: corrupt cpio header" % filename
+
+            name = _read_exactly(reader, name_size)[:-1]
+            reader.skip(_padding(CPIO_HEADER_SIZE + name_size))
+            if name == CPIO_TRAILER:
+                return None
+
+            if wanted(name):
+                return name, _read_exactly(reader, file_size)
+            reader.skip(file_size + _padding(file_size))
+    finally:
+        fp.close()
+
+def spec_file(srpm):
+    """ @return tuple of (spec file name, contents) of source rpm srpm,
+    or None if it has no spec file """
+    return find_member(srpm, lambda name: name.endswith('.spec'))
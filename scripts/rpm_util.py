@@ -1,26 +1,142 @@
 import re
 import sys
-import commands
-import subprocess
+
+import rpm_cache
+import rpm_vercmp
 
 version = '.1'
 _dash_before_num = re.compile('-\d')
 _dash_after_num = re.compile('\d+-')
-_leading_numbers = re.compile('\d+') 
 
 def dict_from_list(l):
 	return dict([(key, None) for key in l])
 
+def parallel_map(func, seq, workers=1):
+	""" @return list of func applied to each item of seq, in order,
+	using up to workers threads.  workers <= 1 runs serially.
+
+	Items are started in the order of seq.  If func raises anything,
+	including SystemExit from a failed critical command, no more items
+	are started and the first exception is raised again here once the
+	running ones finish. """
+	seq = list(seq)
+	if workers <= 1 or len(seq) < 2:
+		return map(func, seq)
+
+	import threading
+	results = [None] * len(seq)
+	failures = []
+	next_item = [0]
+	lock = threading.Lock()
+
+	def worker():
+		while 1:
+			lock.acquire()
+			try:
+				index = next_item[0]
+				if index >= len(seq) or failures:
+					return
+				next_item[0] = index + 1
+			finally:
+				lock.release()
+			try:
+				results[index] = func(seq[index])
+			except BaseException:
+				lock.acquire()
+				failures.append(sys.exc_info())
+				lock.release()
+				return
+
+	threads = [threading.Thread(target=worker)
+		   for i in range(min(workers, len(seq)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if failures:
+		exc_type, exc_value, exc_tb = failures[0]
+		raise exc_type, exc_value, exc_tb
+	return results
+
 def parent_srpm(rpmname):
-	""" @return name of source rpm that built rpmname """
-	# need to actually query rpm in case of 'breakout' package
-	query_string = "rpm -qp --queryformat '%{SOURCERPM}' " + rpmname
+	""" @return name of source rpm that built rpmname, or None if
+	rpmname is unreadable or is itself a source rpm """
+	# need to actually look in the header in case of 'breakout' package
+	try:
+		return rpm_cache.get_header(rpmname).sourcerpm()
+	except (IOError, OSError), e:
+		print >> sys.stderr, "warning: %s" % e
+		return None
+
+class RpmName(object):
+	""" Immutable record of everything in an rpm filename.
+
+	name, version (tuple of strings), release, dist, sol_ver and
+	bitness are None when the filename doesn't have them.  key is the
+	rpm_vercmp version key, None unless version and release are known.
+	parsed is the tuple parse_rpmname used to return.
+	"""
+	__slots__ = ('filename', 'name', 'version', 'release', 'dist',
+		     'sol_ver', 'bitness', 'key', 'parsed')
+
+	def __init__(self, filename, parsed):
+		setter = object.__setattr__
+		padded = parsed + (None,) * (4 - len(parsed))
+		name, version, release, dist = padded
+		setter(self, 'filename', filename)
+		setter(self, 'name', intern(name))
+		setter(self, 'version', version)
+		setter(self, 'release', release)
+		setter(self, 'dist', dist)
+		ver_bit = _ver_bit_from_parsed(parsed)
+		if ver_bit == None: ver_bit = (None, None)
+		setter(self, 'sol_ver', ver_bit[0])
+		setter(self, 'bitness', ver_bit[1])
+		if release == None:
+			setter(self, 'key', None)
+		else:
+			setter(self, 'key', extract_rpm_version(parsed))
+		setter(self, 'parsed', parsed)
+
+	def __setattr__(self, attr, value):
+		raise AttributeError, "RpmName is immutable"
+
+	def __repr__(self):
+		return 'RpmName(%r)' % self.filename
+
+	def ver_bit(self):
+		""" @return (sol_ver, bitness) like sol_ver_and_bit """
+		if self.sol_ver == None: return None
+		return (self.sol_ver, self.bitness)
+
+	def ver_str(self):
+		""" @return human readable version-release string """
+		return '.'.join(self.version) + '-' + self.release
+
+# every filename parsed this run, so each one is only parsed once
+_parsed_names = {}
 
-	# this is ugly
-#	out = subprocess.Popen(query_string.split(),stdout=subprocess.PIPE).communicate()[0].strip() 
-#	print out
-#
-	return commands.getoutput(query_string)
+def parse(rpmname):
+	""" @return RpmName for rpmname, or None if not even a package name
+	can be found in it.  Results are remembered for the rest of the run.
+	"""
+	try:
+		return _parsed_names[rpmname]
+	except KeyError:
+		pass
+
+	parsed = _parse_rpmname(rpmname)
+	if parsed == None:
+		record = None
+	else:
+		record = RpmName(rpmname, parsed)
+	_parsed_names[rpmname] = record
+	return record
+
+def parse_many(rpmnames):
+	""" @return list of RpmName (or None) for each of rpmnames """
+	return map(parse, rpmnames)
 
 def parse_rpmname(full_rpmname):
 	""" Parse as much of an rpmname as is given.
@@ -28,6 +144,11 @@ def parse_rpmname(full_rpmname):
 	@return (name, (major, minor, rel), internal_rel, dist)
 	eg, in ('gtk2', ('2', '2', '2'), '0', 'solaris2.7-sparc')
 	"""
+	record = parse(full_rpmname)
+	if record == None: return None
+	return record.parsed
+
+def _parse_rpmname(full_rpmname):
 	match_name = _dash_before_num.search(full_rpmname)
 	if match_name == None: return None
 	
@@ -50,24 +171,30 @@ def parse_rpmname(full_rpmname):
 
 def extract_rpmname(fullname):
 	""" @param fullname string containing rpm filename """
-	parsed = parse_rpmname(fullname)
-	if parsed == None:				
+	record = parse(fullname)
+	if record == None:				
 		print >> sys.stderr, "warning [ %s ] didn't parse" % fullname
 		return ''
-	return parsed[0]
+	return record.name
 
 def sol_ver_and_bit(rpmname):
 	""" Find out the solaris version and bitness of given rpmname
 
-	@param rpmname either string containing full rpm filename, or
-	format of the return value of parse_rpmname
+	@param rpmname either string containing full rpm filename, a
+	RpmName, or format of the return value of parse_rpmname
 	@return tuple of strings containing version and bitness
 	(eg ('8', '64') or ('9', '')) or None if rpmname is unparseable
 	"""
 	if isinstance(rpmname, type('')):
-		rpmname = parse_rpmname(rpmname)
+		rpmname = parse(rpmname)
+		if rpmname == None: return None
+	if isinstance(rpmname, RpmName):
+		return rpmname.ver_bit()
+	return _ver_bit_from_parsed(rpmname)
+
+def _ver_bit_from_parsed(parsed):
 	try:
-		dist_str = rpmname[3]
+		dist_str = parsed[3]
 
 		match_vers = _dash_after_num.search(dist_str)
 		if match_vers == None:
@@ -83,34 +210,38 @@ def sol_ver_and_bit(rpmname):
 		
 	except (IndexError, TypeError):
 		return None
-		
-
-def _split_num_str(s):
-	""" @return tuple of (int, string) from s, with the int being the
-	leading numeral part of s, (or 0 if none is found) and the string
-	being the rest of s"""
-	match_leading_num = _leading_numbers.match(s)
-	
-	if match_leading_num:
-		boundry = match_leading_num.end()
-		num_begin = int(s[:boundry])
-		str_end = s[boundry:]
-	else:
-		num_begin = 0
-		str_end = s
-
-	return (num_begin, str_end)
 
 def extract_rpm_version(parsed_rpm_name):
 	""" @param parsed_rpm_name tuple formatted like output
 	of parse_rpmname
 	
-	@return tuple of (version, revision), which should order as expected
+	@return tuple of (version, revision) keys from rpm_vercmp, which
+	order the same way rpm orders them
 	"""
-# whitespace sensitive ridiculous tab pkg_vers if in try
-#	try:
-	pkg_vers = parsed_rpm_name[1]
-#	except IndexError, i:
-#		print parsed_rpm_name, " is poorly formatted"
-	split_pkg_vers = tuple(map(_split_num_str, pkg_vers))
-	return (split_pkg_vers, _split_num_str(parsed_rpm_name[2]))
+	pkg_vers = '.'.join(parsed_rpm_name[1])
+	return (rpm_vercmp.version_key(pkg_vers),
+		rpm_vercmp.version_key(parsed_rpm_name[2]))
+
+def rpm_sort_key(rpmname):
+	""" @return (name, version key) for an rpm filename, so a list of
+	filenames can be sorted by name and then version in a single sort,
+	or None if rpmname doesn't parse """
+	record = parse(rpmname)
+	if record == None or record.key == None:
+		return None
+	return (record.name, record.key)
+
+def newest_per_name(rpmnames):
+	""" @return dict keyed by package name yielding the filename of the
+	newest rpm of that name in rpmnames """
+	keyed = []
+	for rpmname in rpmnames:
+		key = rpm_sort_key(rpmname)
+		if key != None:
+			keyed.append((key, rpmname))
+	keyed.sort()
+
+	newest = {}
+	for (name, version), rpmname in keyed:
+		newest[name] = rpmname
+	return newest
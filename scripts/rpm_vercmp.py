@@ -0,0 +1,65 @@
+""" Compare versions the way rpm does.
+
+rpm splits a version into runs of digits and runs of letters, ignoring
+everything else, and compares the runs pairwise: numbers numerically,
+letters as strings, and a number is always newer than letters.  If all
+the runs match, the version with runs left over is newer.  So 1.0a is
+older than 1.0.1, and 1.0 is older than 1.0a.
+
+version_key turns a version into a tuple that sorts in that order, so it
+can be computed once and then used in sort()/max() or as a dict key.
+"""
+
+import re
+
+_segment = re.compile('([0-9]+)|([a-zA-Z]+)')
+
+def version_key(version):
+    """ @return hashable key for version string, keys order the same
+    way rpmvercmp does """
+    key = []
+    for digits, letters in _segment.findall(version):
+        if digits:
+            key.append((1, int(digits)))
+        else:
+            key.append((0, letters))
+    return tuple(key)
+
+def evr_key(epoch, version, release):
+    """ @return hashable key for an epoch, version and release, epoch
+    may be None """
+    return (epoch or 0, version_key(version), version_key(release or ''))
+
+def rpmvercmp(a, b):
+    """ @return -1, 0 or 1 as version string a is older, the same as or
+    newer than b, by rpm's rules """
+    if a == b: return 0
+    return cmp(version_key(a), version_key(b))
+
+def evrcmp(a, b):
+    """ Compare two (epoch, version, release) tuples like rpm does.  A
+    missing release on either side is not compared, so '1.0' matches
+    any release of 1.0.
+
+    @return -1, 0 or 1
+    """
+    result = cmp(a[0] or 0, b[0] or 0)
+    if result: return result
+    result = rpmvercmp(a[1], b[1])
+    if result: return result
+    if a[2] and b[2]:
+        return rpmvercmp(a[2], b[2])
+    return 0
+
+def parse_evr(evr):
+    """ @return (epoch, version, release) from a string like
+    '1:2.0-3', epoch is None and release is '' if they are missing """
+    epoch = None
+    colon = evr.find(':')
+    if colon != -1 and evr[:colon].isdigit():
+        epoch = int(evr[:colon])
+        evr = evr[colon+1:]
+    dash = evr.rfind('-')
+    if dash == -1:
+        return (epoch, evr, '')
+    return (epoch, evr[:dash], evr[dash+1:])
@@ -0,0 +1,225 @@
+""" Timing spans and counters for a publish run.
+
+Phases of a publish are timed with spans, either by decorating a
+function with timed() or with start() and Span.stop() around part of
+one.  Spans with the same name add up, so a phase run once per dist
+shows its total time and how often it ran.  Counters add up numbers
+like files scanned, commands forked and bytes copied, optionally
+labelled, eg with the dist.
+
+At the end of a run, write_json saves everything as a JSON run record
+and write_prometheus as a textfile for the node exporter's textfile
+collector.
+
+If enable_profiling has been called, every span also runs under
+cProfile and its stats are dumped to a file named after the span.  A
+span started inside another pauses the outer one's profiler, so each
+file only holds the time spent in its own phase.
+
+Everything here is safe to use from several threads.
+"""
+
+import os
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class RunRecord:
+    """ The spans and counters of one run """
+    def __init__(self):
+        self.start_time = time.time()
+        self.profile_dir = None
+        # span name -> [calls, total seconds, longest seconds]
+        self._spans = {}
+        # (counter name, sorted label items) -> value
+        self._counters = {}
+        self._profile_counts = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, name):
+        """ @return running Span called name """
+        return Span(self, name)
+
+    def add_span(self, name, seconds):
+        self._lock.acquire()
+        try:
+            span = self._spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] = span[0] + 1
+            span[1] = span[1] + seconds
+            span[2] = max(span[2], seconds)
+        finally:
+            self._lock.release()
+
+    def count(self, name, amount=1, **labels):
+        """ Add amount to the counter called name with labels """
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def profile_file(self, name):
+        """ @return unused file name in profile_dir for span name """
+        self._lock.acquire()
+        try:
+            n = self._profile_counts.get(name, 0) + 1
+            self._profile_counts[name] = n
+        finally:
+            self._lock.release()
+        return '%s/%s.%d.prof' % (self.profile_dir, name, n)
+
+    def profiler_stack(self):
+        """ @return list of the running profilers of this thread """
+        if not hasattr(self._local, 'profilers'):
+            self._local.profilers = []
+        return self._local.profilers
+
+    def as_dict(self):
+        """ @return the record as JSON friendly dicts and lists """
+        self._lock.acquire()
+        try:
+            spans = {}
+            for name, (calls, seconds, longest) in self._spans.items():
+                spans[name] = {'calls': calls,
+                               'seconds': round(seconds, 4),
+                               'max_seconds': round(longest, 4)}
+            counters = []
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.append({'name': name, 'labels': dict(labels),
+                                 'value': value})
+        finally:
+            self._lock.release()
+        return {'start': self.start_time,
+                'seconds': round(time.time() - self.start_time, 4),
+                'spans': spans,
+                'counters': counters}
+
+    def prometheus_text(self, prefix='publish'):
+        """ @return the record in Prometheus' text exposition format """
+        record = self.as_dict()
+        lines = ['# HELP %s_phase_seconds Seconds spent in each phase '
+                 'of the last run' % prefix,
+                 '# TYPE %s_phase_seconds gauge' % prefix]
+        names = record['spans'].keys()
+        names.sort()
+        for name in names:
+            lines.append('%s_phase_seconds{phase="%s"} %s' % (
+                prefix, name, record['spans'][name]['seconds']))
+        lines.append('# TYPE %s_phase_calls gauge' % prefix)
+        for name in names:
+            lines.append('%s_phase_calls{phase="%s"} %d' % (
+                prefix, name, record['spans'][name]['calls']))
+
+        typed = {}
+        for counter in record['counters']:
+            metric = '%s_%s' % (prefix, _metric_name(counter['name']))
+            if not metric in typed:
+                lines.append('# TYPE %s gauge' % metric)
+                typed[metric] = 1
+            labels = ','.join(['%s="%s"' % item
+                               for item in sorted(counter['labels'].items())])
+            if labels: labels = '{%s}' % labels
+            lines.append('%s%s %s' % (metric, labels, counter['value']))
+
+        lines.append('# TYPE %s_run_seconds gauge' % prefix)
+        lines.append('%s_run_seconds %s' % (prefix, record['seconds']))
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_last_run_timestamp_seconds %d' % (
+            prefix, int(record['start'])))
+        return '\n'.join(lines) + '\n'
+
+def _metric_name(name):
+    return ''.join([(c.isalnum() and c) or '_' for c in name])
+
+class Span:
+    """ A phase being timed, from creation until stop() """
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+        self.profiler = None
+        if record.profile_dir != None:
+            import cProfile
+            stack = record.profiler_stack()
+            if stack: stack[-1].disable()
+            self.profiler = cProfile.Profile()
+            stack.append(self.profiler)
+            self.profiler.enable()
+        self.start_time = time.time()
+
+    def stop(self):
+        """ Stop timing, adding the time to the span's total """
+        seconds = time.time() - self.start_time
+        if self.profiler != None:
+            self.profiler.disable()
+            stack = self.record.profiler_stack()
+            stack.pop()
+            try:
+                self.profiler.dump_stats(self.record.profile_file(self.name))
+            except (IOError, OSError), e:
+                print >> sys.stderr, "Warning, can't save profile:", e
+            if stack: stack[-1].enable()
+        self.record.add_span(self.name, seconds)
+        return seconds
+
+current = RunRecord()
+
+def reset():
+    """ Start a new run record, keeping the profiling setting """
+    global current
+    profile_dir = current.profile_dir
+    current = RunRecord()
+    current.profile_dir = profile_dir
+
+def start(name):
+    """ @return running Span called name in the current run """
+    return current.start(name)
+
+def count(name, amount=1, **labels):
+    """ Add amount to a counter of the current run """
+    current.count(name, amount, **labels)
+
+def timed(name):
+    """ Decorator timing every call of a function as span name """
+    def decorate(func):
+        def timed_func(*args, **kwargs):
+            span = current.start(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                span.stop()
+        timed_func.__name__ = func.__name__
+        timed_func.__doc__ = func.__doc__
+        return timed_func
+    return decorate
+
+def enable_profiling(profile_dir):
+    """ Profile every span from now on, dumping stats into profile_dir """
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    current.profile_dir = profile_dir
+
+def _write_atomic(path, data):
+    tmp_path = '%s.new.%d' % (path, os.getpid())
+    fp = open(tmp_path, 'w')
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    os.rename(tmp_path, path)
+
+def write_json(path, **extra):
+    """ Save the current run record as JSON to path, along with extra """
+    record = current.as_dict()
+    record.update(extra)
+    _write_atomic(path, json.dumps(record, indent=1, sort_keys=True) + '\n')
+
+def write_prometheus(path, prefix='publish'):
+    """ Save the current run record to path for the textfile collector """
+    _write_atomic(path, current.prometheus_text(prefix))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+""" Make a synthetic repository to run the publish scripts against.
+
+generate() relocates rpm_config under a root directory and fills it
+with a repository like the real one: every floating dist's RPMS.main,
+SRPMS, the attic, retired and error directories, and the CHECK_PEND
+directories.  Every package is a small but valid RPM, written with
+rpm_header.make_blob, with requires on other packages in the repository
+and on the capabilities the stand-in rpm says the system provides.
+
+The pending directories get newer versions of some packages, older
+versions of others, packages whose SRPM is missing and packages with a
+new unmet dependency, so every branch of a publish gets exercised.
+
+write_tools() writes stand-ins for the external programs the scripts
+run (rpm, apt-get, apt-cache, genbasedir, createrepo and so on).
+"""
+
+import getopt
+import hashlib
+import os
+import random
+import struct
+import sys
+
+import dep_resolver
+import rpm_config
+import rpm_header
+
+ARCH = 'sparc64'
+# what the stand-in rpm says the system provides
+SYSTEM_PROVIDES = ['libc.so.1', 'libm.so.1', 'libnsl.so.1', '/bin/sh']
+# rpmlib requires every package has, all allowed by rpm 4.0.2
+RPMLIB_REQUIRES = [('rpmlib(CompressedFileNames)', '<=', '3.0.4-1'),
+                   ('rpmlib(PayloadFilesHavePrefix)', '<=', '4.0-1')]
+
+TOOLS = {
+    'rpm': """#!/bin/sh
+# stand-in rpm: only answers the query dep_resolver makes of RPM_ROOT
+for arg in "$@"; do
+    case "$arg" in
+        -qa) printf '%s\\n' %(provides)s; exit 0;;
+    esac
+done
+exit 0
+""",
+    'apt-get': "#!/bin/sh\nexit 0\n",
+    'apt-cache': "#!/bin/sh\nexit 0\n",
+    'genbasedir': "#!/bin/sh\nexit 0\n",
+    'createrepo': "#!/bin/sh\nexit 0\n",
+    'rpm2html': "#!/bin/sh\nexit 0\n",
+    'cleanup-rpm2html': "#!/bin/sh\nexit 0\n",
+    'checkrelease.sh': "#!/bin/sh\nexit 0\n",
+    'rebuild-apt': "#!/bin/sh\nexit 0\n",
+    'rpmverify': "#!/bin/sh\nexit 0\n",
+    'sendmail': "#!/bin/sh\ncat >/dev/null\nexit 0\n",
+}
+
+def rpm_filename(name, version, release, vers=9, bitness='64'):
+    return '%s-%s-%s.solaris2.%s-sparc%s.rpm' % (name, version, release,
+                                                 vers, bitness)
+
+def srpm_filename(name, version, release):
+    return '%s-%s-%s.src.rpm' % (name, version, release)
+
+def _dep_entries(name_tag, flag_tag, version_tag, deps):
+    if not deps: return []
+    return [(name_tag, rpm_header.STRING_ARRAY, [d[0] for d in deps]),
+            (flag_tag, rpm_header.INT32,
+             [dep_resolver.op_flags(d[1]) for d in deps]),
+            (version_tag, rpm_header.STRING_ARRAY, [d[2] for d in deps])]
+
+def _file_entries(files):
+    if not files: return []
+    dirnames = []
+    dirindexes = []
+    basenames = []
+    for path in files:
+        slash = path.rfind('/') + 1
+        dirname = path[:slash]
+        if not dirname in dirnames: dirnames.append(dirname)
+        dirindexes.append(dirnames.index(dirname))
+        basenames.append(path[slash:])
+    return [(rpm_header.DIRINDEXES, rpm_header.INT32, dirindexes),
+            (rpm_header.BASENAMES, rpm_header.STRING_ARRAY, basenames),
+            (rpm_header.DIRNAMES, rpm_header.STRING_ARRAY, dirnames)]
+
+def write_rpm(path, name, version, release, requires=(), provides=(),
+              files=(), sourcerpm=None, payload_size=1024):
+    """ Write a minimal rpm to path
+
+    @param requires list of (name, operator, version) like
+    rpm_header.RpmHeader.requires returns, operator and version may be ''
+    @param provides list of (name, operator, version)
+    @param files list of full paths of files in the package
+    @param sourcerpm SOURCERPM tag, if None the package is a source rpm
+    @param payload_size bytes of filler payload after the headers
+    """
+    entries = [(rpm_header.NAME, rpm_header.STRING, name),
+               (rpm_header.VERSION, rpm_header.STRING, version),
+               (rpm_header.RELEASE, rpm_header.STRING, release),
+               (rpm_header.ARCH, rpm_header.STRING, ARCH)]
+    if sourcerpm != None:
+        entries.append((rpm_header.SOURCERPM, rpm_header.STRING, sourcerpm))
+    entries.extend(_dep_entries(rpm_header.REQUIRENAME,
+                                rpm_header.REQUIREFLAGS,
+                                rpm_header.REQUIREVERSION, list(requires)))
+    entries.extend(_dep_entries(rpm_header.PROVIDENAME,
+                                rpm_header.PROVIDEFLAGS,
+                                rpm_header.PROVIDEVERSION, list(provides)))
+    entries.extend(_file_entries(files))
+    main = rpm_header.make_blob(entries)
+    payload = '\0' * payload_size
+
+    sig = rpm_header.make_blob([
+        (rpm_header.SIGTAG_SIZE, rpm_header.INT32, [len(main) + len(payload)]),
+        (rpm_header.SIGTAG_MD5, rpm_header.BIN,
+         hashlib.md5(main + payload).digest())])
+    sig = sig + '\0' * ((8 - len(sig) % 8) % 8)
+
+    rpm_type = sourcerpm == None and 1 or 0
+    lead = struct.pack('>4sBBhh66shh16s', rpm_header.LEAD_MAGIC, 3, 0,
+                       rpm_type, 1, '%s-%s-%s' % (name, version, release),
+                       1, 5, '')
+    assert len(lead) == rpm_header.LEAD_SIZE
+
+    fp = open(path, 'wb')
+    try:
+        fp.write(lead + sig + main + payload)
+    finally:
+        fp.close()
+
+class Package:
+    """ One version of a synthetic package """
+    def __init__(self, index, version, release, requires):
+        self.name = 'pkg%05d' % index
+        self.lib = 'lib%s.so.1' % self.name
+        self.version = version
+        self.release = release
+        self.requires = requires
+
+    def filename(self):
+        return rpm_filename(self.name, self.version, self.release)
+
+    def srpm(self):
+        return srpm_filename(self.name, self.version, self.release)
+
+    def write(self, directory, payload_size):
+        write_rpm('%s/%s' % (directory, self.filename()), self.name,
+                  self.version, self.release,
+                  requires=RPMLIB_REQUIRES + self.requires,
+                  provides=[(self.lib, '', '')],
+                  files=['/usr/local/lib/%s' % self.lib,
+                         '/usr/local/bin/%s' % self.name],
+                  sourcerpm=self.srpm(), payload_size=payload_size)
+
+    def write_srpm(self, directory):
+        write_rpm('%s/%s' % (directory, self.srpm()), self.name,
+                  self.version, self.release, payload_size=256)
+
+def _makedirs(path):
+    if not os.path.isdir(path): os.makedirs(path)
+
+def generate(root, packages=1000, pending_fraction=0.1, payload_size=1024,
+             seed=0):
+    """ Relocate rpm_config under root and make a repository there
+
+    Every package is in unstable, about 70% are in testing and 50% in
+    stable, at older versions the further from unstable.  Each requires
+    a library from a lower numbered package and something from the
+    system, and the live dists have no unmet dependencies.
+
+    @param packages number of distinct package names
+    @param pending_fraction fraction of packages with something waiting
+    in the pending directory of a dist
+    @return dict keyed by floating dist yielding number of rpms put in
+    its pending directory
+    """
+    rand = random.Random(seed)
+    rpm_config.relocate(root)
+    vers, bitness = rpm_config.ver_bit_pairs()[0]
+
+    floating = sorted(rpm_config.fixed_to_floating.values())
+    for dist in floating:
+        _makedirs(rpm_config.rpm_main_dir(dist, vers, bitness))
+        _makedirs(rpm_config.pending_dir(dist))
+    for directory in (rpm_config.srpms_dir, rpm_config.sources_dir,
+                      rpm_config.attic_dir, rpm_config.retired_dir,
+                      rpm_config.error_dir, rpm_config.cache_dir):
+        _makedirs(directory)
+
+    # packages in stable are in testing too, and everything is in
+    # unstable, so a library is chosen from packages in every dist its
+    # user is in, leaving the live dists without unmet dependencies
+    in_stable = []
+    in_testing = []
+
+    pending_counts = dict([(dist, 0) for dist in floating])
+    for index in range(packages):
+        level = rand.random()
+        if level < 0.5:
+            candidates = in_stable
+        elif level < 0.7:
+            candidates = in_testing
+        else:
+            candidates = range(index)
+        requires = [(rand.choice(SYSTEM_PROVIDES), '', '')]
+        if candidates:
+            requires.append(('libpkg%05d.so.1' % rand.choice(candidates),
+                             '', ''))
+
+        major = rand.randint(1, 9)
+        by_dist = {'unstable': Package(index, '%d.2' % major, '1ru',
+                                       requires),
+                   'uranium': Package(index, '%d.2' % major, '1ru',
+                                      requires)}
+        if level < 0.7:
+            by_dist['testing'] = Package(index, '%d.1' % major, '1ru',
+                                         requires)
+            in_testing.append(index)
+        if level < 0.5:
+            by_dist['stable'] = Package(index, '%d.0' % major, '1ru',
+                                        requires)
+            in_stable.append(index)
+
+        for dist, pkg in by_dist.items():
+            if not dist in floating: continue
+            pkg.write(rpm_config.rpm_main_dir(dist, vers, bitness),
+                      payload_size)
+            srpm_path = '%s/%s' % (rpm_config.srpms_dir, pkg.srpm())
+            if not os.path.exists(srpm_path):
+                pkg.write_srpm(rpm_config.srpms_dir)
+
+        if rand.random() >= pending_fraction: continue
+
+        dist = rand.choice(floating)
+        pending = rpm_config.pending_dir(dist)
+        current = by_dist.get(dist)
+        kind = rand.random()
+        if current != None and kind < 0.1:
+            # older than what is already there
+            pkg = Package(index, current.version, '0ru', requires)
+        elif kind < 0.2:
+            # new unmet dependency
+            pkg = Package(index, '%d.3' % major, '1ru',
+                          requires + [('libmissing%05d.so.1' % index, '', '')])
+        else:
+            pkg = Package(index, '%d.3' % major, '1ru', requires)
+        pkg.write(pending, payload_size)
+        # some packages arrive without their source rpm
+        if kind < 0.9: pkg.write_srpm(pending)
+        pending_counts[dist] = pending_counts[dist] + 1
+
+    return pending_counts
+
+def write_tools(bin_dir):
+    """ Write stand-ins for the external programs into bin_dir, which
+    should go first in PATH """
+    _makedirs(bin_dir)
+    provides = ' '.join(["'%s'" % cap for cap in SYSTEM_PROVIDES])
+    for name, script in TOOLS.items():
+        path = '%s/%s' % (bin_dir, name)
+        fp = open(path, 'w')
+        fp.write(script.replace('%(provides)s', provides))
+        fp.close()
+        os.chmod(path, 0755)
+
+def usage(argv):
+    print "%s [-n packages] [-p fraction] [-s seed] root" % argv[0]
+    print "Make a synthetic repository under root, stand-in tools in root/bin"
+    print "-n : distinct package names, default 1000"
+    print "-p : fraction of packages with a pending rpm, default 0.1"
+    print "-s : random seed, default 0"
+    print "-h : print this message"
+
+def main(argv):
+    packages = 1000
+    pending_fraction = 0.1
+    seed = 0
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hn:p:s:')
+        for opt, val in opts:
+            if opt == '-h':
+                usage(argv)
+                return 1
+            elif opt == '-n':
+                packages = int(val)
+            elif opt == '-p':
+                pending_fraction = float(val)
+            elif opt == '-s':
+                seed = int(val)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+        return 1
+    if len(args) != 1:
+        usage(argv)
+        return 1
+
+    root = os.path.abspath(args[0])
+    pending = generate(root, packages, pending_fraction, seed=seed)
+    write_tools('%s/bin' % root)
+    for dist in sorted(pending):
+        print "%s: %d pending" % (dist, pending[dist])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -14,34 +14,39 @@ import operator
 import os
 import sys
 
+import repo_catalog
 import rpm_util
 import rpm_config
 
 func_mapping = {'lt': operator.lt, 'le': operator.le,
                 'e': operator.eq,
-                'ge': operator.gt, 'gt': operator.gt}
+                'ge': operator.ge, 'gt': operator.gt}
+output_formats = ('tsv', 'json')
 
 def usage(prog_name):
     sys.stdout = sys.stderr
     print "%s: [-c comp_type] dist_a dist_b" % prog_name
+    print "%s: -m [-o format] [-c comp_type dist_a dist_b]" % prog_name
     print "Find packages in dist_b with corresponding comparision in dist_a"
     print "Each dist must be in list %s" % ' '.join(rpm_config.dist_list)
     print "comp_type is one of %s, defaults to le" % (', '.join(func_mapping))
     print "'%s -c le unstable testing' will versions of packages in"% prog_name
     print "unstable that are less than or equal to that of testing"
+    print "-m prints the version of every package in every standard dist,"
+    print "   with the result of the comparison if dist_a and dist_b are given"
+    print "-o is the format of -m output, one of %s, defaults to tsv" % (
+        ', '.join(output_formats))
     return 1
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:], 'hc:')
+        opts, args = getopt.getopt(argv[1:], 'hc:mo:')
     except getopt.GetoptError:
         return usage(argv[0])
 
-    if len(args) < 2:
-        return usage(argv[0])
-
-
     comp_func = operator.le
+    matrix_mode = 0
+    output_format = 'tsv'
 
     for (opt, value) in opts:
         if opt == '-c':
@@ -49,8 +54,21 @@ def main(argv):
                 print >> sys.stderr, "invalid comparision: %s" % value
                 return 1
             comp_func = func_mapping[value]
+        if opt == '-m':
+            matrix_mode = 1
+        if opt == '-o':
+            if not value in output_formats:
+                print >> sys.stderr, "invalid output format: %s" % value
+                return 1
+            output_format = value
         if opt == '-h':
             return usage(argv[0])
+
+    if matrix_mode and len(args) == 0:
+        return print_matrix(version_matrix(), output_format)
+
+    if len(args) < 2:
+        return usage(argv[0])
     
     dist_list = rpm_config.dist_list
     newer_dist = args[0]
@@ -58,16 +76,139 @@ def main(argv):
     if (newer_dist not in dist_list) or (older_dist not in dist_list):
         print >> sys.stderr, "dists not in list"
         return usage(argv[0])
+
+    if matrix_mode:
+        if (newer_dist not in rpm_config.standard_dists) or \
+           (older_dist not in rpm_config.standard_dists):
+            print >> sys.stderr, "-m only compares standard dists"
+            return usage(argv[0])
+        matrix = version_matrix()
+        return print_matrix(matrix, output_format, (newer_dist, older_dist,
+                                                    comp_func))
     
     for (ver, bitness) in rpm_config.ver_bit_pairs():
         new_main_dir = rpm_config.rpm_main_dir(newer_dist, ver, bitness)
         old_main_dir = rpm_config.rpm_main_dir(older_dist, ver, bitness)
-        for fn in os.listdir(old_main_dir):
+        for fn in list_rpms(old_main_dir):
             mismatched_ver = find_comp_vers(fn, new_main_dir, comp_func)
             if mismatched_ver != None:
                 print old_main_dir + '/' + fn, mismatched_ver
 
     return 0
+
+def list_rpms(main_dir):
+    """ @return filenames in main_dir, from the repository catalog if
+    it covers main_dir """
+    catalog = repo_catalog.covering(main_dir)
+    if catalog != None:
+        return catalog.filenames(main_dir)
+    return os.listdir(main_dir)
+
+def newest_by_name(main_dir):
+    """ Read main_dir once.
+
+    @return dict keyed by package name yielding (version key, version
+    string) of the newest rpm with that name in main_dir.  A directory
+    that doesn't exist yields an empty dict.
+    """
+    newest = {}
+    catalog = repo_catalog.covering(main_dir)
+    if catalog != None:
+        for fn, name, key, ver_str in catalog.versions(main_dir):
+            if not name in newest or newest[name][0] < key:
+                newest[name] = (key, ver_str)
+        return newest
+
+    try:
+        filenames = list_rpms(main_dir)
+    except OSError:
+        return newest
+
+    for fn in filenames:
+        parsed = rpm_util.parse_rpmname(fn)
+        try:
+            key = rpm_util.extract_rpm_version(parsed)
+            ver_str = '.'.join(parsed[1]) + '-' + parsed[2]
+        except (IndexError, TypeError):
+            print >> sys.stderr, "Warning: can't parse %s" % fn
+            continue
+        if not parsed[0] in newest or newest[parsed[0]][0] < key:
+            newest[parsed[0]] = (key, ver_str)
+    return newest
+
+def version_matrix(dists=None):
+    """ Read the RPMS.main of every dist once
+
+    @param dists list of dists to read, defaults to the standard dists
+    @return tuple of (dists, rows).  Each row is a tuple of (sol_ver,
+    bitness, name, versions), where versions has one (version key,
+    version string) or None per dist.  Rows are sorted by sol_ver,
+    bitness and name.
+    """
+    if dists == None: dists = rpm_config.standard_dists
+    rows = []
+    for (ver, bitness) in rpm_config.ver_bit_pairs():
+        per_dist = []
+        for dist in dists:
+            main_dir = rpm_config.rpm_main_dir(dist, ver, bitness)
+            per_dist.append(newest_by_name(main_dir))
+        all_names = {}
+        for newest in per_dist:
+            all_names.update(newest)
+        names = all_names.keys()
+        names.sort()
+
+        for name in names:
+            versions = [newest.get(name) for newest in per_dist]
+            rows.append((ver, bitness, name, versions))
+    return dists, rows
+
+def print_matrix(matrix, output_format, comparison=None):
+    """ Write matrix, as returned by version_matrix, to stdout
+
+    @param comparison optional tuple of (newer_dist, older_dist,
+    comp_func), adds a column saying whether comp_func holds for the
+    versions in the two dists
+    """
+    dists, rows = matrix
+    if comparison != None:
+        newer_dist, older_dist, comp_func = comparison
+        newer_i = list(dists).index(newer_dist)
+        older_i = list(dists).index(older_dist)
+
+    records = []
+    for (ver, bitness, name, versions) in rows:
+        compared = None
+        if comparison != None and versions[newer_i] and versions[older_i]:
+            compared = bool(comp_func(versions[newer_i][0],
+                                      versions[older_i][0]))
+        records.append((ver, bitness, name,
+                        [v and v[1] for v in versions], compared))
+
+    if output_format == 'json':
+        import json
+        out = []
+        for (ver, bitness, name, ver_strs, compared) in records:
+            record = {'sol_ver': ver, 'bitness': bitness, 'name': name,
+                      'versions': dict(zip(dists, ver_strs))}
+            if comparison != None:
+                record['compared'] = compared
+            out.append(record)
+        json.dump(out, sys.stdout, indent=1, sort_keys=True)
+        print
+        return 0
+
+    header = ['sol_ver', 'bitness', 'name'] + list(dists)
+    if comparison != None:
+        header.append('%s_%s_%s' % (newer_dist, comp_func.__name__,
+                                    older_dist))
+    print '\t'.join(header)
+    for (ver, bitness, name, ver_strs, compared) in records:
+        line = [str(ver), bitness, name] + [v or '-' for v in ver_strs]
+        if comparison != None:
+            line.append({None: '-', True: 'yes', False: 'no'}[compared])
+        print '\t'.join(line)
+    return 0
             
 def find_comp_vers(pkg_filename, newer_main_dir, comp_func):
     """ Find a comparable version of the package given by
@@ -80,8 +221,17 @@ def find_comp_vers(pkg_filename, newer_main_dir, comp_func):
         parsed_pkg_name = rpm_util.parse_rpmname(pkg_filename)
         pkg_ver_from_old_dist = rpm_util.extract_rpm_version(parsed_pkg_name)
 
-        get_same_name_glob = '%s/%s*' % (newer_main_dir, parsed_pkg_name[0])
-        for newer_dist_pkg_name in glob.glob(get_same_name_glob):
+        catalog = repo_catalog.covering(newer_main_dir)
+        if catalog != None:
+            for fn, name, key, ver_str in catalog.versions(
+                newer_main_dir, parsed_pkg_name[0]):
+                if comp_func(key, pkg_ver_from_old_dist):
+                    return '%s/%s' % (newer_main_dir, fn)
+            return None
+
+        same_name = glob.glob('%s/%s*' % (newer_main_dir,
+                                          parsed_pkg_name[0]))
+        for newer_dist_pkg_name in same_name:
             basename = newer_dist_pkg_name.split('/')[-1]
             parsed_newer_name = rpm_util.parse_rpmname(basename)
             # prevent nastiness when one name is a prefix of another,